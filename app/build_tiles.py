@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Build the tiles of daily events of the Sun that core.tiles serves from.
+
+Every row of the grid is solved one day at a time with
+calculate_observers, for the solar day of each point with a UTC offset
+on its own side of the date line, and the rows of the grid are spread
+over a process pool.
+The arrays are written straight into the memory mapped .npy files, and
+meta.json last, so that an unfinished directory is never loaded.
+
+Run from the repository root, e.g. for land points between 60S and 72N
+on a one degree grid:
+    python3 app/build_tiles.py tiles --lat -60 72 --lon -180 180 --step 1 --years 2025 2027
+
+and serve from them with CELESTIAL_TILES_DIR=tiles.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from time import perf_counter
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(__file__))
+from core.tiles import EPOCH, MISSING, encode_angles, estimate_error
+
+# Days of error estimates computed at a time, to bound memory use
+ERROR_CHUNK_DAYS = 16
+# Days solved per process pool task
+YEAR_DAYS = 366
+
+
+def minutes(time_string):
+    """
+    Minutes since 1970-01-01 of a UTC time string, MISSING for None.
+    """
+    if time_string is None:
+        return MISSING
+    time = datetime.fromisoformat(time_string).replace(tzinfo=EPOCH.tzinfo)
+    return int((time - EPOCH).total_seconds()) // 60
+
+
+def build_row(directory, i, lat, lons, first_date, first_day, days):
+    """
+    Process pool task solving row i of the grid for days days
+    from first_date, which is day first_day of the tiles.
+    """
+    from routes.sunrise import calculate_observers, context, eph
+
+    shape = (days, len(lons), 4)
+    times = np.full(shape, MISSING, dtype=np.int32)
+    angles = np.full(shape, np.nan)
+    visible = np.zeros((days, len(lons)), dtype=np.uint8)
+    for day in range(days):
+        results = calculate_observers(first_date + timedelta(days=day), context.ts, eph,
+                                      [lat] * len(lons), lons, ["+00:00"] * len(lons), "Sun")
+        for j, (rising, setting, noon, _, _, _) in enumerate(results):
+            meridian, antimeridian = noon
+            times[day, j] = [minutes(rising[0]), minutes(setting[0]),
+                             minutes(meridian[0]), minutes(antimeridian[0])]
+            angles[day, j] = [np.nan if a is None else a for a in
+                              (rising[1], setting[1], meridian[1], antimeridian[1])]
+            visible[day, j] = ((1 if meridian[2] else 0)
+                               | (2 if antimeridian[2] else 0))
+
+    days_slice = slice(first_day, first_day + days)
+    np.load(os.path.join(directory, "times.npy"), mmap_mode="r+")[days_slice, i] = times
+    np.load(os.path.join(directory, "angles.npy"), mmap_mode="r+")[days_slice, i] = encode_angles(angles)
+    np.load(os.path.join(directory, "visible.npy"), mmap_mode="r+")[days_slice, i] = visible
+
+
+def build(directory, lats, lons, step, first_date, days, processes=None):
+    """
+    Builds tiles for the grid of lats and lons, spaced step degrees, for
+    days days from first_date into directory. Rows are solved a year at
+    a time in a pool of processes, or in this process if processes is 1.
+    """
+    os.makedirs(directory, exist_ok=True)
+    if os.path.exists(os.path.join(directory, "meta.json")):
+        os.remove(os.path.join(directory, "meta.json"))
+    shape = (days, len(lats), len(lons))
+    for name, dtype, fill, extra in [("times", np.int32, MISSING, (4,)),
+                                     ("angles", np.int16, 0, (4,)),
+                                     ("visible", np.uint8, 0, ())]:
+        array = np.lib.format.open_memmap(os.path.join(directory, name + ".npy"),
+                                          mode="w+", dtype=dtype, shape=shape + extra)
+        array[:] = fill
+        array.flush()
+        del array
+
+    tasks = [(directory, i, float(lat), [float(lon) for lon in lons],
+              first_date + timedelta(days=first_day), first_day,
+              min(YEAR_DAYS, days - first_day))
+             for i, lat in enumerate(lats) for first_day in range(0, days, YEAR_DAYS)]
+    start = perf_counter()
+    if processes == 1:
+        for task in tasks:
+            build_row(*task)
+    else:
+        with ProcessPoolExecutor(max_workers=processes,
+                                 mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = [executor.submit(build_row, *task) for task in tasks]
+            for done, future in enumerate(futures, 1):
+                future.result()
+                if done % max(1, len(futures) // 20) == 0:
+                    print(f"{done} of {len(futures)} rows in {perf_counter() - start:.0f} s")
+
+    times = np.load(os.path.join(directory, "times.npy"), mmap_mode="r")
+    angles = np.load(os.path.join(directory, "angles.npy"), mmap_mode="r")
+    error = np.lib.format.open_memmap(os.path.join(directory, "error.npy"), mode="w+",
+                                      dtype=np.uint8, shape=(days, len(lats) - 1, len(lons) - 1))
+    for day in range(0, days, ERROR_CHUNK_DAYS):
+        error[day:day + ERROR_CHUNK_DAYS] = estimate_error(
+            times[day:day + ERROR_CHUNK_DAYS], angles[day:day + ERROR_CHUNK_DAYS])
+    error.flush()
+
+    from routes.sunrise import etag_version
+    meta = {"lat0": float(lats[0]), "dlat": step, "nlat": len(lats),
+            "lon0": float(lons[0]), "dlon": step, "nlon": len(lons),
+            "first_date": first_date.strftime("%Y-%m-%d"), "days": days,
+            "version": f"{etag_version}:{datetime.now():%Y%m%dT%H%M%S}"}
+    with open(os.path.join(directory, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    return error
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("directory")
+    parser.add_argument("--lat", type=float, nargs=2, default=[-60, 72],
+                        help="first and last latitude of the grid")
+    parser.add_argument("--lon", type=float, nargs=2, default=[-180, 180],
+                        help="first and last longitude of the grid")
+    parser.add_argument("--step", type=float, default=1.0,
+                        help="grid spacing in degrees")
+    parser.add_argument("--years", type=int, nargs=2,
+                        default=[datetime.now().year, datetime.now().year + 1],
+                        help="first and last year")
+    parser.add_argument("--processes", type=int, default=None)
+    args = parser.parse_args()
+    # The tiles being built can not be served from
+    os.environ.pop("CELESTIAL_TILES_DIR", None)
+
+    # Points at the poles have no meaningful solar day
+    lats = np.arange(args.lat[0], args.lat[1] + args.step / 2, args.step)
+    lats = lats[np.abs(lats) < 90]
+    lons = np.arange(args.lon[0], args.lon[1] + args.step / 2, args.step)
+    first_date = datetime(args.years[0], 1, 1)
+    days = (datetime(args.years[1] + 1, 1, 1) - first_date).days
+
+    print(f"Building {days} days on a {len(lats)} x {len(lons)} grid ...")
+    start = perf_counter()
+    error = build(args.directory, lats, lons, args.step, first_date, days,
+                  args.processes)
+    print(f"Built tiles in {perf_counter() - start:.0f} s, "
+          f"{np.mean(error[:] <= 5):.0%} of cells within 0.5 minutes")
+
+
+if __name__ == "__main__":
+    main()
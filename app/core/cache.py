@@ -0,0 +1,121 @@
+import os
+import sys
+from collections import OrderedDict
+from threading import Lock
+
+
+cache = None
+
+
+class ResultCache():
+    """
+    Bounded in-process LRU cache for results of calculate_one_day.
+
+    Results are keyed on (body, date, lat, lon, offset, precision), with lat and lon
+    quantized to a grid of `quantization` degrees so that lookups for the
+    same city land on the same entry. Least recently used entries are
+    evicted when either `max_entries` or `max_bytes` is exceeded.
+    A cache with max_entries set to 0 is disabled.
+    """
+    def __init__(self, max_entries=100000, max_bytes=64 * 1024 * 1024,
+                 quantization=0.0001):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.quantization = quantization
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def key(self, body, date, lat, lon, offset, precision="full") -> tuple:
+        """
+        Build a cache key for a query, with lat and lon
+        quantized to the configured grid.
+        """
+        if self.quantization > 0:
+            lat = round(lat / self.quantization)
+            lon = round(lon / self.quantization)
+        return (body, date, lat, lon, offset, precision)
+
+    def get(self, key):
+        """
+        Return the cached value for key, or None on a miss.
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            try:
+                value, _ = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Store value under key and evict least recently used
+        entries until the cache is within its bounds again.
+        """
+        if not self.enabled:
+            return
+        size = _sizeof(key) + _sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.bytes += size
+            while (len(self._entries) > self.max_entries
+                   or self.bytes > self.max_bytes):
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "quantization": self.quantization,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions}
+
+
+def _sizeof(obj) -> int:
+    """
+    Approximate memory footprint of a cached result in bytes.
+    """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (list, tuple)):
+        size += sum(_sizeof(item) for item in obj)
+    return size
+
+
+def init_cache():
+    """
+    Create the result cache once, configured through the
+    CELESTIAL_CACHE_MAX_ENTRIES, CELESTIAL_CACHE_MAX_BYTES and
+    CELESTIAL_CACHE_QUANTIZATION (degrees) environment variables.
+    """
+    global cache
+    if cache is None:
+        cache = ResultCache(
+            max_entries=int(os.getenv("CELESTIAL_CACHE_MAX_ENTRIES", 100000)),
+            max_bytes=int(os.getenv("CELESTIAL_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+            quantization=float(os.getenv("CELESTIAL_CACHE_QUANTIZATION", 0.0001)))
+    return cache
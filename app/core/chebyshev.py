@@ -0,0 +1,157 @@
+"""
+Per-day Chebyshev interpolant tables of the geocentric apparent
+position of the Sun and Moon.
+
+The geocentric apparent position of a body at a given instant is the
+same for every observer. Each table holds a polynomial fit over one day
+(0h to 24h TT) to the position as x, y, z in au in the true equator and
+equinox of date frame, and to the Greenwich apparent sidereal time.
+This is the same information as right ascension, declination and
+distance, but without the wrap of right ascension at 24h. The
+observer-specific topocentric correction is then cheap arithmetic,
+see core.solver.horizontal.
+
+Accuracy against evaluating de440s.bsp directly through skyfield, with
+the default degree 8 fit: positions agree to about 2e-5 arcseconds and
+sidereal time to about 1e-3 arcseconds for both bodies, which is the
+resolution of a julian date stored as a double. This is checked by
+TestChebyshevTables in test_main.py.
+"""
+import os
+from threading import Lock
+from time import monotonic
+import numpy as np
+from numpy.polynomial import chebyshev
+from core.initialize import init_eph
+from core.context import init_context
+from core.solver import geocentric
+from core.metrics import TABLES
+
+DEGREE = 8
+
+tables = None
+
+
+class ChebyshevTables():
+    """
+    Tables of Chebyshev coefficients keyed by (body, day), where day is
+    floor(tt - 0.5) of the TT julian dates the table covers. Tables are
+    built on demand, or ahead of time with build(), and evicted after
+    `max_age` seconds without use or when there are more than
+    `max_tables`. Tables with max_tables set to 0 are disabled, and
+    positions are then evaluated directly from the ephemeris.
+
+    A Prometheus gauge passed as `gauge` is set to the number of tables
+    whenever it changes, by the process that holds the tables, so that
+    the tables of process pool workers are counted too.
+    """
+    def __init__(self, eph, ts, degree=DEGREE, max_tables=2000,
+                 max_age=86400, gauge=None):
+        self.eph = eph
+        self.ts = ts
+        self.gauge = gauge
+        self.degree = degree
+        self.max_tables = max_tables
+        self.max_age = max_age
+        self.built = 0
+        self.evictions = 0
+        self._tables = {}
+        self._lock = Lock()
+        # Chebyshev nodes on [-1, 1] to fit each day on
+        k = np.arange(2 * (degree + 1))
+        self._nodes = np.cos(np.pi * (k + 0.5) / len(k))
+
+    @property
+    def enabled(self):
+        return self.max_tables > 0
+
+    def build(self, body, days):
+        """
+        Build the tables for body for each day in days,
+        evaluating the ephemeris in a single call.
+        """
+        days = np.asarray(days, dtype=int)
+        tt = (days[:, None] + 1 + self._nodes / 2).ravel()
+        xyz, gast = geocentric(self.eph, self.ts, body, tt)
+        values = np.vstack([xyz, gast]).reshape(4, len(days), len(self._nodes))
+        now = monotonic()
+        with self._lock:
+            for i, day in enumerate(days):
+                y = values[:, i, :].copy()
+                y[3] = np.unwrap(y[3])
+                coefficients = chebyshev.chebfit(self._nodes, y.T, self.degree)
+                self._tables[(body, int(day))] = [coefficients, now]
+                self.built += 1
+            self._evict(now)
+            if self.gauge is not None:
+                self.gauge.set(len(self._tables))
+
+    def geocentric(self, body, tt) -> tuple:
+        """
+        Same as core.solver.geocentric, evaluated from the tables.
+        """
+        if not self.enabled:
+            return geocentric(self.eph, self.ts, body, tt)
+        tt = np.asarray(tt, dtype=float)
+        day = np.floor(tt - 0.5)
+        x = 2 * (tt - day) - 2
+        values = np.empty((4,) + tt.shape)
+        for d in np.unique(day):
+            mask = day == d
+            values[:, mask] = chebyshev.chebval(x[mask], self._table(body, int(d)))
+        return (values[:3], values[3])
+
+    def _table(self, body, day):
+        key = (body, day)
+        with self._lock:
+            table = self._tables.get(key)
+            if table is not None:
+                table[1] = monotonic()
+                return table[0]
+        self.build(body, [day])
+        with self._lock:
+            return self._tables[key][0]
+
+    def _evict(self, now):
+        """
+        Remove tables not used for max_age seconds, then the least
+        recently used tables while there are more than max_tables.
+        Must be called with the lock held.
+        """
+        expired = [key for key, (_, used) in self._tables.items()
+                   if now - used > self.max_age]
+        if len(self._tables) - len(expired) > self.max_tables:
+            by_use = sorted(self._tables, key=lambda key: self._tables[key][1])
+            expired = by_use[:len(self._tables) - self.max_tables]
+        for key in expired:
+            del self._tables[key]
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        return {"tables": len(self._tables),
+                "max_tables": self.max_tables,
+                "max_age": self.max_age,
+                "built": self.built,
+                "evictions": self.evictions}
+
+
+def init_tables():
+    """
+    Create the tables once, configured through the CELESTIAL_TABLES_MAX
+    and CELESTIAL_TABLES_MAX_AGE (seconds) environment variables.
+    CELESTIAL_TABLES_PREBUILD_DAYS builds the tables for the Sun and
+    Moon from yesterday and that many days ahead right away.
+    """
+    global tables
+    if tables is None:
+        tables = ChebyshevTables(
+            init_eph(), init_context().ts,
+            max_tables=int(os.getenv("CELESTIAL_TABLES_MAX", 2000)),
+            max_age=float(os.getenv("CELESTIAL_TABLES_MAX_AGE", 86400)),
+            gauge=TABLES)
+        prebuild_days = int(os.getenv("CELESTIAL_TABLES_PREBUILD_DAYS", 0))
+        if tables.enabled and tables.eph is not None and prebuild_days > 0:
+            today = int(np.floor(tables.ts.now().tt - 0.5))
+            for body in ["Sun", "Moon"]:
+                tables.build(body, range(today - 1, today + prebuild_days + 1))
+    return tables
@@ -0,0 +1,66 @@
+"""
+Shared astronomy context of the application.
+
+Holds the objects every calculation needs and that are expensive or
+wasteful to rebuild per request: the timescale and the ephemeris.
+"""
+import os
+from skyfield import api
+from core.initialize import init_eph
+
+ATMOSPHERE_REFRAC = 0.5666 # Average angle in which atmospheric refraction moves the horizon
+MOON_RADIUS_DEGREES = 0.2667 # Roughly stimated average Moon radius in degrees
+SUN_HORIZON = -0.8333 # Disc centre altitude at sunrise used by almanac.sunrise_sunset
+
+context = None
+
+
+class Observer():
+    """
+    An observer at a fixed location on the wgs84 ellipsoid.
+
+    lat, lon: latitude and longitude in degrees
+    """
+    def __init__(self, lat, lon):
+        self.lat = lat
+        self.lon = lon
+
+
+class AstroContext():
+    """
+    The timescale and ephemeris shared by all requests. Observers are
+    placed on a grid of `quantization` degrees, like the result cache.
+
+    `ready` is set once the application has run its warm-up
+    calculations, see the lifespan in main.py.
+    """
+    def __init__(self, eph, ts, quantization=0.0001):
+        self.eph = eph
+        self.ts = ts
+        self.quantization = quantization
+        self.ready = False
+
+    def observer(self, lat, lon) -> Observer:
+        """
+        Returns the Observer at lat, lon, rounded to the quantization grid.
+        """
+        if self.quantization > 0:
+            lat = round(lat / self.quantization) * self.quantization
+            lon = round(lon / self.quantization) * self.quantization
+        return Observer(lat, lon)
+
+    def stats(self) -> dict:
+        return {"ready": self.ready}
+
+
+def init_context():
+    """
+    Create the context once per process, configured through the
+    CELESTIAL_CACHE_QUANTIZATION (degrees) environment variable.
+    """
+    global context
+    if context is None:
+        context = AstroContext(
+            init_eph(), api.load.timescale(),
+            quantization=float(os.getenv("CELESTIAL_CACHE_QUANTIZATION", 0.0001)))
+    return context
@@ -0,0 +1,51 @@
+"""
+HTTP caching of results, which only depend on the query, the code
+calculating them and the ephemeris.
+"""
+import hashlib
+import os
+
+# Bump whenever a change to the calculations or the response format
+# changes the response to any query, so that cached copies are replaced.
+ENGINE_VERSION = "4"
+
+
+def ephemeris_version(eph) -> str:
+    """
+    Identifies the ephemeris by its file name, size and file record,
+    or as "none" where no ephemeris is loaded.
+    """
+    if eph is None:
+        return "none"
+    with open(eph.path, "rb") as f:
+        record = f.read(1024)
+    digest = hashlib.blake2b(record, digest_size=8).hexdigest()
+    return f"{eph.filename}:{os.path.getsize(eph.path)}:{digest}"
+
+
+def make_etag(version, *query) -> str:
+    """
+    Returns a strong ETag for the normalized query parameters and
+    the version of the engine and ephemeris answering it.
+    """
+    key = "\x1f".join([version] + [repr(part) for part in query])
+    return '"' + hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest() + '"'
+
+
+def if_none_match(header, etag) -> bool:
+    """
+    Returns whether an If-None-Match header matches etag, with
+    the weak comparison that RFC 9110 prescribes for it.
+    """
+    if header is None:
+        return False
+    if header.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque
+               for tag in header.split(","))
+
+
+def cache_headers(etag, max_age) -> dict:
+    return {"ETag": etag,
+            "Cache-Control": f"public, max-age={max_age}"}
@@ -1,32 +1,205 @@
+import atexit
+import json
 import logging
+import random
+import sys
 import colorlog
 import os
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue
+from time import perf_counter
 from skyfield import api
 
 
 eph = None
+eph_load_seconds = None
+listener = None
+
+# Bytes in a page of the ephemeris memory map
+PAGE_SIZE = 4096
+
 
 class Initialize():
     """
     Pre-load ephemeris table once.
+
+    The kernel is opened read-only and its segment coefficients are
+    memory-mapped rather than read into the heap, so every worker
+    process on a node shares the same page-cache-backed copy. With
+    `touch` set every page is read once up front, so the first request
+    does not pay for faulting the kernel in from disk.
     """
-    def __init__(self):
+    def __init__(self, touch=False):
+        start = perf_counter()
         self.eph = api.load('de440s.bsp')
+        self.mapped_bytes = map_ephemeris(self.eph, touch)
+        self.load_seconds = perf_counter() - start
+
+
+def map_ephemeris(eph, touch=False) -> int:
+    """
+    Memory-map the coefficients of every segment of eph, which jplephem
+    otherwise does lazily on first use, and return the mapped size in
+    bytes. With touch set, read one value per page to fault them in.
+
+    This relies on the private Segment._data and DAF._array of jplephem,
+    as of jplephem 2.24. Should they change, the segments are left to
+    the lazy loading of jplephem and 0 bytes are reported as mapped.
+    """
+    mapped = {}
+    try:
+        for segment in eph.spk.segments:
+            segment._data
+            daf = segment.daf
+            if daf._array is not None:
+                mapped[id(daf)] = daf._array
+    except AttributeError as e:
+        logging.getLogger("celestial").warning(
+            f"Ephemeris not memory-mapped up front: {e!r}")
+        return 0
+    if touch:
+        for array in mapped.values():
+            array[::PAGE_SIZE // array.itemsize].sum()
+    return sum(array.nbytes for array in mapped.values())
+
+
+def ephemeris_enabled() -> bool:
+    """
+    Whether the ephemeris is loaded. CELESTIAL_EPHEMERIS=0 makes a fast
+    only deployment, which answers nothing but precision=fast for the
+    Sun and never opens the ephemeris.
+    """
+    return os.getenv("CELESTIAL_EPHEMERIS", "1") != "0"
 
 
 #@router.on_event("startup")
 def init_eph():
-    global eph
+    """
+    Load the ephemeris once per process. Set CELESTIAL_EPH_TOUCH=1
+    to read the whole kernel into the page cache at load. Returns
+    None without loading anything if the ephemeris is disabled.
+    """
+    global eph, eph_load_seconds
+    if not ephemeris_enabled():
+        return None
     if(eph == None):
-      eph = Initialize().eph
+      loaded = Initialize(touch=os.getenv("CELESTIAL_EPH_TOUCH", "0") == "1")
+      eph = loaded.eph
+      eph_load_seconds = loaded.load_seconds
+      logging.getLogger("celestial").info(
+          f"Ephemeris loaded in {loaded.load_seconds:.3f} seconds, "
+          f"{loaded.mapped_bytes / 2**20:.1f} MiB memory-mapped")
     return eph
 
 
-def configure_logging():
+def memory_usage() -> dict:
+    """
+    Memory of the current process in KiB, from /proc/self/smaps_rollup.
+
+    rss counts every resident page, including pages shared with other
+    processes such as the memory-mapped ephemeris, while pss splits
+    shared pages evenly between the processes mapping them, and private
+    counts only the pages no other process uses. Returns an empty dict
+    where smaps_rollup is not available.
+    """
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return {}
+    fields = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        fields[name] = int(value.split()[0])
+    return {"rss": fields.get("Rss", 0),
+            "pss": fields.get("Pss", 0),
+            "shared": (fields.get("Shared_Clean", 0)
+                       + fields.get("Shared_Dirty", 0)),
+            "private": (fields.get("Private_Clean", 0)
+                        + fields.get("Private_Dirty", 0))}
+
+
+def log_memory_usage(logger, worker="main"):
+    """
+    Log the resident memory of this process with shared pages counted
+    in full (rss), split between processes (pss) and left out (private).
+    """
+    usage = memory_usage()
+    if usage:
+        logger.info(f"Worker {worker} (pid {os.getpid()}) memory: "
+                    f"rss {usage['rss'] / 1024:.1f} MiB, "
+                    f"pss {usage['pss'] / 1024:.1f} MiB, "
+                    f"shared {usage['shared'] / 1024:.1f} MiB, "
+                    f"private {usage['private'] / 1024:.1f} MiB")
+
+
+class AccessSampler():
+    """
+    Decides which requests are written to the access log. Failed
+    requests (status 400 and above) and requests taking at least
+    `slow_seconds` are always logged, other requests with probability
+    `rate`.
+    """
+    def __init__(self, rate=1.0, slow_seconds=1.0):
+        self.rate = rate
+        self.slow_seconds = slow_seconds
+
+    def __call__(self, status_code, seconds) -> bool:
+        return (status_code >= 400 or seconds >= self.slow_seconds
+                or random.random() < self.rate)
+
+
+def init_access_sampler():
+    """
+    Create the sampler configured through the CELESTIAL_ACCESS_LOG_SAMPLE
+    (fraction of successful requests to log) and
+    CELESTIAL_ACCESS_LOG_SLOW (seconds) environment variables.
+    """
+    return AccessSampler(
+        rate=float(os.getenv("CELESTIAL_ACCESS_LOG_SAMPLE", 1.0)),
+        slow_seconds=float(os.getenv("CELESTIAL_ACCESS_LOG_SLOW", 1.0)))
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as JSON lines, with the entries of a `fields`
+    dict passed through `extra` as top level keys.
+    """
+    def format(self, record):
+        entry = {"time": datetime.fromtimestamp(record.created, timezone.utc)
+                         .isoformat(timespec="milliseconds"),
+                 "level": record.levelname,
+                 "logger": record.name,
+                 "message": record.getMessage()}
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, separators=(",", ":"))
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    QueueHandler that leaves formatting to the handlers of the
+    QueueListener, in its background thread. The application only logs
+    immutable arguments, so records can be queued as they are.
+    """
+    def prepare(self, record):
+        return record
+
+
+def configure_logging(mode=None):
     """
     Configures the logging for the application.
     The log level can be set via the LOG_LEVEL environment variable.
-    If not set, it defaults to INFO."""
+    If not set, it defaults to INFO.
+
+    The mode can be set via the LOG_FORMAT environment variable:
+    "text" (the default) writes colored lines to stderr from the
+    calling thread, and "json" queues records for a background thread
+    that writes them to stdout as JSON lines, which keeps log writes
+    off the event loop."""
+    mode = (mode or os.getenv("LOG_FORMAT", "text")).lower()
     log_level = os.getenv("LOG_LEVEL", "INFO").upper()
     log_colors = {
         'DEBUG': 'cyan',
@@ -36,16 +209,22 @@ def configure_logging():
         'CRITICAL': 'bold_red',
     }
 
-    formatter = colorlog.ColoredFormatter(
-        "%(asctime)s - %(name)s - %(log_color)s%(levelname)s%(reset)s - %(message)s",
-        log_colors=log_colors,
-        reset=True,
-        style='%',
-        datefmt="%Y-%m-%d %H:%M:%S"
-    )
+    if mode == "json":
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(JsonFormatter())
+        handler = DeferredQueueHandler(Queue())
+        _start_listener(handler, stream_handler)
+    else:
+        formatter = colorlog.ColoredFormatter(
+            "%(asctime)s - %(name)s - %(log_color)s%(levelname)s%(reset)s - %(message)s",
+            log_colors=log_colors,
+            reset=True,
+            style='%',
+            datefmt="%Y-%m-%d %H:%M:%S"
+        )
 
-    handler = logging.StreamHandler()
-    handler.setFormatter(formatter)
+        handler = logging.StreamHandler()
+        handler.setFormatter(formatter)
 
     # Create a named logger for the application
     logger = logging.getLogger("celestial")
@@ -56,4 +235,41 @@ def configure_logging():
     logger.addHandler(handler)
     logger.propagate = False
     
-    return(logger)
\ No newline at end of file
+    return(logger)
+
+
+def _start_listener(handler, *handlers):
+    """
+    Start the background thread writing the records queued by handler.
+    """
+    global listener
+    _stop_listener()
+    listener = QueueListener(handler.queue, *handlers)
+    listener.start()
+
+
+def _stop_listener():
+    """
+    Write out the queued records and stop the background thread.
+    """
+    if listener is not None and listener._thread is not None:
+        listener.stop()
+
+
+def _restart_listener():
+    """
+    Only the forking thread survives a fork, so give a forked
+    process its own queue and background thread.
+    """
+    if listener is not None and listener._thread is not None:
+        queue = Queue()
+        for handler in logging.getLogger("celestial").handlers:
+            if isinstance(handler, DeferredQueueHandler):
+                handler.queue = queue
+        listener.queue = queue
+        listener._thread = None
+        listener.start()
+
+
+atexit.register(_stop_listener)
+os.register_at_fork(after_in_child=_restart_listener)
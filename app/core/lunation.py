@@ -0,0 +1,146 @@
+"""
+Table of lunations for looking up the phase of the Moon.
+
+The phase of the Moon is the difference of the apparent geocentric
+ecliptic longitudes of the Moon and the Sun, as almanac.moon_phase
+computes it. It grows smoothly from 0 to 360 degrees over every
+lunation, from one new moon to the next. The table holds the instants
+of the principal phases (new moon, first quarter, full moon and last
+quarter) found with almanac.moon_phases, and for every lunation a
+Chebyshev fit to the phase. Looking up a phase is then
+evaluating one polynomial instead of the ephemeris.
+
+Lunations are found a block of BLOCK_DAYS at a time, on demand. With
+the default degree 24 fit, phases agree with almanac.moon_phase to
+about 1e-5 degrees, far below the 0.01 degrees they are reported to.
+This is checked by TestLunationTable in test_main.py. Instants the
+table can not cover, at the ends of the ephemeris, are evaluated
+directly.
+"""
+from threading import Lock
+import numpy as np
+from numpy.polynomial import chebyshev
+from skyfield import almanac
+from core.initialize import init_eph
+from core.context import init_context
+
+DEGREE = 24
+BLOCK_DAYS = 365.25
+# Block 0 starts at J2000
+EPOCH_TT = 2451545.0
+# Longer than a lunation, so that every instant of a block falls in a
+# lunation found with the block
+PADDING_DAYS = 35
+PHASE_NAMES = almanac.MOON_PHASES
+
+lunations = None
+
+
+class LunationTable():
+    """
+    Lunations of the Moon, found with eph and ts in blocks of
+    BLOCK_DAYS days keyed by floor((tt - EPOCH_TT) / BLOCK_DAYS).
+    """
+    def __init__(self, eph, ts, degree=DEGREE):
+        self.eph = eph
+        self.ts = ts
+        self.degree = degree
+        self.built = 0
+        self.direct = 0
+        self._blocks = {}
+        self._lock = Lock()
+        k = np.arange(2 * (degree + 1))
+        self._nodes = np.cos(np.pi * (k + 0.5) / len(k))
+
+    def build(self, block):
+        """
+        Find the principal phases and fit the lunations of a block.
+        """
+        start = EPOCH_TT + block * BLOCK_DAYS
+        # Julian dates covered by every segment of the ephemeris
+        first = max(s.spk_segment.start_jd for s in self.eph.segments)
+        last = min(s.spk_segment.end_jd for s in self.eph.segments)
+        tt0 = max(start - PADDING_DAYS, first + 1)
+        tt1 = min(start + BLOCK_DAYS + PADDING_DAYS, last - 1)
+        if tt0 < tt1:
+            times, phases = almanac.find_discrete(self.ts.tt_jd(tt0), self.ts.tt_jd(tt1),
+                                                  almanac.moon_phases(self.eph))
+            tt = times.tt
+        else:
+            tt, phases = np.empty(0), np.empty(0, dtype=int)
+        new_moons = tt[phases == 0]
+        begin, end = new_moons[:-1], new_moons[1:]
+        coefficients = np.empty((self.degree + 1, len(begin)))
+        if len(begin):
+            x = (begin + end)[:, None] / 2 + self._nodes * (end - begin)[:, None] / 2
+            # Between two new moons the phase grows from 0 to 360
+            # degrees without wrapping
+            degrees = almanac.moon_phase(self.eph, self.ts.tt_jd(x.ravel())).degrees
+            degrees = degrees.reshape(x.shape)
+            coefficients = chebyshev.chebfit(self._nodes, degrees.T, self.degree)
+        in_block = (tt >= start) & (tt < start + BLOCK_DAYS)
+        with self._lock:
+            self._blocks[block] = (begin, end, coefficients,
+                                   tt[in_block], np.asarray(phases)[in_block])
+            self.built += 1
+
+    def _block(self, block) -> tuple:
+        with self._lock:
+            found = self._blocks.get(block)
+        if found is None:
+            self.build(block)
+            with self._lock:
+                found = self._blocks[block]
+        return found
+
+    def phase(self, tt) -> np.ndarray:
+        """
+        The phase of the Moon in degrees, from 0 to 360, at each of the
+        TT julian dates tt.
+        """
+        tt = np.atleast_1d(np.asarray(tt, dtype=float))
+        degrees = np.full(tt.shape, np.nan)
+        blocks = np.floor((tt - EPOCH_TT) / BLOCK_DAYS)
+        for block in np.unique(blocks):
+            mask = blocks == block
+            begin, end, coefficients, _, _ = self._block(int(block))
+            i = np.searchsorted(begin, tt[mask], side="right") - 1
+            covered = (i >= 0) & (tt[mask] < end[np.maximum(i, 0)])
+            i = np.maximum(i, 0)
+            x = (2 * tt[mask] - begin[i] - end[i]) / (end[i] - begin[i])
+            values = chebyshev.chebval(x, coefficients[:, i], tensor=False)
+            degrees[mask] = np.where(covered, values, np.nan)
+        missing = np.isnan(degrees)
+        if missing.any():
+            self.direct += int(missing.sum())
+            degrees[missing] = almanac.moon_phase(self.eph, self.ts.tt_jd(tt[missing])).degrees
+        return degrees % 360
+
+    def events(self, tt0, tt1) -> tuple:
+        """
+        The TT julian dates and indices into PHASE_NAMES of the
+        principal phases from tt0 up to tt1.
+        """
+        times, phases = [], []
+        for block in range(int(np.floor((tt0 - EPOCH_TT) / BLOCK_DAYS)),
+                           int(np.floor((tt1 - EPOCH_TT) / BLOCK_DAYS)) + 1):
+            _, _, _, tt, found = self._block(block)
+            mask = (tt >= tt0) & (tt < tt1)
+            times.append(tt[mask])
+            phases.append(found[mask])
+        return (np.concatenate(times), np.concatenate(phases))
+
+    def stats(self) -> dict:
+        return {"blocks": len(self._blocks),
+                "built": self.built,
+                "direct": self.direct}
+
+
+def init_lunations():
+    """
+    Create the table once. Blocks of lunations are built on demand.
+    """
+    global lunations
+    if lunations is None:
+        lunations = LunationTable(init_eph(), init_context().ts)
+    return lunations
@@ -1,6 +1,16 @@
+import json
+from fastapi.responses import Response
 from pydantic import BaseModel
 from typing import List, Optional, Literal
 
+COPYRIGHT = "MET Norway"
+LICENSE_URL = "https://api.met.no/license_data.html"
+
+# Encoder with the settings of starlette.responses.JSONResponse,
+# created once so that every response uses the same C encoder
+_encoder = json.JSONEncoder(ensure_ascii=False, allow_nan=False,
+                            indent=None, separators=(",", ":"))
+
 class Geometry(BaseModel):
     type: Literal["Point"] = "Point"
     coordinates: list[float]  # [longitude, latitude] without altitude
@@ -40,10 +50,35 @@ class ResponseModel(BaseModel):
     when: When
     properties: SunProperties | MoonProperties
 
+class FeatureCollection(BaseModel):
+    copyright: Literal["MET Norway"] = "MET Norway"
+    licenseURL: Literal["https://api.met.no/license_data.html"] = "https://api.met.no/license_data.html"
+    type: Literal["FeatureCollection"] = "FeatureCollection"
+    features: List[ResponseModel]
+
+class DailyMoonPhase(BaseModel):
+    date: str
+    moonphase: float
+
+class MoonPhaseEvent(BaseModel):
+    time: str
+    phase: Literal["New Moon", "First Quarter", "Full Moon", "Last Quarter"]
+
+class MoonPhasesProperties(BaseModel):
+    body: Literal["Moon"] = "Moon"
+    moonphases: List[DailyMoonPhase]
+    phase_events: List[MoonPhaseEvent]
+
+class MoonPhasesModel(BaseModel):
+    copyright: Literal["MET Norway"] = "MET Norway"
+    licenseURL: Literal["https://api.met.no/license_data.html"] = "https://api.met.no/license_data.html"
+    when: When
+    properties: MoonPhasesProperties
+
 
 def make_response(setting, rising, meridian, antimeridian,
                   start, end, body, lat, lon,
-                  moonphase, offset) -> ResponseModel:
+                  moonphase, offset) -> dict:
     """
     Construct a response model for celestial event data.
 
@@ -66,49 +101,108 @@ def make_response(setting, rising, meridian, antimeridian,
     Raises:
         ValueError: If 'body' is not "Sun" or "Moon".
     """
-    geometry = Geometry(coordinates=[lon, lat])
-    when = When(interval=[start + ":00Z", end + ":00Z"])
-
     rising_time = rising[0] + offset if rising[0] is not None else None
-    rising_az = round(rising[1], 2) if rising[1] is not None else None
+    rising_az = round(float(rising[1]), 2) if rising[1] is not None else None
     setting_time = setting[0] + offset if setting[0] is not None else None
-    setting_az = round(setting[1], 2) if setting[1] is not None else None
+    setting_az = round(float(setting[1]), 2) if setting[1] is not None else None
+    meridian = {
+        "time": meridian[0] + offset if meridian[0] is not None else None,
+        "disc_centre_elevation": round(float(meridian[1]), 2) if meridian[1] is not None else None,
+        "visible": str(meridian[2]) == "True" if meridian[2] is not None else None
+    }
+    antimeridian = {
+        "time": antimeridian[0] + offset if antimeridian[0] is not None else None,
+        "disc_centre_elevation": round(float(antimeridian[1]), 2) if antimeridian[1] is not None else None,
+        "visible": str(antimeridian[2]) == "True" if antimeridian[2] is not None else None
+    }
 
     if body == "Sun":
-        properties = SunProperties(
-            sunrise=RisingEvent(time=rising_time, azimuth=rising_az),
-            sunset=RisingEvent(time=setting_time, azimuth=setting_az),
-            solarnoon=MeridianCrossingEvent(
-                time=meridian[0] + offset if meridian[0] is not None else None,
-                disc_centre_elevation=round(meridian[1], 2) if meridian[1] is not None else None,
-                visible=str(meridian[2]) == "True" if meridian[2] is not None else None
-            ),
-            solarmidnight=MeridianCrossingEvent(
-                time=antimeridian[0] + offset if antimeridian[0] is not None else None,
-                disc_centre_elevation=round(antimeridian[1], 2) if antimeridian[1] is not None else None,
-                visible=str(antimeridian[2]) == "True" if antimeridian[2] is not None else None
-            )
-        )
+        properties = {
+            "body": "Sun",
+            "sunrise": {"time": rising_time, "azimuth": rising_az},
+            "sunset": {"time": setting_time, "azimuth": setting_az},
+            "solarnoon": meridian,
+            "solarmidnight": antimeridian
+        }
     elif body == "Moon":
-        properties = MoonProperties(
-            moonrise=RisingEvent(time=rising_time, azimuth=rising_az),
-            moonset=RisingEvent(time=setting_time, azimuth=setting_az),
-            high_moon=MeridianCrossingEvent(
-                time=meridian[0] + offset if meridian[0] is not None else None,
-                disc_centre_elevation=round(meridian[1], 2) if meridian[1] is not None else None,
-                visible=str(meridian[2]) == "True" if meridian[2] is not None else None
-            ),
-            low_moon=MeridianCrossingEvent(
-                time=antimeridian[0] + offset if antimeridian[0] is not None else None,
-                disc_centre_elevation=round(antimeridian[1], 2) if antimeridian[1] is not None else None,
-                visible=str(antimeridian[2]) == "True" if antimeridian[2] is not None else None
-            ),
-            moonphase=round(moonphase.degrees, 2) if moonphase else None
-        )
+        properties = {
+            "body": "Moon",
+            "moonrise": {"time": rising_time, "azimuth": rising_az},
+            "moonset": {"time": setting_time, "azimuth": setting_az},
+            "high_moon": meridian,
+            "low_moon": antimeridian,
+            "moonphase": round(float(moonphase.degrees), 2) if moonphase else None
+        }
     else:
         raise ValueError("body must be 'Sun' or 'Moon'")
 
-    return ResponseModel(
-        geometry=geometry,
-        when=when,
-        properties=properties).model_dump()
+    # Same content and key order as ResponseModel(...).model_dump(),
+    # built directly since the values are already of the right types.
+    return {
+        "copyright": COPYRIGHT,
+        "licenseURL": LICENSE_URL,
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [float(lon), float(lat)]},
+        "when": {"interval": [start + ":00Z", end + ":00Z"]},
+        "properties": properties
+    }
+
+
+def make_feature_collection(features) -> dict:
+    """
+    Construct a GeoJSON FeatureCollection from responses made by make_response.
+
+    Args:
+        features: List of dictionaries returned by make_response.
+
+    Returns:
+        dict: Dictionary representation of the FeatureCollection model.
+    """
+    return {
+        "copyright": COPYRIGHT,
+        "licenseURL": LICENSE_URL,
+        "type": "FeatureCollection",
+        "features": features
+    }
+
+
+def make_moon_phases(dates, phases, events, start, end, offset) -> dict:
+    """
+    Construct a response of the phases of the Moon over a range of days.
+
+    Args:
+        dates: List of YYYY-MM-DD strings of the days.
+        phases: Phase of the Moon in degrees at the start of each day.
+        events: List of (time, name) of the principal phases during the days.
+        start: Start time string (ISO format, without ":00Z" suffix).
+        end: End time string (ISO format, without ":00Z" suffix).
+        offset: String to append to event times (e.g., timezone offset).
+
+    Returns:
+        dict: Dictionary representation of MoonPhasesModel.
+    """
+    return {
+        "copyright": COPYRIGHT,
+        "licenseURL": LICENSE_URL,
+        "when": {"interval": [start + ":00Z", end + ":00Z"]},
+        "properties": {
+            "body": "Moon",
+            "moonphases": [{"date": date, "moonphase": round(float(phase), 2)}
+                           for date, phase in zip(dates, phases)],
+            "phase_events": [{"time": time + offset, "phase": name}
+                             for time, name in events]
+        }
+    }
+
+
+def render(content) -> Response:
+    """
+    Serialize a response made by make_response or make_feature_collection,
+    or a list of them, into a JSON response.
+
+    The bytes are the same as FastAPI returns after validating content
+    against the response models, but without validating and converting
+    it again, which make_response has already done.
+    """
+    return Response(content=_encoder.encode(content).encode("utf-8"),
+                    media_type="application/json")
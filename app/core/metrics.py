@@ -0,0 +1,81 @@
+"""
+Prometheus metrics of the application, exported on /metrics.
+
+With several worker processes, either uvicorn workers or a process
+pool, set PROMETHEUS_MULTIPROC_DIR to an empty directory shared by all
+of them, and /metrics aggregates the metrics of every process.
+The tables gauge is set by the process holding the tables, which with
+CELESTIAL_POOL=process are the pool workers, so without
+PROMETHEUS_MULTIPROC_DIR it stays 0 in that mode.
+"""
+import os
+from prometheus_client import (CollectorRegistry, Counter, Gauge, Histogram, REGISTRY,
+                               CONTENT_TYPE_LATEST, generate_latest,
+                               multiprocess)
+
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+REQUEST_SECONDS = Histogram(
+    "celestial_request_duration_seconds",
+    "Time from receiving a request to sending the response",
+    ["endpoint", "body", "status"])
+
+STAGE_SECONDS = Histogram(
+    "celestial_stage_duration_seconds",
+    "Time spent in each stage of answering a request. events: finding "
+    "transits, risings and settings, select: picking each day's events, "
+    "moon_phase: the phase of the Moon, tiles: looking up precomputed "
+    "events, response: building the response",
+    ["stage", "body"], buckets=STAGE_BUCKETS)
+
+COALESCED = Counter("celestial_coalesced_requests",
+                    "Requests answered with the results of an identical "
+                    "request calculated at the same time",
+                    ["body"])
+
+CACHE_ENTRIES = Gauge("celestial_cache_entries",
+                      "Entries in the result cache",
+                      multiprocess_mode="livesum")
+CACHE_BYTES = Gauge("celestial_cache_bytes",
+                    "Approximate bytes used by the result cache",
+                    multiprocess_mode="livesum")
+TABLES = Gauge("celestial_tables",
+               "Chebyshev tables of geocentric positions in memory",
+               multiprocess_mode="livesum")
+POOL_IN_FLIGHT = Gauge("celestial_pool_in_flight",
+                       "Calculations running or waiting in the worker pool",
+                       multiprocess_mode="livesum")
+POOL_QUEUED = Gauge("celestial_pool_queued",
+                    "Calculations waiting for a free worker",
+                    multiprocess_mode="livesum")
+EPHEMERIS_LOAD_SECONDS = Gauge("celestial_ephemeris_load_seconds",
+                               "Time taken to load the ephemeris",
+                               multiprocess_mode="max")
+
+
+def stage(name, body):
+    """
+    Context manager timing a stage of answering a request for body.
+    """
+    return STAGE_SECONDS.labels(name, body).time()
+
+
+def latest(cache, pool, eph_load_seconds) -> tuple:
+    """
+    Updates the gauges from the current state of the application and
+    returns the metrics in the Prometheus text format, with its content type.
+    """
+    cache_stats = cache.stats()
+    CACHE_ENTRIES.set(cache_stats["entries"])
+    CACHE_BYTES.set(cache_stats["bytes"])
+    POOL_IN_FLIGHT.set(pool.in_flight)
+    POOL_QUEUED.set(pool.queued)
+    if eph_load_seconds is not None:
+        EPHEMERIS_LOAD_SECONDS.set(eph_load_seconds)
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return (generate_latest(registry), CONTENT_TYPE_LATEST)
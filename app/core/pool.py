@@ -0,0 +1,135 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from threading import Lock
+from time import perf_counter, time
+
+
+pool = None
+
+
+class PoolFull(Exception):
+    """
+    Raised when a task is submitted to a worker pool whose queue is full.
+    """
+
+
+class WorkerPool():
+    """
+    Runs CPU bound calculations in a thread or process pool,
+    so that the asyncio event loop only does I/O.
+
+    At most `size` tasks run at the same time and at most `queue_depth`
+    more wait for a free worker. Submitting beyond that raises PoolFull.
+    Process pools need tasks that are module level functions taking
+    and returning picklable values.
+    """
+    def __init__(self, kind="thread", size=None, queue_depth=64):
+        self.kind = kind
+        self.size = size or os.cpu_count() or 1
+        self.queue_depth = queue_depth
+        if kind == "process":
+            # Spawn, since forking a process with running threads is unsafe
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.size,
+                mp_context=multiprocessing.get_context("spawn"))
+        elif kind == "thread":
+            self.executor = ThreadPoolExecutor(max_workers=self.size,
+                                               thread_name_prefix="celestial")
+        else:
+            raise ValueError("kind must be 'thread' or 'process'")
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.wait_seconds = 0.0
+        self.run_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.max_run_seconds = 0.0
+        self._lock = Lock()
+
+    @property
+    def queued(self):
+        return max(0, self.in_flight - self.size)
+
+    async def run(self, fn, *args):
+        """
+        Run fn(*args) in the pool and return its result.
+        """
+        with self._lock:
+            if self.in_flight >= self.size + self.queue_depth:
+                self.rejected += 1
+                raise PoolFull(f"Worker pool is full with {self.in_flight} tasks.")
+            self.in_flight += 1
+        submitted = time()
+        try:
+            future = self.executor.submit(_timed, fn, *args)
+        except BaseException:
+            self._done(None)
+            raise
+        # The task is in flight until the executor is done with it, also
+        # when the caller is cancelled while the task keeps running
+        future.add_done_callback(self._done)
+        try:
+            result, started, run_seconds = await asyncio.wrap_future(future)
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        wait_seconds = max(0.0, started - submitted)
+        with self._lock:
+            self.completed += 1
+            self.wait_seconds += wait_seconds
+            self.run_seconds += run_seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+            self.max_run_seconds = max(self.max_run_seconds, run_seconds)
+        return result
+
+    def _done(self, future):
+        with self._lock:
+            self.in_flight -= 1
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        completed = max(self.completed, 1)
+        return {"kind": self.kind,
+                "size": self.size,
+                "queue_depth": self.queue_depth,
+                "in_flight": self.in_flight,
+                "queued": self.queued,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "avg_wait_seconds": self.wait_seconds / completed,
+                "max_wait_seconds": self.max_wait_seconds,
+                "avg_run_seconds": self.run_seconds / completed,
+                "max_run_seconds": self.max_run_seconds}
+
+
+def _timed(fn, *args) -> tuple:
+    """
+    Runs fn(*args) inside a worker and returns the result together
+    with the wall clock start time and the run time in seconds.
+    """
+    started = time()
+    start = perf_counter()
+    result = fn(*args)
+    return (result, started, perf_counter() - start)
+
+
+def init_pool():
+    """
+    Create the worker pool once, configured through the
+    CELESTIAL_POOL ("thread" or "process"), CELESTIAL_POOL_SIZE and
+    CELESTIAL_POOL_QUEUE environment variables.
+    """
+    global pool
+    if pool is None:
+        pool = WorkerPool(
+            kind=os.getenv("CELESTIAL_POOL", "thread").lower(),
+            size=int(os.getenv("CELESTIAL_POOL_SIZE", 0)) or None,
+            queue_depth=int(os.getenv("CELESTIAL_POOL_QUEUE", 64)))
+    return pool
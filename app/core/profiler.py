@@ -0,0 +1,131 @@
+"""
+Opt-in profiling of slow calculations.
+
+When enabled, every worker pool task runs under cProfile, and the
+profile of any task taking longer than a threshold is written to a
+directory as a .prof file (readable with pstats or snakeviz) next to a
+.json file describing the task. Only the newest `max_files` profiles
+are kept.
+"""
+import cProfile
+import json
+import os
+import re
+from datetime import datetime, timezone
+from time import perf_counter
+
+profiler = None
+
+# Names of stored profiles, without extension
+NAME_PATTERN = re.compile(r"^\d{8}T\d{6}_\d{6}_\d+_[a-z_]+$")
+
+
+class SlowTaskProfiler():
+    """
+    Profiles worker pool tasks and keeps the profiles of tasks taking
+    at least `threshold` seconds in `directory`. Disabled if directory
+    is None. Instances are picklable, so run() works in process pools.
+    """
+    def __init__(self, directory=None, threshold=1.0, max_files=100):
+        self.directory = directory
+        self.threshold = threshold
+        self.max_files = max_files
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    def run(self, fn, *args):
+        """
+        Run fn(*args) under cProfile and store the profile if it was slow.
+        """
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # From Python 3.12 only one profiler can be active at a
+            # time, so concurrent tasks in a thread pool run unprofiled
+            return fn(*args)
+        start = perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            profile.disable()
+            seconds = perf_counter() - start
+            if seconds >= self.threshold:
+                self._store(profile, fn, args, seconds)
+
+    def _store(self, profile, fn, args, seconds):
+        now = datetime.now(timezone.utc)
+        name = f"{now:%Y%m%dT%H%M%S_%f}_{os.getpid()}_{fn.__name__}"
+        path = os.path.join(self.directory, name)
+        profile.dump_stats(path + ".prof")
+        with open(path + ".json", "w") as f:
+            json.dump({"name": name,
+                       "time": now.isoformat(timespec="milliseconds"),
+                       "seconds": seconds,
+                       "task": fn.__name__,
+                       "args": [_describe(arg) for arg in args]}, f)
+        self._evict()
+
+    def _evict(self):
+        """
+        Remove the oldest profiles beyond max_files.
+        """
+        names = self.names()
+        for name in names[:max(0, len(names) - self.max_files)]:
+            for extension in (".prof", ".json"):
+                try:
+                    os.remove(os.path.join(self.directory, name + extension))
+                except FileNotFoundError:
+                    pass
+
+    def names(self) -> list:
+        """
+        Names of the stored profiles, oldest first.
+        """
+        if not self.enabled:
+            return []
+        return sorted(file[:-5] for file in os.listdir(self.directory)
+                      if file.endswith(".json") and NAME_PATTERN.match(file[:-5]))
+
+    def describe(self, name) -> dict:
+        with open(os.path.join(self.directory, name + ".json")) as f:
+            return json.load(f)
+
+    def path(self, name) -> str:
+        """
+        Path of the .prof file of a stored profile,
+        or None if there is no such profile.
+        """
+        if not NAME_PATTERN.match(name) or name not in self.names():
+            return None
+        return os.path.join(self.directory, name + ".prof")
+
+
+def _describe(arg):
+    """
+    Short JSON friendly description of a task argument.
+    """
+    if isinstance(arg, (str, int, float, bool)) or arg is None:
+        return arg
+    if isinstance(arg, (list, tuple)) and len(arg) > 10:
+        return f"{type(arg).__name__} of {len(arg)}"
+    return str(arg)
+
+
+def init_profiler():
+    """
+    Create the profiler once, configured through the
+    CELESTIAL_PROFILE_DIR (enables profiling), CELESTIAL_PROFILE_THRESHOLD
+    (seconds) and CELESTIAL_PROFILE_MAX_FILES environment variables.
+    """
+    global profiler
+    if profiler is None:
+        profiler = SlowTaskProfiler(
+            directory=os.getenv("CELESTIAL_PROFILE_DIR") or None,
+            threshold=float(os.getenv("CELESTIAL_PROFILE_THRESHOLD", 1.0)),
+            max_files=int(os.getenv("CELESTIAL_PROFILE_MAX_FILES", 100)))
+    return profiler
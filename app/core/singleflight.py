@@ -0,0 +1,70 @@
+import asyncio
+import os
+from core.metrics import COALESCED
+
+
+single_flight = None
+
+
+class SingleFlight():
+    """
+    Coalesces identical calculations that are in flight at the same time.
+
+    The first call for a key runs the calculation as a task, and calls
+    with the same key while it runs await the same task instead of
+    calculating again. The key is forgotten as soon as the task is done,
+    so this holds no results, unlike the result cache. The task is
+    shielded, so a caller that is cancelled, e.g. by a client going
+    away, does not cancel it for the others. Errors are raised to every
+    caller. A SingleFlight with enabled set to False runs every call.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.calculated = 0
+        self.coalesced = 0
+        self._tasks = {}
+
+    async def run(self, key, label, fn, *args):
+        """
+        Returns the result of await fn(*args), shared with other calls
+        for key. label is the body the coalesced calls are counted for.
+        """
+        if not self.enabled:
+            return await fn(*args)
+        # Tasks belong to the event loop they were created on
+        key = (id(asyncio.get_running_loop()), key)
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn(*args))
+            self._tasks[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+            self.calculated += 1
+        else:
+            self.coalesced += 1
+            COALESCED.labels(label).inc()
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        # Mark errors as retrieved, also when every caller has gone away
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> dict:
+        return {"enabled": self.enabled,
+                "in_flight": len(self._tasks),
+                "calculated": self.calculated,
+                "coalesced": self.coalesced}
+
+
+def init_single_flight():
+    """
+    Create the single flight once, configured through the
+    CELESTIAL_COALESCE environment variable (0 disables it).
+    """
+    global single_flight
+    if single_flight is None:
+        single_flight = SingleFlight(
+            enabled=os.getenv("CELESTIAL_COALESCE", "1") == "1")
+    return single_flight
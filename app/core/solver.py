@@ -0,0 +1,228 @@
+"""
+Vectorized solver for risings, settings and meridian transits
+of a celestial body seen from arrays of observers.
+
+The geocentric apparent position of the body is the same for every
+observer, so it is evaluated once per time on a shared time grid.
+Each observer's altitude and hour angle then follow from broadcast
+NumPy arithmetic. Events are bracketed on the grid and all brackets
+are refined together, with one ephemeris evaluation per iteration.
+Meridian transits are first interpolated from the hour angle, which
+settles most of them in a single evaluation, so that observers in polar
+day or night, who only have transits, need hardly any refining.
+"""
+import numpy as np
+from skyfield.framelib import true_equator_and_equinox_of_date
+from skyfield.nutationlib import iau2000b_radians
+
+AU_KM = 149597870.7
+WGS84_RADIUS_KM = 6378.137
+WGS84_FLATTENING = 1 / 298.257223563
+
+# Event kinds
+RISING = 0
+TRANSIT = 1
+
+
+class Events():
+    """
+    Events found by find_events, as flat arrays sorted by observer and time.
+
+    observer: index of the observer the event belongs to
+    tt: time of the event as a TT julian date
+    kind: RISING for risings and settings, TRANSIT for meridian transits
+    value: 1 for risings and meridian transits,
+           0 for settings and antimeridian transits
+    alt, az: altitude and azimuth of the body at the event in degrees
+    up: whether the body is above the horizon at the event
+    """
+    def __init__(self, observer, tt, kind, value, alt, az, up):
+        self.observer = observer
+        self.tt = tt
+        self.kind = kind
+        self.value = value
+        self.alt = alt
+        self.az = az
+        self.up = up
+
+
+def geocentric(eph, ts, body, tt) -> tuple:
+    """
+    Returns the geocentric apparent position of body as x, y, z in au
+    in the true equator and equinox of date frame, together with the
+    Greenwich apparent sidereal time in radians, at TT julian dates tt.
+    """
+    t = ts.tt_jd(tt)
+    # Same nutation model as skyfield uses in its almanac functions
+    t._nutation_angles_radians = iau2000b_radians(t)
+    app = eph["earth"].at(t).observe(eph[body]).apparent()
+    return (app.frame_xyz(true_equator_and_equinox_of_date).au,
+            t.gast * np.pi / 12)
+
+
+def horizontal(xyz, gast, lat, lon) -> tuple:
+    """
+    Returns topocentric altitude and azimuth in degrees and hour angle
+    in radians of a body with geocentric position xyz (see geocentric)
+    for observers at lat, lon degrees on the wgs84 ellipsoid.
+
+    gast, lat and lon broadcast against the trailing shape of xyz.
+    """
+    phi = np.radians(lat)
+    sin_phi, cos_phi = np.sin(phi), np.cos(phi)
+    theta = gast + np.radians(lon)
+    sin_theta, cos_theta = np.sin(theta), np.cos(theta)
+
+    # Observer position in the true equator and equinox of date frame
+    e2 = WGS84_FLATTENING * (2 - WGS84_FLATTENING)
+    n = WGS84_RADIUS_KM / np.sqrt(1 - e2 * sin_phi**2) / AU_KM
+    x = xyz[0] - n * cos_phi * cos_theta
+    y = xyz[1] - n * cos_phi * sin_theta
+    z = xyz[2] - n * (1 - e2) * sin_phi
+
+    # Components along the local zenith, north and east directions
+    zenith = cos_phi * (cos_theta * x + sin_theta * y) + sin_phi * z
+    north = - sin_phi * (cos_theta * x + sin_theta * y) + cos_phi * z
+    east = - sin_theta * x + cos_theta * y
+    alt = np.degrees(np.arctan2(zenith, np.hypot(north, east)))
+    az = np.degrees(np.arctan2(east, north)) % 360
+    hour_angle = (theta - np.arctan2(y, x)) % (2 * np.pi)
+    return (alt, az, hour_angle)
+
+
+def _states(alt, hour_angle, horizon, inclusive) -> tuple:
+    """
+    Returns whether the body is up and whether it is west of the
+    meridian, matching the almanac functions of skyfield.
+    """
+    up = alt >= horizon if inclusive else alt > horizon
+    west = hour_angle < np.pi
+    return (up, west)
+
+
+def find_events(eph, ts, body, lat, lon, tt0, tt1, horizon,
+                epsilon, inclusive=False, step_days=0.04,
+                tables=None) -> Events:
+    """
+    Finds risings, settings and meridian transits of body between TT
+    julian dates tt0 and tt1 for every observer in the arrays lat, lon.
+
+    Arguments:
+    ----------
+    eph: skyfield.jpllib.SpiceKernel Object
+        loaded ephemeral table from skyfield api module
+
+    ts: skyfield.timelib.Timescale Object
+
+    body: str
+        Name of celestial object
+
+    lat, lon: array of float
+        latitudes and longitudes of the observers in degrees
+
+    tt0, tt1: float
+        start and end of the search as TT julian dates
+
+    horizon: float
+        altitude in degrees of the disc centre at rising and setting
+
+    epsilon: float
+        precision of the event times in days, as for almanac.find_discrete
+
+    inclusive: bool
+        whether the body counts as up when exactly at the horizon,
+        as almanac.sunrise_sunset does
+
+    step_days: float
+        spacing of the shared time grid. Events closer together
+        than this for one observer may be missed.
+
+    tables: core.chebyshev.ChebyshevTables Object
+        optional interpolant tables to evaluate the geocentric position
+        of the body from, instead of the ephemeris. Anything with the
+        same geocentric(body, tt) method will do, such as
+        core.analytic.AnalyticSun
+    """
+    def positions(tt):
+        if tables is not None:
+            return tables.geocentric(body, tt)
+        return geocentric(eph, ts, body, tt)
+
+    lat = np.asarray(lat, dtype=float)[:, None]
+    lon = np.asarray(lon, dtype=float)[:, None]
+
+    # Sample every observer on a shared time grid. The grid is aligned
+    # to whole multiples of step_days, so that an event is bracketed and
+    # refined the same way whatever range it is searched for in.
+    tt = np.arange(np.floor(tt0 / step_days), np.ceil(tt1 / step_days) + 1) * step_days
+    xyz, gast = positions(tt)
+    alt, _, hour_angle = horizontal(xyz[:, None, :], gast, lat, lon)
+    up, west = _states(alt, hour_angle, horizon, inclusive)
+
+    # Bracket every change of state
+    brackets = []
+    for kind, state in ((RISING, up), (TRANSIT, west)):
+        observer, index = np.nonzero(state[:, 1:] != state[:, :-1])
+        brackets.append((observer, index, np.full(len(index), kind)))
+    observer, index, kind = (np.concatenate(b) for b in zip(*brackets))
+    if len(index) == 0:
+        empty = np.array([])
+        return Events(index, empty, index, index, empty, empty,
+                      empty.astype(bool))
+    start = tt[index]
+    end = tt[index + 1]
+    before = np.where(kind == RISING, up[observer, index], west[observer, index])
+    lat, lon = lat[observer, 0], lon[observer, 0]
+
+    # The hour angle grows almost linearly, so interpolating it on the
+    # grid puts meridian transits well within epsilon. Each transit
+    # bracket is narrowed to epsilon / 2 around the interpolated time
+    # if the states at both ends confirm it, which is all the refining
+    # observers in polar day or night need. Risings and settings, and
+    # transits that are not confirmed, are bisected below.
+    transit = np.flatnonzero(kind == TRANSIT)
+    if len(transit):
+        h0 = hour_angle[observer[transit], index[transit]]
+        h1 = hour_angle[observer[transit], index[transit] + 1]
+        # West of the meridian the next crossing is the antimeridian at
+        # an hour angle of pi, east of it the meridian at 0
+        target = np.where(before[transit], np.pi, 0)
+        fraction = ((target - h0) % (2 * np.pi)) / ((h1 - h0) % (2 * np.pi))
+        estimate = start[transit] + fraction * (end[transit] - start[transit])
+        ends = np.concatenate([estimate - epsilon / 4, estimate + epsilon / 4])
+        xyz, gast = positions(ends)
+        alt, _, hour_angle = horizontal(xyz, gast, np.tile(lat[transit], 2),
+                                        np.tile(lon[transit], 2))
+        _, west = _states(alt, hour_angle, horizon, inclusive)
+        west_before, west_after = west[:len(transit)], west[len(transit):]
+        confirmed = ((west_before == before[transit]) & (west_after != before[transit])
+                     & (ends[:len(transit)] > start[transit])
+                     & (ends[len(transit):] < end[transit]))
+        start[transit[confirmed]] = ends[:len(transit)][confirmed]
+        end[transit[confirmed]] = ends[len(transit):][confirmed]
+
+    # Refine the remaining brackets together, keeping the state at the
+    # start of each bracket equal to the state before the event
+    refine = np.flatnonzero(end - start > epsilon)
+    while len(refine) and (end[refine] - start[refine]).max() > epsilon:
+        middle = (start[refine] + end[refine]) / 2
+        xyz, gast = positions(middle)
+        alt, _, hour_angle = horizontal(xyz, gast, lat[refine], lon[refine])
+        up, west = _states(alt, hour_angle, horizon, inclusive)
+        changed = np.where(kind[refine] == RISING, up, west) != before[refine]
+        end[refine] = np.where(changed, middle, end[refine])
+        start[refine] = np.where(changed, start[refine], middle)
+
+    # Drop events the grid found outside the requested range
+    inside = (end > tt0) & (start < tt1)
+    observer, kind, before = observer[inside], kind[inside], before[inside]
+    lat, lon, end = lat[inside], lon[inside], end[inside]
+
+    # Like almanac.find_discrete, report the first time after each event
+    xyz, gast = positions(end)
+    alt, az, hour_angle = horizontal(xyz, gast, lat, lon)
+    up, _ = _states(alt, hour_angle, horizon, inclusive)
+    order = np.lexsort((end, observer))
+    return Events(observer[order], end[order], kind[order],
+                  (~before[order]).astype(int), alt[order], az[order],
+                  up[order])
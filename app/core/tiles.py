@@ -0,0 +1,210 @@
+"""
+Precomputed tiles of the daily events of the Sun on a lat/lon grid.
+
+A tile directory, written by build_tiles.py, holds for every day and
+grid point the times of sunrise, sunset, solar noon and solar midnight
+as integer minutes since 1970-01-01 UTC, the azimuths and elevations at
+them in hundredths of degrees, and whether the Sun is visible at noon
+and midnight. Each day is the solar day of the grid point, as
+calculate_days finds it for an offset on the same side of the date line
+as the point. The arrays are .npy files that are memory mapped, so only
+the pages of the days and places asked for are read.
+
+A query between grid points is answered by bilinear interpolation of
+the four surrounding points. The error of the interpolation is
+estimated at build time for every cell and day from the curvature of
+the event times and azimuths over the grid, and queries in cells where
+it exceeds `max_error` minutes, or where the corners do not all have
+the same events, are left to the live calculation.
+"""
+import json
+import os
+from datetime import datetime, timezone
+from threading import Lock
+import numpy as np
+
+tiles = None
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# Order of the events in times.npy and angles.npy
+RISE, SET, NOON, MIDNIGHT = range(4)
+MISSING = np.iinfo(np.int32).min
+# Error estimates are stored in tenths of minutes, UNKNOWN_ERROR
+# for cells whose error could not be estimated or is too large
+UNKNOWN_ERROR = 255
+# Largest allowed interpolation error of azimuths in degrees
+MAX_AZIMUTH_ERROR = 0.05
+# Largest second difference of times truncated to the minute over
+# times that change linearly
+TRUNCATION_NOISE = 2
+
+
+class EventTiles():
+    """
+    Memory mapped tiles in `directory`. Disabled if directory is None.
+    """
+    def __init__(self, directory=None, max_error=0.5):
+        self.directory = directory
+        self.max_error = max_error
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        if directory is None:
+            return
+        with open(os.path.join(directory, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.first_date = datetime.strptime(self.meta["first_date"], "%Y-%m-%d")
+        self.times = np.load(os.path.join(directory, "times.npy"), mmap_mode="r")
+        self.angles = np.load(os.path.join(directory, "angles.npy"), mmap_mode="r")
+        self.visible = np.load(os.path.join(directory, "visible.npy"), mmap_mode="r")
+        self.error = np.load(os.path.join(directory, "error.npy"), mmap_mode="r")
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    @property
+    def version(self) -> str:
+        return self.meta["version"] if self.enabled else None
+
+    def lookup(self, date, lat, lon):
+        """
+        Returns the interpolated events of the solar day of date at
+        (lat, lon) as (times, angles, visible): the times in minutes
+        since 1970-01-01 UTC and angles in degrees of RISE, SET, NOON
+        and MIDNIGHT, None for events that do not happen, and whether
+        the Sun is visible at NOON and MIDNIGHT. Returns None when the
+        query is outside the tiles or the interpolation not good enough.
+        """
+        result = self._lookup(date, lat, lon)
+        with self._lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return result
+
+    def _lookup(self, date, lat, lon):
+        if not self.enabled:
+            return None
+        meta = self.meta
+        day = (date - self.first_date).days
+        y = (lat - meta["lat0"]) / meta["dlat"]
+        x = (lon - meta["lon0"]) / meta["dlon"]
+        if (not 0 <= day < meta["days"] or not 0 <= y <= meta["nlat"] - 1
+                or not 0 <= x <= meta["nlon"] - 1):
+            return None
+        i = min(int(y), meta["nlat"] - 2)
+        j = min(int(x), meta["nlon"] - 2)
+        if self.error[day, i, j] > self.max_error * 10:
+            return None
+        u, v = y - i, x - j
+        weights = np.array([[(1 - u) * (1 - v), (1 - u) * v],
+                            [u * (1 - v), u * v]])[..., np.newaxis]
+        corners = np.asarray(self.times[day, i:i + 2, j:j + 2])
+        missing = corners == MISSING
+        if (missing.any(axis=(0, 1)) != missing.all(axis=(0, 1))).any():
+            # An event that only happens at some of the corners
+            return None
+        visible = np.asarray(self.visible[day, i:i + 2, j:j + 2])
+        if visible.min() != visible.max():
+            return None
+        angles = np.asarray(self.angles[day, i:i + 2, j:j + 2], dtype=float)
+        if np.ptp(angles[..., [RISE, SET]], axis=(0, 1)).max() > 9000:
+            # Azimuths on both sides of north, close to polar day
+            return None
+        angles[..., [RISE, SET]] += 18000
+        times = (weights * np.where(missing, 0, corners)).sum(axis=(0, 1))
+        angles = (weights * angles).sum(axis=(0, 1)) / 100
+        happens = ~missing[0, 0]
+        return ([int(round(t)) if h else None for t, h in zip(times, happens)],
+                [float(a) if h else None for a, h in zip(angles, happens)],
+                [bool(visible[0, 0] & 1), bool(visible[0, 0] & 2)])
+
+    def stats(self) -> dict:
+        if not self.enabled:
+            return {"enabled": False}
+        return {"enabled": True,
+                "version": self.version,
+                "first_date": self.meta["first_date"],
+                "days": self.meta["days"],
+                "grid": [self.meta["nlat"], self.meta["nlon"]],
+                "max_error": self.max_error,
+                "hits": self.hits,
+                "misses": self.misses}
+
+
+def encode_angles(azimuths_and_elevations) -> np.ndarray:
+    """
+    Encodes [rise azimuth, set azimuth, noon elevation, midnight
+    elevation] in degrees, NaN where missing, as stored in angles.npy.
+    Azimuths are shifted by 180 degrees to fit in int16.
+    """
+    angles = np.array(azimuths_and_elevations, dtype=float)
+    angles[..., [RISE, SET]] -= 180
+    return np.where(np.isnan(angles), 0, np.round(angles * 100)).astype(np.int16)
+
+
+def estimate_error(times, angles=None) -> np.ndarray:
+    """
+    Estimates the error in tenths of minutes of bilinear interpolation
+    in each cell of the grid from times of shape (days, nlat, nlon, 4),
+    as an uint8 array of shape (days, nlat - 1, nlon - 1). With the
+    encoded angles of the same shape, cells where the azimuths of rise
+    and set interpolate worse than MAX_AZIMUTH_ERROR degrees are
+    given UNKNOWN_ERROR.
+
+    The error of bilinear interpolation is about an eighth of the
+    second differences along latitude and longitude, which are taken at
+    the corners of each cell. As the times are truncated to the minute,
+    second differences of up to TRUNCATION_NOISE minutes are noise and
+    do not count. Events missing at all four corners of a cell are
+    ignored, while events missing around some of them make the error
+    unknown.
+    """
+    days, nlat, nlon, _ = times.shape
+    if nlat < 3 or nlon < 3:
+        return np.full((days, nlat - 1, nlon - 1), UNKNOWN_ERROR, dtype=np.uint8)
+    missing = times == MISSING
+    cell = _cell_error(np.where(missing, np.nan, times.astype(float)), TRUNCATION_NOISE)
+    if angles is not None:
+        azimuths = np.where(missing, np.nan, angles.astype(float))[..., [RISE, SET]] / 100
+        cell[_cell_error(azimuths) > MAX_AZIMUTH_ERROR] = np.inf
+    return np.minimum(np.ceil(cell * 10), UNKNOWN_ERROR).astype(np.uint8)
+
+
+def _cell_error(t, noise=0) -> np.ndarray:
+    """
+    The largest interpolation error of the events of each cell, from
+    values t of shape (days, nlat, nlon, events), NaN where missing.
+    """
+    curvature = np.zeros_like(t)
+    second_lat = np.abs(t[:, :-2] - 2 * t[:, 1:-1] + t[:, 2:])
+    second_lon = np.abs(t[:, :, :-2] - 2 * t[:, :, 1:-1] + t[:, :, 2:])
+    second_lat = np.maximum(second_lat - noise, 0)
+    second_lon = np.maximum(second_lon - noise, 0)
+    # Edges take the second difference of their neighbour
+    curvature += np.concatenate([second_lat[:, :1], second_lat, second_lat[:, -1:]], axis=1)
+    curvature += np.concatenate([second_lon[:, :, :1], second_lon, second_lon[:, :, -1:]], axis=2)
+    error = curvature / 8
+    corners = np.stack([error[:, :-1, :-1], error[:, :-1, 1:],
+                        error[:, 1:, :-1], error[:, 1:, 1:]])
+    missing = np.stack([np.isnan(t[:, :-1, :-1]), np.isnan(t[:, :-1, 1:]),
+                        np.isnan(t[:, 1:, :-1]), np.isnan(t[:, 1:, 1:])]).all(axis=0)
+    # Unknown (NaN) errors of events that happen count as too large
+    cell = np.where(np.isnan(corners), np.inf, corners).max(axis=0)
+    return np.where(missing, 0, cell).max(axis=-1)
+
+
+def init_tiles():
+    """
+    Load the tiles once, configured through the CELESTIAL_TILES_DIR
+    (enables serving from tiles) and CELESTIAL_TILES_MAX_ERROR
+    (minutes) environment variables.
+    """
+    global tiles
+    if tiles is None:
+        tiles = EventTiles(
+            directory=os.getenv("CELESTIAL_TILES_DIR") or None,
+            max_error=float(os.getenv("CELESTIAL_TILES_MAX_ERROR", 0.5)))
+    return tiles
@@ -16,7 +16,7 @@ async def http_exception_handler(request, exc):
     logger.info(f"Call to endpoint {request.url.path} "
                  f"failed with status_code {exc.status_code}")
     return(JSONResponse(content=str(exc.detail),
-                        headers=headers,
+                        headers={**headers, **(exc.headers or {})},
                         status_code=exc.status_code))
 
 async def unexpected_exception_handler(request, exc):
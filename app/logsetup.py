@@ -0,0 +1,9 @@
+"""
+Configures logging when imported, before the modules that log while
+they are imported, such as the ephemeris loading in routes.sunrise.
+Imported first by main.py.
+"""
+from core.initialize import configure_logging, init_access_sampler
+
+logger = configure_logging()
+access_sampler = init_access_sampler()
@@ -1,19 +1,59 @@
 #!/usr/bin/env python3
 
+import asyncio
+import hmac
+import io
+import os
+import pstats
 import uvicorn
+from contextlib import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import HTMLResponse
-from routes.sunrise import router
+from fastapi import Depends, FastAPI, Header, HTTPException, Request
+from fastapi.responses import (HTMLResponse, PlainTextResponse, Response,
+                               FileResponse)
+from logsetup import logger, access_sampler
+from core import initialize
+from core.initialize import log_memory_usage
+from routes.sunrise import router, warm_up
 from exception_handler import (http_exception_handler,
                               unexpected_exception_handler)
 from time import perf_counter
-from core.initialize import configure_logging
+from http import HTTPStatus
+from core.cache import init_cache
+from core.singleflight import init_single_flight
+from core.pool import init_pool
+from core.chebyshev import init_tables
+from core.tiles import init_tiles
+from core.lunation import init_lunations
+from core.context import init_context
+from core.metrics import REQUEST_SECONDS, latest
+from core.profiler import init_profiler
+
+
+log_memory_usage(logger)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Builds the shared astronomy context and runs warm-up calculations
+    in every pool worker before /readyz reports ready. Without the
+    lifespan, as in tests, everything is still built lazily on first use.
+    """
+    context = init_context()
+    pool = init_pool()
+    start_time = perf_counter()
+    runs = pool.size if pool.kind == "process" else 1
+    await asyncio.gather(*[pool.run(warm_up) for _ in range(runs)])
+    context.ready = True
+    logger.info(f"Warm-up completed in {perf_counter() - start_time:.3f} seconds")
+    yield
+    context.ready = False
 
 
-logger = configure_logging()
 app = FastAPI(openapi_url="/openapi.json",
-              docs_url="/docs")
+              docs_url="/docs",
+              lifespan=lifespan)
 
 
 app.include_router(router)
@@ -32,11 +72,42 @@ app.add_middleware(
 async def add_process_time_header(request: Request,
                                   call_next):
     start_time = perf_counter()
-    response = await call_next(request)
+    try:
+        response = await call_next(request)
+    except Exception:
+        observe_request(request, HTTPStatus.INTERNAL_SERVER_ERROR,
+                        perf_counter() - start_time)
+        raise
     process_time = perf_counter() - start_time
-    logger.info(f"Request: {request.method} {request.url} with status code {response.status_code} completed in {process_time:.4f} seconds")
+    observe_request(request, response.status_code, process_time)
+    if access_sampler(response.status_code, process_time):
+        # Arguments are formatted by the log handler, which in
+        # LOG_FORMAT=json mode does so off the event loop
+        logger.info("Request: %s %s with status code %s completed in %.4f seconds",
+                    request.method, request.url, response.status_code, process_time,
+                    extra={"fields": {"method": request.method,
+                                      "path": request.url.path,
+                                      "query": request.url.query,
+                                      "status": response.status_code,
+                                      "duration_ms": round(process_time * 1000, 3),
+                                      "sample_rate": access_sampler.rate}})
     return(response)
 
+METRIC_BODIES = {"sun", "moon"}
+
+def observe_request(request, status_code, seconds):
+    """
+    Records the latency of a request by route, body and status.
+    The body label only takes the values of known bodies, or "other",
+    so that requests for made up bodies do not create new series.
+    """
+    route = request.scope.get("route")
+    endpoint = route.path if route is not None else "unmatched"
+    body = request.scope.get("path_params", {}).get("body", "")
+    if body and body not in METRIC_BODIES:
+        body = "other"
+    REQUEST_SECONDS.labels(endpoint, body, int(status_code)).observe(seconds)
+
 @app.get("/healthz",
          response_class=HTMLResponse)
 def healthz():
@@ -48,6 +119,74 @@ def healthz():
            "Status: Ok<br/>"
            "Description: Application for requesting rising and setting of The Sun and Moon.")
 
+@app.get("/readyz",
+         response_class=PlainTextResponse)
+def readyz():
+    if not init_context().ready:
+        raise HTTPException(detail="Warming up",
+                            status_code=HTTPStatus.SERVICE_UNAVAILABLE)
+    return "Ready"
+
+@app.get("/metrics")
+def metrics() -> Response:
+    content, media_type = latest(init_cache(), init_pool(),
+                                 initialize.eph_load_seconds)
+    return Response(content=content, media_type=media_type)
+
+def require_admin_token(authorization: str | None = Header(None)):
+    """
+    Admits requests with the header "Authorization: Bearer <token>" for
+    the token in CELESTIAL_ADMIN_TOKEN. Without the token configured the
+    admin endpoints are not served.
+    """
+    token = os.getenv("CELESTIAL_ADMIN_TOKEN", "")
+    if not token:
+        raise HTTPException(detail="The admin endpoints are not enabled.",
+                            status_code=HTTPStatus.NOT_FOUND)
+    if authorization is None or not hmac.compare_digest(
+            authorization.encode(), f"Bearer {token}".encode()):
+        raise HTTPException(detail="A valid admin token is required.",
+                            status_code=HTTPStatus.UNAUTHORIZED,
+                            headers={"WWW-Authenticate": "Bearer"})
+
+@app.get("/admin/profiles", dependencies=[Depends(require_admin_token)])
+def profiles() -> list:
+    """
+    Lists the stored profiles of slow calculations, newest first.
+    """
+    profiler = init_profiler()
+    if not profiler.enabled:
+        raise HTTPException(detail="Profiling is not enabled.",
+                            status_code=HTTPStatus.NOT_FOUND)
+    return [profiler.describe(name) for name in reversed(profiler.names())]
+
+@app.get("/admin/profiles/{name}", dependencies=[Depends(require_admin_token)])
+def profile(name: str, format: str = "prof") -> Response:
+    """
+    Returns a stored profile as a .prof file for pstats or snakeviz,
+    or with format=text the 40 most expensive functions.
+    """
+    path = init_profiler().path(name)
+    if path is None:
+        raise HTTPException(detail=f"No profile named {name}.",
+                            status_code=HTTPStatus.NOT_FOUND)
+    if format == "text":
+        output = io.StringIO()
+        pstats.Stats(path, stream=output).sort_stats("cumulative").print_stats(40)
+        return PlainTextResponse(output.getvalue())
+    return FileResponse(path, media_type="application/octet-stream",
+                        filename=name + ".prof")
+
+@app.get("/stats")
+def stats() -> dict:
+    return {"context": init_context().stats(),
+            "cache": init_cache().stats(),
+            "coalescing": init_single_flight().stats(),
+            "pool": init_pool().stats(),
+            "tables": init_tables().stats(),
+            "tiles": init_tiles().stats(),
+            "lunations": init_lunations().stats()}
+
 @app.get("/")
 def home() -> str:
     return ("This is the Celestial backend for calculating rising and setting of the Sun and Moon! "
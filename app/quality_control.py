@@ -1,9 +1,18 @@
 """
 One-time quality control of celestial calculations against AA USNO,
 version 2 and 2.1 of weatherapi.
+
+compare_offline runs without any network access: celestial is
+calculated in-process and USNO data is read from the app/testdata/
+cache, over a process pool, so that large sweeps run in minutes.
 """
 
 import datetime
+import functools
+import re
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import multiprocessing
 from dateutil import parser
 import unittest
 import requests
@@ -19,18 +28,34 @@ from colorama import Fore, Back, Style
 colorama.init()
 
 verbose = True
+datapath = "app/testdata/"
+usno_datafile_pattern = re.compile(r"^usno_(-?[\d.]+)_(-?[\d.]+)_(\d{4}-\d\d-\d\d)\.json$")
+
+
+@functools.lru_cache(maxsize=None)
+def timezone_finder() -> TimezoneFinder:
+    """
+    TimezoneFinder loads its data when created, so only create it once.
+    """
+    return TimezoneFinder()
+
+
+@functools.lru_cache(maxsize=100000)
+def timezone_at(lat, lon) -> str:
+    return timezone_finder().timezone_at(lat=lat, lng=lon)
+
 
 class CelestialQA(unittest.TestCase):
 
-    def fetch_usno(self, coords: tuple, selected_time: datetime, skip_cache = False, body = "sun") -> tuple[float, float, datetime.datetime, datetime.datetime]:
+    def fetch_usno(self, coords: tuple, selected_time: datetime, skip_cache = False, body = "sun", offline = False) -> tuple[float, float, datetime.datetime, datetime.datetime]:
         """
         Fetch data from AA USNO. If we have an offline datafile, return that, if not fetch from API.
+        With offline, return None instead of fetching from the API.
 
         We use an ID to present ourself.
         See https://aa.usno.navy.mil/data/api for docs.
         """
         usno_jsondata = None
-        datapath = "app/testdata/"
         os.makedirs(datapath, exist_ok=True)
         usno_datafile = f"{datapath}usno_{coords[0]}_{coords[1]}_{selected_time.strftime('%Y-%m-%d')}.json"
 
@@ -50,6 +75,8 @@ class CelestialQA(unittest.TestCase):
                 print(Fore.GREEN + "Using cached data for USNO" + Fore.RESET)
             with open (usno_datafile, mode='r', encoding='utf-8') as f:
                 usno_jsondata = json.load(f)
+        elif offline:
+            return None
         else:
             usno_response = requests.get(url, timeout=10)
             usno_jsondata = usno_response.json()
@@ -89,8 +116,27 @@ class CelestialQA(unittest.TestCase):
         if verbose:
             print("fetch_celestial", url)
         response = requests.get(url, timeout=10, headers={'User-Agent': 'larsfp@met.no'})
-        response_json = response.json()
+        return self.parse_celestial_response(response.json(), body)
+
+    def compute_celestial(self, coords: tuple, selected_time: datetime, body = "sun") -> tuple[float, float, datetime.datetime, datetime.datetime]:
+        """
+        Calculate celestial in-process, giving the same result as fetch_celestial
+        against this version of the code. Run from the repository root.
+        """
+        # Imported here, as loading the ephemeris is only needed in this mode
+        from routes.sunrise import solve_days, TIME_FORMAT
+        from core.make_response import make_response
 
+        offset = self.get_coords_offset(coords, selected_time)
+        date = datetime.datetime(selected_time.year, selected_time.month, selected_time.day)
+        rising, setting, noon, moonphase, start, end = solve_days(
+            body.capitalize(), date, 1, coords[0], coords[1], offset)[0]
+        response_json = make_response(setting, rising, noon[0], noon[1],
+                                      start.strftime(TIME_FORMAT), end.strftime(TIME_FORMAT),
+                                      body.capitalize(), coords[0], coords[1], moonphase, offset)
+        return self.parse_celestial_response(response_json, body)
+
+    def parse_celestial_response(self, response_json: dict, body = "sun") -> tuple[float, float, datetime.datetime, datetime.datetime]:
         lat = response_json['geometry']['coordinates'][1]
         lon = response_json['geometry']['coordinates'][0]
 
@@ -314,11 +360,74 @@ class CelestialQA(unittest.TestCase):
 
             time.sleep(delay)
 
+    def compare_offline_point(self, coords: tuple, selected_time: datetime, body = "sun") -> tuple:
+        """
+        Compare celestial calculated in-process with cached USNO data for one point.
+        Returns the rise and set diffs in seconds, None where either has no event,
+        or None if there is no cached USNO data.
+        """
+        usno = self.fetch_usno(coords, selected_time, body=body, offline=True)
+        if usno is None:
+            return None
+        _, _, us_rise, us_set = usno
+        _, _, c_rise, c_set = self.compute_celestial(coords, selected_time, body=body)
+        rise_diff = set_diff = None
+        if c_rise and us_rise:
+            rise_diff = self.calculate_diff(c_rise, us_rise, ignore_date=True)
+        if c_set and us_set:
+            set_diff = self.calculate_diff(c_set, us_set, ignore_date=True)
+        return rise_diff, set_diff
+
+    def cached_usno_points(self) -> list:
+        """
+        Return the (coords, time) of every cached USNO datafile.
+        """
+        points = []
+        for filename in sorted(os.listdir(datapath)) if os.path.isdir(datapath) else []:
+            match = usno_datafile_pattern.match(filename)
+            if match:
+                selected_time = datetime.datetime.strptime(match.group(3) + " 12:00", "%Y-%m-%d %H:%M")
+                points.append(((float(match.group(1)), float(match.group(2))),
+                               selected_time.replace(tzinfo=pytz.UTC)))
+        return points
+
+    def compare_offline(self, points = None, body = "sun", processes = None, chunksize = 20) -> list:
+        """
+        Compare celestial with cached USNO data for many (coords, time) points, by
+        default every cached one, without network access. The points are spread
+        over a pool of processes, each loading the ephemeris once. Points without
+        cached USNO data are skipped. Returns the results of compare_offline_point.
+        """
+        if points is None:
+            points = self.cached_usno_points()
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=processes,
+                                 mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_quiet) as executor:
+            results = list(executor.map(_compare_offline_point, points, repeat(body),
+                                        chunksize=chunksize))
+        seconds = time.perf_counter() - start
+
+        compared = [(point, result) for point, result in zip(points, results) if result is not None]
+        print(f"Compared {len(compared)} of {len(points)} points with cached USNO data in {seconds:.1f} s")
+        for i, event in enumerate(["rise", "set"]):
+            diffs = numpy.array([abs(result[i]) for _, result in compared if result[i] is not None])
+            if len(diffs) == 0:
+                continue
+            print(f"{body}{event}: count {len(diffs)}, mean {numpy.mean(diffs):.0f} s, "
+                  f"standard deviation {numpy.std(diffs):.0f} s, "
+                  f"p95 {numpy.percentile(diffs, 95):.0f} s, max {numpy.max(diffs):.0f} s")
+            worst = sorted(((abs(result[i]), point) for point, result in compared
+                            if result[i] is not None), reverse=True, key=lambda x: x[0])[:5]
+            for diff, (coords, selected_time) in worst:
+                print(f" * {diff:.0f} s at {coords} on {selected_time.strftime('%Y-%m-%d')}")
+        return results
+
     def get_coords_localtime(self, coords: tuple, selected_time_utc: datetime) -> datetime:
         """
         Return local time for a location and UTC timestamp
         """
-        local_timezone = TimezoneFinder().timezone_at(lat=coords[0], lng=coords[1]) # returns 'Europe/Berlin'
+        local_timezone = timezone_at(coords[0], coords[1]) # returns 'Europe/Berlin'
         tz = pytz.timezone(local_timezone)
         #local_time = tz.localize(selected_time_utc)
         local_time = selected_time_utc.astimezone(tz)
@@ -330,7 +439,7 @@ class CelestialQA(unittest.TestCase):
         """
         Return timezone offset for a location. Needs a time as offset will change during the year.
         """
-        local_timezone = TimezoneFinder().timezone_at(lat=coords[0], lng=coords[1]) # returns 'Europe/Berlin'
+        local_timezone = timezone_at(coords[0], coords[1]) # returns 'Europe/Berlin'
         tz = pytz.timezone(local_timezone)
         offset = pytz.timezone(local_timezone).localize(selected_time_utc.replace(tzinfo=None)).strftime('%z')
         if len(offset) > 0:
@@ -341,7 +450,7 @@ class CelestialQA(unittest.TestCase):
         """
         US NO wants 4, 4.5, -7, -7.25. Pytz gives +0400, +0430, -0700, -0715
         """
-        local_timezone = TimezoneFinder().timezone_at(lat=coords[0], lng=coords[1]) # returns 'Europe/Berlin'
+        local_timezone = timezone_at(coords[0], coords[1]) # returns 'Europe/Berlin'
         tz = pytz.timezone(local_timezone)
         offset = pytz.timezone(local_timezone).localize(selected_time_utc.replace(tzinfo=None)).strftime('%z')
         if len(offset) > 0:
@@ -355,7 +464,7 @@ class CelestialQA(unittest.TestCase):
         """
         Return timezone shorthand for a location.
         """
-        local_timezone = TimezoneFinder().timezone_at(lat=coords[0], lng=coords[1]) # returns 'Europe/Berlin'
+        local_timezone = timezone_at(coords[0], coords[1]) # returns 'Europe/Berlin'
         tz = pytz.timezone(local_timezone)
         shorthand = pytz.timezone(local_timezone).localize(selected_time_utc.replace(tzinfo=None)).strftime('%Z')
         return shorthand
@@ -379,6 +488,19 @@ class CelestialQA(unittest.TestCase):
         return datetime.datetime.strptime(date + " " + offset, "%Y-%m-%dT%H:%M %z")
 
 
+def _quiet():
+    global verbose
+    verbose = False
+
+
+def _compare_offline_point(point, body):
+    """
+    Process pool task of compare_offline.
+    """
+    coords, selected_time = point
+    return CelestialQA().compare_offline_point(coords, selected_time, body=body)
+
+
 if __name__ == '__main__':
     pass
     # CelestialQA().generate_random_timestamps(1)
@@ -396,3 +518,6 @@ if __name__ == '__main__':
 
     # Find a random location and random time and compare APIs
     # CelestialQA().compare_random(1)
+
+    # Compare every point with cached USNO data, without network access
+    # CelestialQA().compare_offline()
@@ -1,23 +1,60 @@
+import asyncio
+import os
 import re
 from datetime import datetime, timedelta
 from enum import Enum
-from fastapi import APIRouter, HTTPException, Query, Path
+from fastapi import APIRouter, HTTPException, Query, Path, Body, Header
+from fastapi.responses import Response
 from typing import Optional
-from numpy import where
-from skyfield import api
+from pydantic import BaseModel, Field
+from numpy import flatnonzero, searchsorted, arange
 from skyfield.api import utc
-from skyfield import almanac
+from skyfield.units import Angle
 from http import HTTPStatus
 from core.initialize import init_eph
-from core.make_response import make_response, ResponseModel
+from core.context import (init_context, ATMOSPHERE_REFRAC,
+                          MOON_RADIUS_DEGREES, SUN_HORIZON)
+from core.cache import init_cache
+from core.singleflight import init_single_flight
+from core.pool import init_pool, PoolFull
+from core.chebyshev import init_tables
+from core.solver import find_events, RISING, TRANSIT
+from core.analytic import AnalyticSun
+from core.tiles import init_tiles, EPOCH, RISE, SET, NOON, MIDNIGHT
+from core.lunation import init_lunations, PHASE_NAMES
+from core.metrics import stage
+from core.profiler import init_profiler
+from core.etag import (ENGINE_VERSION, ephemeris_version, make_etag,
+                       if_none_match, cache_headers)
+from core.make_response import (make_response, make_feature_collection,
+                                make_moon_phases, render, ResponseModel,
+                                FeatureCollection, MoonPhasesModel)
 
 EPS = 0.0001
 TIME_FORMAT = "%Y-%m-%dT%H:%M"
-ATMOSPHERE_REFRAC = 0.5666 # Average angle in which atmospheric refraction moves the horizon
-MOON_RADIUS_DEGREES = 0.2667 # Roughly stimated average Moon radius in degrees 
+BATCH_MAX_POINTS = int(os.getenv("CELESTIAL_BATCH_MAX_POINTS", 10000))
+BATCH_CHUNK_POINTS = 500 # Points per worker pool task in batch requests
+CACHE_MAX_AGE = int(os.getenv("CELESTIAL_HTTP_MAX_AGE", 2592000)) # Seconds clients and CDNs may cache results
+# Days around the requested dates that events may be searched for in
+RANGE_MARGIN_DAYS = 2
+# Disc centre altitude at rising and setting, and whether the body
+# counts as up when exactly at it, as in the skyfield almanac functions
+HORIZONS = {"Sun": (SUN_HORIZON, True),
+            "Moon": (-ATMOSPHERE_REFRAC - MOON_RADIUS_DEGREES, False)}
 
 router = APIRouter()
 eph = init_eph()
+context = init_context()
+cache = init_cache()
+single_flight = init_single_flight()
+tables = init_tables()
+profiler = init_profiler()
+analytic_sun = AnalyticSun(context.ts)
+event_tiles = init_tiles()
+lunations = init_lunations()
+etag_version = f"{ENGINE_VERSION}:{ephemeris_version(eph)}"
+if event_tiles.enabled:
+    etag_version += f":{event_tiles.version}"
 
 
 class bodies(str, Enum):
@@ -25,7 +62,21 @@ class bodies(str, Enum):
     sun: str = "sun"
 
 
-@router.get("/events/{body}")
+class precisions(str, Enum):
+    full: str = "full"
+    fast: str = "fast"
+
+
+class BatchPoint(BaseModel):
+    lat: float = Field(gt=-90.0, lt=90.0, description="latitude in degrees.")
+    lon: float = Field(gt=-180.0, lt=180.0, description="longitude in degrees.")
+    date: str = Field(description="date on format YYYY-MM-DD.")
+    offset: str = Field(default="+00:00",
+                        description="Offset from utc time. Has to be on format +/-HH:MM")
+
+
+@router.get("/events/{body}",
+            response_model=ResponseModel | list[ResponseModel])
 async def get_sunrise(
     body: bodies = Path(..., description="Celestial body for which to query for events"),
     date: str = Query(...,
@@ -37,7 +88,16 @@ async def get_sunrise(
                        description="longitude in degrees. Default value set to Greenwich observatory."),
     offset: Optional[str] = Query(default="+00:00",
                                   description="Offset from utc time. Has to be on format +/-HH:MM"),
-                       ) -> ResponseModel:
+    days: int = Query(default=1, ge=1, le=366,
+                      description="Number of consecutive days starting at date to return events for. "
+                                  "A list of daily results is returned if days is larger than 1."),
+    precision: precisions = Query(default=precisions.full,
+                                  description="fast uses a closed-form position of the Sun instead of the "
+                                              "ephemeris, with times within a minute of full. Only for the Sun."),
+    if_none_match_header: Optional[str] = Header(default=None, alias="If-None-Match",
+                                                 description="ETag of a previous response. "
+                                                             "Answered with 304 Not Modified if it still matches."),
+                       ) -> Response:
     """
     Returns moonrise and sunset for a given
     date and position in (lat,lon) with optional height
@@ -46,6 +106,153 @@ async def get_sunrise(
     # Capitalize first letter of moon and sun
     body = body.value.capitalize()
 
+    datetime_date = validate_date_and_offset(date, offset)
+    if precision == precisions.fast and body != "Sun":
+        raise HTTPException(detail="precision=fast is only available for the Sun.",
+                            status_code=HTTPStatus.BAD_REQUEST)
+    if precision == precisions.full:
+        require_ephemeris()
+
+    # Results never change for the same query, engine and ephemeris,
+    # so a client that has the response already is answered right away
+    etag = make_etag(etag_version, body, date, lat, lon, offset, days,
+                     precision.value)
+    headers = cache_headers(etag, CACHE_MAX_AGE)
+    if if_none_match(if_none_match_header, etag):
+        return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+
+    results = None
+    if body == "Sun" and event_tiles.enabled:
+        with stage("tiles", body):
+            results = tile_days(datetime_date, days, lat, lon, offset)
+    if results is None:
+        results = await calculate_cached(body, datetime_date, days,
+                                         lat, lon, offset, precision.value)
+
+    with stage("response", body):
+        responses = []
+        for rising, setting, noon, moonphase, start, end in results:
+            responses.append(make_response(setting, rising, noon[0], noon[1],
+                                           start.strftime(TIME_FORMAT),
+                                           end.strftime(TIME_FORMAT),
+                                           body, lat, lon, moonphase, offset))
+        response = render(responses[0] if days == 1 else responses)
+    response.headers.update(headers)
+    return response
+
+
+@router.post("/events/{body}/batch",
+             response_model=FeatureCollection)
+async def get_sunrise_batch(
+    points: list[BatchPoint] = Body(..., description="Observer locations and dates to calculate events for."),
+    body: bodies = Path(..., description="Celestial body for which to query for events"),
+                       ) -> Response:
+    """
+    Returns rising, setting and meridian crossings of a celestial
+    body for many (lat, lon, date, offset) points in one request,
+    as a GeoJSON FeatureCollection in the same order as the points.
+    """
+    body = body.value.capitalize()
+    require_ephemeris()
+
+    if len(points) > BATCH_MAX_POINTS:
+        raise HTTPException(detail=f"Too many points in batch request. "
+                                   f"At most {BATCH_MAX_POINTS} points are allowed.",
+                            status_code=HTTPStatus.BAD_REQUEST)
+    dates = []
+    for i, point in enumerate(points):
+        try:
+            dates.append(validate_date_and_offset(point.date, point.offset))
+            validate_date_range(dates[-1])
+        except HTTPException as exc:
+            raise HTTPException(detail=f"Point {i}: {exc.detail}",
+                                status_code=exc.status_code)
+
+    # Solve points that share a date together, on a shared time grid.
+    # Large groups are split into chunks that run in parallel in the pool.
+    groups = {}
+    for i, point in enumerate(points):
+        groups.setdefault(point.date, []).append(i)
+    chunks = []
+    for indices in groups.values():
+        chunks += [indices[i:i + BATCH_CHUNK_POINTS]
+                   for i in range(0, len(indices), BATCH_CHUNK_POINTS)]
+
+    features = [None] * len(points)
+    running = asyncio.Semaphore(init_pool().size)
+
+    async def solve_chunk(indices):
+        cache_keys = [cache.key(body, points[i].date, points[i].lat,
+                                points[i].lon, points[i].offset)
+                      for i in indices]
+        results = [cache.get(cache_key) for cache_key in cache_keys]
+        missing = [j for j, result in enumerate(results) if result is None]
+        if missing:
+            async with running:
+                solved = await run_in_pool(
+                    solve_observers, body, dates[indices[0]],
+                    [points[indices[j]].lat for j in missing],
+                    [points[indices[j]].lon for j in missing],
+                    [points[indices[j]].offset for j in missing])
+            for j, result in zip(missing, solved):
+                results[j] = result
+                cache.put(cache_keys[j], result)
+        with stage("response", body):
+            for i, result in zip(indices, results):
+                point = points[i]
+                rising, setting, noon, moonphase, start, end = result
+                features[i] = make_response(setting, rising, noon[0], noon[1],
+                                            start.strftime(TIME_FORMAT),
+                                            end.strftime(TIME_FORMAT),
+                                            body, point.lat, point.lon,
+                                            moonphase, point.offset)
+
+    await asyncio.gather(*[solve_chunk(indices) for indices in chunks])
+    with stage("response", body):
+        return render(make_feature_collection(features))
+
+
+@router.get("/events/moon/phases",
+            response_model=MoonPhasesModel)
+async def get_moon_phases(
+    date: str = Query(...,
+                      description="date on format YYYY-MM-DD.",
+                      ),
+    offset: Optional[str] = Query(default="+00:00",
+                                  description="Offset from utc time. Has to be on format +/-HH:MM"),
+    days: int = Query(default=30, ge=1, le=366,
+                      description="Number of consecutive days starting at date to return the phase for."),
+    if_none_match_header: Optional[str] = Header(default=None, alias="If-None-Match",
+                                                 description="ETag of a previous response. "
+                                                             "Answered with 304 Not Modified if it still matches."),
+                       ) -> Response:
+    """
+    Returns the phase of the Moon at the start of each day, and the
+    new moons, first quarters, full moons and last quarters, for
+    a number of days starting at date in the queried offset.
+    """
+    require_ephemeris()
+    datetime_date = validate_date_and_offset(date, offset)
+    validate_date_range(datetime_date, days)
+    etag = make_etag(etag_version, "phases", date, offset, days)
+    headers = cache_headers(etag, CACHE_MAX_AGE)
+    if if_none_match(if_none_match_header, etag):
+        return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+
+    dates, phases, events, start, end = await run_in_pool(
+        moon_phase_range, datetime_date, days, offset)
+    with stage("response", "Moon"):
+        response = render(make_moon_phases(dates, phases, events,
+                                           start, end, offset))
+    response.headers.update(headers)
+    return response
+
+
+def validate_date_and_offset(date, offset) -> datetime:
+    """
+    Validates the date and offset query parameters
+    and returns the date as a datetime object.
+    """
     # Regex checking YYYY-MM-DD patter
     pattern = re.compile(r"([12]\d{3}-(0[1-9]|1[0-2])-(0[1-9]|[12]\d|3[01]))")
     if not pattern.match(date):
@@ -59,21 +266,64 @@ async def get_sunrise(
                                    "The date parameter has to be on the form +/-HH:MM",
                             status_code=HTTPStatus.BAD_REQUEST)
     try:
-        datetime_date = datetime.strptime(date, "%Y-%m-%d")
+        return datetime.strptime(date, "%Y-%m-%d")
     except ValueError:
         raise HTTPException(detail=f"The day of the requested date {date} is out of range for the requested month.",
                             status_code=HTTPStatus.BAD_REQUEST)
-    ts = api.load.timescale()
 
-    # eph = init_eph()
-    global eph
-    loc = api.wgs84.latlon(lat, lon)
-    # Parse offset string
+
+def require_ephemeris():
+    """
+    Raises a 400 Bad Request in fast only deployments, which have not
+    loaded the ephemeris, see core.initialize.ephemeris_enabled.
+    """
+    if eph is None:
+        raise HTTPException(detail="This server only calculates the Sun with precision=fast.",
+                            status_code=HTTPStatus.BAD_REQUEST)
+
+
+def ephemeris_dates() -> tuple:
+    """
+    Returns the first and last date, as datetime objects, that events
+    can be calculated for with the ephemeris.
+    """
+    first = max(s.spk_segment.start_jd for s in eph.segments) + RANGE_MARGIN_DAYS
+    last = min(s.spk_segment.end_jd for s in eph.segments) - RANGE_MARGIN_DAYS
+    first = context.ts.tt_jd(first).utc_datetime() + timedelta(days=1)
+    last = context.ts.tt_jd(last).utc_datetime() - timedelta(days=1)
+    return (datetime(first.year, first.month, first.day),
+            datetime(last.year, last.month, last.day))
+
+
+def validate_date_range(datetime_date, days=1):
+    """
+    Raises a 400 Bad Request unless all of days consecutive days
+    starting at datetime_date are covered by the ephemeris.
+    """
+    first, last = ephemeris_dates()
+    if datetime_date < first or datetime_date + timedelta(days=days - 1) > last:
+        raise HTTPException(detail=f"The requested dates are outside the range of the ephemeris. "
+                                   f"Dates from {first:%Y-%m-%d} to {last:%Y-%m-%d} are supported.",
+                            status_code=HTTPStatus.BAD_REQUEST)
+
+
+def parse_offset(offset) -> tuple:
+    """
+    Parses a validated +/-HH:MM offset string into hours and minutes.
+    """
     offset_h = int(offset[:3])
     offset_m = int(offset[4:])
     # Make sure minutes is also negative if offset_h is negative
     if offset_h < 0:
         offset_m = -offset_m
+    return (offset_h, offset_m)
+
+
+def solar_offset(lon, offset_h) -> float:
+    """
+    Returns the offset in hours from utc in solar time
+    for a longitude, given the queried offset hours.
+    """
     # Offset in solar time. Not "political" Timezone
     delta_offset = - lon / 15
     # correct for locations on the "wrong" side of the date line
@@ -83,35 +333,176 @@ async def get_sunrise(
     elif lon < -100 and offset_h > 0:
         # e.g. Tonga (-175.2, -21.1, UTC+13)
         delta_offset -= 24
+    return delta_offset
+
+
+async def calculate_cached(body, datetime_date, days, lat, lon,
+                           offset, precision="full") -> list:
+    """
+    Returns the results of calculate_one_day for days consecutive
+    days starting at datetime_date, from the result cache where
+    possible and otherwise calculated in the worker pool and
+    stored in the cache.
+    """
+    # Serve repeated lookups for the same place and day from the cache
+    # before doing any ephemeris work.
+    dates = [(datetime_date + timedelta(days=i)).strftime("%Y-%m-%d")
+             for i in range(days)]
+    cache_keys = [cache.key(body, day, lat, lon, offset, precision)
+                  for day in dates]
+    results = [cache.get(cache_key) for cache_key in cache_keys]
+    if None in results:
+        # Identical queries arriving while this one is calculated wait
+        # for its results, also when the cache is disabled or cold
+        results = await single_flight.run(tuple(cache_keys), body, calculate_and_store,
+                                          cache_keys, body, datetime_date, days,
+                                          lat, lon, offset, precision)
+    return results
+
+
+async def calculate_and_store(cache_keys, body, datetime_date, days, lat, lon,
+                              offset, precision) -> list:
+    """
+    Calculates the results for calculate_cached in the worker pool
+    and stores them in the cache under cache_keys.
+    """
+    results = await run_in_pool(solve_days, body, datetime_date, days,
+                                lat, lon, offset, precision)
+    for cache_key, result in zip(cache_keys, results):
+        cache.put(cache_key, result)
+    return results
+
+
+async def run_in_pool(fn, *args):
+    """
+    Runs a calculation in the worker pool, answering with
+    503 Service Unavailable if the pool queue is full.
+    Slow calculations are profiled if profiling is enabled.
+    The pool is created on first use, so that app/serve.py creates
+    it in each forked worker rather than once before forking.
+    """
+    pool = init_pool()
+    try:
+        if profiler.enabled:
+            return await pool.run(profiler.run, fn, *args)
+        return await pool.run(fn, *args)
+    except PoolFull:
+        raise HTTPException(detail="The server is busy. Please try again later.",
+                            status_code=HTTPStatus.SERVICE_UNAVAILABLE)
+
 
-    rising, setting, noon, moonphase, start, end = await calculate_one_day(
-        datetime_date,
-        ts,
-        eph,
-        loc,
-        offset_h,
-        offset_m,
-        delta_offset,
-        body)
-    return (make_response(setting, rising, noon[0], noon[1],
-                          start.strftime(TIME_FORMAT),
-                          end.strftime(TIME_FORMAT),
-                          body, lat, lon, moonphase, offset))
+def tile_days(datetime_date, days, lat, lon, offset) -> list:
+    """
+    Returns the results of calculate_one_day for the Sun for days
+    consecutive days starting at datetime_date, interpolated from the
+    precomputed tiles of core.tiles, or None if any of the days can
+    not be answered from them.
+    """
+    offset_h, offset_m = parse_offset(offset)
+    delta_offset = solar_offset(lon, offset_h)
+    # Tiles hold the solar day of each point for an offset on its own
+    # side of the date line, one day off from the other side
+    shift = round((delta_offset + lon / 15) / 24)
+    results = []
+    for i in range(days):
+        date = datetime_date + timedelta(days=i)
+        found = event_tiles.lookup(date + timedelta(days=shift), lat, lon)
+        if found is None:
+            return None
+        results.append(tile_events(found, date, offset_h, offset_m,
+                                   delta_offset))
+    return results
+
+
+def tile_events(found, date, offset_h, offset_m, delta_offset) -> tuple:
+    """
+    Builds the result of calculate_one_day for the Sun from the events
+    of a day found in the tiles, the same way daily_events does.
+    """
+    times, angles, visible = found
+    utc_times = [EPOCH + timedelta(minutes=minutes) if minutes is not None
+                 else None for minutes in times]
+    start = datetime(date.year, date.month, date.day, tzinfo=utc) + timedelta(hours=delta_offset)
+    end = start + timedelta(days=1)
+    solarnoon = utc_times[NOON]
+    start = min(start, solarnoon - timedelta(hours=12))
+    end = max(end, solarnoon + timedelta(hours=12))
+    rising, setting = [[local_time_string(utc_times[event], offset_h, offset_m),
+                        angles[event]] for event in (RISE, SET)]
+    noon = ([local_time_string(utc_times[NOON], offset_h, offset_m),
+             angles[NOON], visible[0]],
+            [local_time_string(utc_times[MIDNIGHT], offset_h, offset_m),
+             angles[MIDNIGHT], visible[1]])
+    if utc_times[MIDNIGHT] is None:
+        noon[1][2] = None
+    return (rising, setting, noon, None, start, end)
+
+
+def solve_days(body, datetime_date, days, lat, lon, offset,
+               precision="full") -> list:
+    """
+    Worker pool task calculating days consecutive days starting at
+    datetime_date for one observer. Only takes and returns picklable
+    values, so that it can run in a process pool.
+    """
+    offset_h, offset_m = parse_offset(offset)
+    delta_offset = solar_offset(lon, offset_h)
+    observer = context.observer(lat, lon)
+    if days == 1:
+        return [calculate_one_day(datetime_date, context.ts, eph, observer,
+                                  offset_h, offset_m, delta_offset, body,
+                                  precision)]
+    return calculate_days(datetime_date, days, context.ts, eph, observer,
+                          offset_h, offset_m, delta_offset, body, precision)
+
+
+def solve_observers(body, datetime_date, lats, lons, offsets) -> list:
+    """
+    Worker pool task calculating one date for many observers.
+    Only takes and returns picklable values, so that it can
+    run in a process pool.
+    """
+    return calculate_observers(datetime_date, context.ts, eph,
+                               lats, lons, offsets, body)
 
 
-async def calculate_one_day(date, ts, eph, loc, offset_h,
-                            offset_m, delta_offset, body) -> list:
+def warm_up():
+    """
+    Worker pool task running one calculation of each kind for each
+    body, so that the ephemeris pages, interpolant tables and lazily
+    loaded skyfield data are in place before the first request.
+    """
+    today = datetime.now(utc).replace(hour=0, minute=0, second=0,
+                                      microsecond=0, tzinfo=None)
+    solve_days("Sun", today, 1, 51.477, -0.001, "+00:00", "fast")
+    if eph is None:
+        return
+    for body in ["Sun", "Moon"]:
+        solve_days(body, today, 1, 51.477, -0.001, "+00:00")
+        solve_days(body, today, 2, 51.477, -0.001, "+00:00")
+        solve_observers(body, today, [59.9, -33.9], [10.7, 18.4],
+                        ["+01:00", "+02:00"])
+
+
+def calculate_one_day(date, ts, eph, observer, offset_h,
+                            offset_m, delta_offset, body,
+                            precision="full") -> list:
     """
     Returns moonrise and sunset for a given
     date and position in lat,lon with optional height
 
+    Risings, settings and meridian crossings are found together in one
+    pass of core.solver.find_events, which samples the altitude and
+    hour angle of the body on a single time grid and returns the
+    altitude and azimuth at every event with it.
+
     date: datetime object
         date to calculate for
     ts: skyfield.api ts object
         latitude in degrees.
     eph: skyfield.api ephemeral object
         longitutde in degrees
-    loc: skyfield.api.wgs84.latlon object
+    observer: core.context.Observer object
         (lat,lon) position on Earth
     offset_h: int
         hours of offset from utc
@@ -119,182 +510,239 @@ async def calculate_one_day(date, ts, eph, loc, offset_h,
         minutes of offset from utc
     delta_offset: float
         offset from utc in solar time (lon/15)
+    precision: str
+        "full" to use the ephemeris, or "fast" to use the
+        closed-form position of core.analytic for the Sun
     """
-
-    # Set start and end time for position with UTC offset
-    start = datetime(date.year, date.month, date.day, tzinfo=utc)
-    start = start + timedelta(hours=delta_offset)
-    end = start + timedelta(days=1)
-    
-    f_transit = almanac.meridian_transits(eph, eph[body], loc)
-    if body == "Sun":
-        # Add one minute to account for noon occuring at 12:00
-        _end = end + timedelta(minutes=1)
-
-        # Use specially made function if body == Sun
-        # For taking into account atmospheric refraction and sun diameter
-        f_rising = almanac.sunrise_sunset(eph, loc)
-        noon = await meridian_transit(loc,
-                                      eph,
-                                      ts.utc(start - timedelta(hours=6)), # Catch the solarmidnight that happens before the requested day
-                                      ts.utc(_end - timedelta(hours=6)),
-                                      "Sun", f_rising,
-                                      f_transit)
-
-        # Use solarnoon to set start and end of interval.
-        solarnoon_strptime = noon[0][0]
-        solarnoon_minus_12h = (solarnoon_strptime
-                               - timedelta(hours=12)).replace(tzinfo=utc)
-        solarnoon_plus_12_h = (solarnoon_strptime
-                               + timedelta(hours=12)).replace(tzinfo=utc)
-        start = min(start, solarnoon_minus_12h)
-        end = max(end, solarnoon_plus_12_h)
-        moonphase = None
-    elif body == "Moon":
-        f_rising = almanac.risings_and_settings(
-            eph, eph[body], loc,
-            horizon_degrees=-ATMOSPHERE_REFRAC,
-            radius_degrees=MOON_RADIUS_DEGREES
-        )
-        f_rising.step_days = 0.04
-        # Add one minute to account for noon occuring at 12:00
-        _end = end + timedelta(minutes=1)
-        noon = await meridian_transit(loc, eph, ts.utc(start), ts.utc(_end),
-                                      body,
-                                      f_rising, f_transit)
-        moonphase = almanac.moon_phase(eph, ts.utc(start))
-    else:
-        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST,
-                            detail=f"Unsopported celestial body \"{body}\" entered.")
-
-    # convert noon to string with queried offset.
-    noon[0][0] = ((noon[0][0]
-        + timedelta(hours=offset_h,
-                    minutes=offset_m)).strftime(TIME_FORMAT)
-                        if noon[0][0] is not None else None)
-    noon[1][0] = ((noon[1][0]
-        + timedelta(hours=offset_h,
-                    minutes=offset_m)).strftime(TIME_FORMAT)
-                        if noon[1][0] is not None else None)
-    rising, setting = await set_and_rise(loc, eph, ts.utc(start), ts.utc(end),
-                                         body, offset_h, offset_m, f_rising)
-    return (rising, setting, noon, moonphase, start, end)
+    return calculate_days(date, 1, ts, eph, observer, offset_h,
+                          offset_m, delta_offset, body, precision)[0]
 
 
-async def meridian_transit(loc, eph, start, end, body,
-                           f_rising, f_transit) -> list:
+def calculate_days(date, days, ts, eph, observer, offset_h,
+                         offset_m, delta_offset, body,
+                         precision="full") -> list:
     """
-    Calculates the time at which a body passes a location meridian,
-    at which point it reaches its highest elevation in the sky
+    Returns the results of calculate_one_day for a number of
+    consecutive days starting at date.
 
-    Arguments:
-    ----------
-    loc: skyfield.toposlib.GeographicPosition Object
-        location of observer given lat, lon in wgs84 projection
-        from skyfield api module
+    All events of the whole range are found in a single
+    core.solver.find_events pass, and split into daily windows.
 
-    eph: skyfield.jpllib.SpiceKernel Object
-        loaded ephemeral table from skyfield api module
+    days: int
+        number of days to calculate for
+    See calculate_one_day for the remaining arguments.
+    """
+    first = datetime(date.year, date.month, date.day, tzinfo=utc)
+    starts = [first + timedelta(days=i, hours=delta_offset)
+              for i in range(days)]
+    transit_windows, search_start, search_end = event_windows(body, starts)
+    horizon, inclusive = HORIZONS[body]
+    with stage("events", body):
+        if precision == "fast":
+            events = analytic_sun.find_events([observer.lat], [observer.lon],
+                                              ts.utc(search_start).tt,
+                                              ts.utc(search_end).tt,
+                                              horizon, inclusive)
+        else:
+            events = find_events(eph, ts, body, [observer.lat], [observer.lon],
+                                 ts.utc(search_start).tt, ts.utc(search_end).tt,
+                                 horizon, EPS, inclusive, tables=tables)
+    moonphases = moon_phases(body, ts, eph, starts)
+
+    with stage("select", body):
+        times = ts.tt_jd(events.tt).utc_datetime()
+        index = arange(len(events.tt))
+        results = []
+        for start, transit_window, moonphase in zip(starts, transit_windows,
+                                                    moonphases):
+            rising, setting, noon, start, end = daily_events(
+                body, times, events, index, transit_window, start,
+                offset_h, offset_m)
+            results.append((rising, setting, noon, moonphase, start, end))
+    return results
+
+
+def calculate_observers(date, ts, eph, lats, lons, offsets,
+                             body) -> list:
+    """
+    Returns the result of calculate_one_day for many observers on the
+    same date. All observers are solved together by
+    core.solver.find_events on one shared time grid, and the events are
+    split into the same windows as calculate_one_day uses.
 
-    start: Time::TT object
-        Date argument converted through skyfield api module
+    date: datetime object
+        date to calculate for
+    ts: skyfield.api ts object
+    eph: skyfield.api ephemeral object
+    lats, lons: list of float
+        latitudes and longitudes of the observers in degrees
+    offsets: list of str
+        offsets from utc on the form +/-HH:MM, one per observer
+    body: str
+        Name of celestial object
+    """
+    day = datetime(date.year, date.month, date.day, tzinfo=utc)
+    offsets = [parse_offset(offset) for offset in offsets]
+    starts = [day + timedelta(hours=solar_offset(lon, offset_h))
+              for lon, (offset_h, _) in zip(lons, offsets)]
+    transit_windows, search_start, search_end = event_windows(body, starts)
+    horizon, inclusive = HORIZONS[body]
+    with stage("events", body):
+        events = find_events(eph, ts, body, lats, lons,
+                             ts.utc(search_start).tt, ts.utc(search_end).tt,
+                             horizon, EPS, inclusive, tables=tables)
+    moonphases = moon_phases(body, ts, eph, starts)
+
+    with stage("select", body):
+        times = ts.tt_jd(events.tt).utc_datetime()
+        bounds = searchsorted(events.observer, arange(len(starts) + 1))
+        results = []
+        for i, (offset_h, offset_m) in enumerate(offsets):
+            rising, setting, noon, start, end = daily_events(
+                body, times, events, arange(bounds[i], bounds[i + 1]),
+                transit_windows[i], starts[i], offset_h, offset_m)
+            results.append((rising, setting, noon, moonphases[i], start, end))
+    return results
+
+
+def event_windows(body, starts) -> tuple:
+    """
+    Returns the windows to search for meridian crossings in for days
+    starting at starts, as a list of (start, end) datetimes, and the
+    start and end of a search covering every event of all the days.
+    """
+    if body == "Sun":
+        # Catch the solarmidnight that happens before the requested day,
+        # and add one minute to account for noon occuring at 12:00
+        transit_windows = [(start - timedelta(hours=6),
+                            start + timedelta(hours=18, minutes=1))
+                           for start in starts]
+        # Risings and settings are searched for within 12 hours of solarnoon
+        return (transit_windows, min(starts) - timedelta(hours=18),
+                max(starts) + timedelta(hours=30, minutes=1))
+    elif body == "Moon":
+        # Add one minute to account for noon occuring at 12:00
+        transit_windows = [(start, start + timedelta(days=1, minutes=1))
+                           for start in starts]
+        return (transit_windows, min(starts),
+                max(starts) + timedelta(days=1, minutes=1))
+    raise HTTPException(status_code=HTTPStatus.BAD_REQUEST,
+                        detail=f"Unsopported celestial body \"{body}\" entered.")
 
-    start: Time::TT object
-        The day after date argument converted through skyfield api module
 
-    body: str
-        Name of celestial object in which
-        to calculate rising and setting times
+def daily_events(body, times, events, index, transit_window, start,
+                 offset_h, offset_m) -> tuple:
+    """
+    Picks the events of one day from the output of find_events.
+
+    Returns the rising and setting as [time string, azimuth], the
+    meridian and antimeridian crossings as [time string, altitude,
+    visible], and the start and end of the window that risings and
+    settings were picked from, which for the Sun is widened to
+    12 hours either side of solar noon.
+
+    times: array of datetime objects
+        utc times of all events
+    events: core.solver.Events object
+    index: array of int
+        indices of the events of the observer in question
+    transit_window: tuple of datetime objects
+        window to pick meridian crossings from, see event_windows
+    start: datetime object
+        start of the day in utc
+    """
+    end = start + timedelta(days=1)
+    window_start, window_end = transit_window
+    transits = index[(events.kind[index] == TRANSIT)
+                     & (times[index] >= window_start)
+                     & (times[index] <= window_end)]
+    noon = first_transits(times[transits], events.value[transits],
+                          events.alt[transits], events.up[transits])
+    if body == "Sun":
+        # Use solarnoon to set start and end of interval.
+        solarnoon = noon[0][0].replace(tzinfo=utc)
+        start = min(start, solarnoon - timedelta(hours=12))
+        end = max(end, solarnoon + timedelta(hours=12))
+    risings = index[(events.kind[index] == RISING)
+                    & (times[index] >= start)
+                    & (times[index] <= end)]
+    rising, setting = last_rise_set(times[risings], events.value[risings],
+                                    events.az[risings], offset_h, offset_m)
+    # convert noon to string with queried offset.
+    noon[0][0] = local_time_string(noon[0][0], offset_h, offset_m)
+    noon[1][0] = local_time_string(noon[1][0], offset_h, offset_m)
+    return (rising, setting, noon, start, end)
 
-    f_rising: skyfield almanac.rising_and_settings object
-        Initialized object for finding rising and setting times.
-        Used in this function for checking visibility of an object
 
-    f_transit: skyfield almanac.meridian_transits object
-        Initialized object for finding meridian transit times.
+def moon_phases(body, ts, eph, starts) -> list:
     """
+    Returns the phase of the Moon at each of starts,
+    or None for each of them for other bodies.
+    """
+    if body != "Moon":
+        return [None] * len(starts)
+    with stage("moon_phase", body):
+        moonphase = lunations.phase(ts.utc(starts).tt)
+        return [Angle(degrees=degrees) for degrees in moonphase]
 
-    times, events = almanac.find_discrete(start, end, f_transit, epsilon=EPS)
-    astro = (eph["earth"] + loc).at(times).observe(eph[body])
-    app = astro.apparent()
-    alt = app.altaz()[0]
-    alt = alt.degrees
 
-    try:
-        antimeridian = times[events == 0][0]
-    except IndexError:
-        # Special case where no antimeridian crossing events are found 
+def moon_phase_range(date, days, offset) -> tuple:
+    """
+    Returns the dates of days consecutive days from date, the phase of
+    the Moon in degrees at the start of each of them, the principal
+    phases during them as (time string, name), and the start and end
+    of the days in UTC as time strings.
+    """
+    offset_h, offset_m = parse_offset(offset)
+    first = (datetime(date.year, date.month, date.day, tzinfo=utc)
+             - timedelta(hours=offset_h, minutes=offset_m))
+    starts = [first + timedelta(days=i) for i in range(days + 1)]
+    with stage("moon_phase", "Moon"):
+        tt = context.ts.utc(starts).tt
+        phases = lunations.phase(tt[:-1])
+        times, indices = lunations.events(tt[0], tt[-1])
+        events = []
+        if len(times):
+            events = [(local_time_string(time, offset_h, offset_m), PHASE_NAMES[index])
+                      for time, index in zip(context.ts.tt_jd(times).utc_datetime(), indices)]
+    dates = [(date + timedelta(days=i)).strftime("%Y-%m-%d") for i in range(days)]
+    return (dates, phases, events,
+            starts[0].strftime(TIME_FORMAT), starts[-1].strftime(TIME_FORMAT))
+
+
+def first_transits(times, events, alt, visible) -> tuple:
+    """
+    Picks the first meridian and antimeridian crossing from the output
+    of a meridian transit search, as [time, altitude, visible] lists.
+    """
+    antimeridian_index = flatnonzero(events == 0)
+    if len(antimeridian_index) == 0:
+        # Special case where no antimeridian crossing events are found
         antimeridian_list = [None, None, None]
     else:
-        antimeridian_index = where(events == 0)[0][0]
-        # Check if body is visible to inform about polar day and night
-        antimeridian_visible = f_rising(antimeridian)
-        antimeridian_list = [antimeridian.utc_datetime(),
-                            alt[antimeridian_index],
-                            antimeridian_visible]
-    try:
-        meridian = times[events == 1][0]
-    except IndexError:
+        i = antimeridian_index[0]
+        antimeridian_list = [times[i], alt[i], visible[i]]
+    meridian_index = flatnonzero(events == 1)
+    if len(meridian_index) == 0:
         # Special case where no meridian crossing events are found
         meridian_list = [None, None, None]
     else:
-        meridian_index = where(events == 1)[0][0]
-        meridian_visible = f_rising(meridian)
-        meridian_list = [meridian.utc_datetime(),
-                        alt[meridian_index],
-                        meridian_visible]
+        i = meridian_index[0]
+        meridian_list = [times[i], alt[i], visible[i]]
 
     return (meridian_list, antimeridian_list)
 
 
-async def set_and_rise(loc, eph, start, end,
-                       body, offset_h, offset_m, f) -> list:
+def last_rise_set(times, events, az, offset_h, offset_m) -> tuple:
     """
-    Calculates rising and setting times for a given
-    celestial body as viewed from a location on Earth.
-
-    Arguments:
-    ----------
-    loc: skyfield.toposlib.GeographicPosition Object
-        location of observer given lat, lon in wgs84 projection
-        from skyfield api module
-
-    eph: skyfield.jpllib.SpiceKernel Object
-        loaded ephemeral table from skyfield api module
-
-    start: Time::TT object
-        Date argument converted through skyfield api module
-
-    start: Time::TT object
-        The day after date argument converted through skyfield api module
-
-    body: str
-        Name of celestial object in which
-        to calculate rising and setting times
-    offset_h: int
-        hours of offset from utc
-    offset_m: int
-        minutes of offset from utc
-
-    f: skyfield almanac.rising_and_settings object
-        Initialized object for finding rising and setting times.
-        Used in this function for checking visibility of an object
+    Picks the last rising and setting from the output of a rising and
+    setting search, as [time string with queried offset, azimuth] lists.
     """
-    # Find set and rise for a celestial body
-    t, y = almanac.find_discrete(start, end, f, epsilon=EPS)
-
-    if len(y) > 0:
-        astro = (eph["earth"] + loc).at(t).observe(eph[body])
-        app = astro.apparent()
-        az = app.altaz()[1]
-        az = az.degrees
-    else:
-        az = [None, None]
-    t = t.utc_datetime() + timedelta(hours=offset_h, minutes=offset_m)
+    t = [ti + timedelta(hours=offset_h, minutes=offset_m) for ti in times]
 
     set = [None, None]
     rise = [None, None]
-    zip_list = list(zip(t, y, az))
+    zip_list = list(zip(t, events, az))
     for ti, yi, az in zip_list:
         if yi:
             rise = ti.strftime(TIME_FORMAT)
@@ -303,3 +751,13 @@ async def set_and_rise(loc, eph, start, end,
             set = ti.strftime(TIME_FORMAT)
             set = [set, az]
     return (rise, set)
+
+
+def local_time_string(time, offset_h, offset_m):
+    """
+    Formats a utc datetime with the queried offset, keeping None as None.
+    """
+    if time is None:
+        return None
+    return (time + timedelta(hours=offset_h,
+                             minutes=offset_m)).strftime(TIME_FORMAT)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Run the application in several uvicorn worker processes.
+
+uvicorn --workers starts each worker as a fresh interpreter, so every
+worker loads the ephemeris and the application on its own. With
+CELESTIAL_PRELOAD=1 (the default) this script instead imports the
+application once, with the ephemeris memory-mapped and read into the
+page cache, and then forks the workers. The workers inherit the loaded
+application and share the mapped ephemeris pages with the parent.
+
+The worker pool is not created by the import. Every worker creates its
+own pool after the fork, lazily in the lifespan or on first use, so
+that forked workers never share the executor of a process pool
+(CELESTIAL_POOL=process), its queues or its management thread.
+serve_preloaded checks that the import left the pool uncreated.
+
+Configured through the environment variables
+    PORT                 port to listen on, default 8080
+    HOST                 address to listen on, default 0.0.0.0
+    CELESTIAL_WORKERS    number of worker processes, default 4
+    CELESTIAL_PRELOAD    1 to preload before forking, 0 to let
+                         uvicorn spawn workers that load on their own
+"""
+import os
+import signal
+import socket
+import uvicorn
+
+
+def serve_preloaded(host, port, workers):
+    """
+    Import the application, bind the socket and fork `workers`
+    processes serving on it. Returns when all workers have exited.
+    """
+    os.environ.setdefault("CELESTIAL_EPH_TOUCH", "1")
+    from main import app, logger
+    from core.initialize import log_memory_usage
+    import core.pool
+    if core.pool.pool is not None:
+        raise RuntimeError("The worker pool must be created after forking the workers.")
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.set_inheritable(True)
+
+    children = []
+    for worker in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            log_memory_usage(logger, worker)
+            config = uvicorn.Config(app, access_log=False)
+            uvicorn.Server(config).run(sockets=[sock])
+            os._exit(0)
+        children.append(pid)
+    logger.info(f"Serving on {host}:{port} with {workers} preloaded workers")
+
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for pid in children:
+        os.waitpid(pid, 0)
+    sock.close()
+
+
+def main():
+    host = os.getenv("HOST", "0.0.0.0")
+    port = int(os.getenv("PORT", 8080))
+    workers = int(os.getenv("CELESTIAL_WORKERS", 4))
+    if os.getenv("CELESTIAL_PRELOAD", "1") == "1":
+        serve_preloaded(host, port, workers)
+    else:
+        uvicorn.run("main:app", host=host, port=port, workers=workers,
+                    access_log=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,77 @@
 import datetime
 from fastapi.testclient import TestClient
 from main import app
+from core.cache import ResultCache, init_cache
+from core.singleflight import SingleFlight
+from core import initialize
+from core.initialize import (init_eph, map_ephemeris, memory_usage,
+                             configure_logging, AccessSampler)
+from core.solver import find_events, RISING, TRANSIT
+from core.pool import WorkerPool, PoolFull
+from core.chebyshev import ChebyshevTables
+from core.lunation import LunationTable, PHASE_NAMES
+from core.context import AstroContext
+from core.profiler import SlowTaskProfiler
+from core.analytic import AnalyticSun
+from core.tiles import EventTiles, estimate_error, MISSING, RISE, UNKNOWN_ERROR
+from core.solver import geocentric
+from core.make_response import (make_response, make_feature_collection, MoonPhasesModel,
+                                render, ResponseModel, FeatureCollection)
+from fastapi.responses import JSONResponse
+from pydantic import TypeAdapter
+from skyfield.units import Angle
+from routes.sunrise import EPS, SUN_HORIZON, ATMOSPHERE_REFRAC, MOON_RADIUS_DEGREES
+from routes import sunrise
+from build_tiles import build
+from skyfield import api, almanac
+import numpy
 from http import HTTPStatus
 from dateutil import parser
 import unittest
+import asyncio
+import contextlib
+import httpx
+import io
+import json
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+import unittest.mock
+import prometheus_client
 
 
 client = TestClient(app)
 
 class TestStringMethods(unittest.TestCase):
 
+    def assertSameEvents(self, first, second, exact_when=True, angle_delta=0.05):
+        """
+        Assert that two responses describe the same events, with times
+        within a minute and angles within angle_delta degrees.
+        Unless exact_when is set, the intervals may also differ by a minute.
+        """
+        self.assertEqual(first["geometry"], second["geometry"])
+        if exact_when:
+            self.assertEqual(first["when"], second["when"])
+        else:
+            for value, other in zip(first["when"]["interval"], second["when"]["interval"]):
+                delta = parser.parse(value) - parser.parse(other)
+                self.assertLessEqual(abs(delta.total_seconds()), 60)
+        for event, properties in first["properties"].items():
+            other = second["properties"][event]
+            if not isinstance(properties, dict):
+                self.assertAlmostEqual(properties, other, delta=angle_delta)
+                continue
+            for key, value in properties.items():
+                if value is None or other[key] is None or isinstance(value, bool):
+                    self.assertEqual(value, other[key])
+                elif key == "time":
+                    delta = parser.parse(value) - parser.parse(other[key])
+                    self.assertLessEqual(abs(delta.total_seconds()), 60)
+                else:
+                    self.assertAlmostEqual(value, other[key], delta=angle_delta)
+
     def test_known_date(self):
         """
         Sunrise in Oslo 2010-12-24 occured on 09:19 local time
@@ -63,6 +125,742 @@ class TestStringMethods(unittest.TestCase):
         self.assertEqual(n_sunrise, 1)
         self.assertEqual(n_sunset, 1)
 
+    def test_north_pole_range(self):
+        """
+        Only one sunset and sunrise per year on the north pole,
+        also when the whole year is requested at once.
+        """
+        response = client.get("/events/sun?date=2022-01-02&days=365&lat=89.99&lon=20")
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        days = response.json()
+        self.assertEqual(len(days), 365)
+        n_sunrise = sum(day["properties"]["sunrise"]["time"] is not None for day in days)
+        n_sunset = sum(day["properties"]["sunset"]["time"] is not None for day in days)
+        self.assertEqual(n_sunrise, 1)
+        self.assertEqual(n_sunset, 1)
+
+    def test_range_matches_single_days(self):
+        """
+        Each day of a date range is the same as requesting that day
+        on its own, within a minute.
+        """
+        for body in ["sun", "moon"]:
+            query = f"/events/{body}?lat=-33.87&lon=151.21&offset=%2B11:00"
+            days = client.get(f"{query}&date=2021-12-30&days=4").json()
+            # Make sure the single days are calculated, not read from the cache
+            init_cache().clear()
+            for i, day in enumerate(days):
+                date = datetime.date(2021, 12, 30) + datetime.timedelta(days=i)
+                single = client.get(f"{query}&date={date}").json()
+                self.assertSameEvents(day, single)
+
+    def test_batch(self):
+        """
+        A batch request gives the same features as querying
+        each point on its own, in the order of the points.
+        """
+        points = [{"lat": 59.91, "lon": 10.75, "date": "2010-12-24", "offset": "+01:00"},
+                  {"lat": -36.85, "lon": 174.76, "date": "2023-06-21", "offset": "+12:00"},
+                  {"lat": 40.69, "lon": -74.04, "date": "2010-12-24", "offset": "-05:00"},
+                  {"lat": 69.65, "lon": 18.96, "date": "2010-12-24", "offset": "+01:00"},
+                  {"lat": -21.1, "lon": -175.2, "date": "2023-06-21", "offset": "+13:00"}]
+        init_cache().clear()
+        for body in ["sun", "moon"]:
+            response = client.post(f"/events/{body}/batch", json=points)
+            # Make sure the single points are calculated, not read from the cache
+            init_cache().clear()
+            self.assertEqual(response.status_code, HTTPStatus.OK)
+            collection = response.json()
+            self.assertEqual(collection["type"], "FeatureCollection")
+            self.assertEqual(len(collection["features"]), len(points))
+            for point, feature in zip(points, collection["features"]):
+                offset = point["offset"].replace("+", "%2B")
+                single = client.get(f"/events/{body}?date={point['date']}&lat={point['lat']}"
+                                    f"&lon={point['lon']}&offset={offset}")
+                self.assertSameEvents(feature, single.json())
+
+    def test_batch_invalid_point(self):
+        points = [{"lat": 59.91, "lon": 10.75, "date": "2010-12-24"},
+                  {"lat": 59.91, "lon": 10.75, "date": "2010-02-30"}]
+        response = client.post("/events/sun/batch", json=points)
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+        self.assertIn("Point 1", response.json())
+
+    def test_batch_point_outside_ephemeris(self):
+        points = [{"lat": 59.91, "lon": 10.75, "date": "2010-12-24"},
+                  {"lat": 60, "lon": 10, "date": "2010-12-25"},
+                  {"lat": 60, "lon": 10, "date": "1849-12-31"}]
+        for body in ["sun", "moon"]:
+            response = client.post(f"/events/{body}/batch", json=points)
+            self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+            self.assertIn("Point 2", response.json())
+            self.assertIn("outside the range of the ephemeris", response.json())
+
+    def test_fast_precision(self):
+        """
+        precision=fast gives the same events as the ephemeris within
+        a minute, on dates across 1900-2100 covered by the ephemeris.
+        """
+        eph = init_eph()
+        first = max(s.spk_segment.start_jd for s in eph.segments)
+        last = min(s.spk_segment.end_jd for s in eph.segments)
+        rng = numpy.random.default_rng(1)
+        init_cache().clear()
+        for year in range(1900, 2101, 20):
+            date = datetime.date(year, 1, 1) + datetime.timedelta(days=int(rng.integers(0, 355)))
+            jd = date.toordinal() + 1721424.5
+            if not first + 2 < jd < last - 12:
+                continue
+            lat, lon = rng.uniform(-60, 60), rng.uniform(-179, 179)
+            query = f"/events/sun?date={date}&days=10&lat={lat:.4f}&lon={lon:.4f}"
+            full = client.get(query).json()
+            fast = client.get(f"{query}&precision=fast").json()
+            for full_day, fast_day in zip(full, fast):
+                self.assertSameEvents(full_day, fast_day, exact_when=False)
+        response = client.get("/events/moon?date=2020-01-01&precision=fast")
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+    def test_tiles(self):
+        """
+        Responses served from tiles agree with the calculation within a
+        minute and 0.1 degrees, on and between grid points and across
+        the date line.
+        """
+        for lats, lons, places in [
+                ([59, 60, 61], [9, 10, 11], [(60, 10, "+02:00"), (59.91, 10.75, "+02:00"),
+                                            (60.5, 9.2, "-03:00")]),
+                ([51, 52, 53], [171, 172, 173], [(52, 172, "+12:00"), (52.9, 172.9, "-10:00")])]:
+            with tempfile.TemporaryDirectory() as directory:
+                build(directory, lats, lons, 1.0, datetime.datetime(2022, 6, 19), 5, processes=1)
+                tiles = EventTiles(directory)
+                for lat, lon, offset in places:
+                    query = (f"/events/sun?date=2022-06-20&days=3&lat={lat}&lon={lon}"
+                             f"&offset={offset.replace('+', '%2B')}")
+                    init_cache().clear()
+                    calculated = client.get(query).json()
+                    with unittest.mock.patch.object(sunrise, "event_tiles", tiles):
+                        served = client.get(query).json()
+                    for calculated_day, served_day in zip(calculated, served):
+                        self.assertSameEvents(calculated_day, served_day,
+                                              exact_when=False, angle_delta=0.1)
+                self.assertEqual(tiles.stats()["misses"], 0)
+                self.assertIsNone(tiles.lookup(datetime.datetime(2022, 6, 20), lats[0] - 1, lons[0]))
+                self.assertIsNone(tiles.lookup(datetime.datetime(2022, 6, 25), lats[0], lons[0]))
+
+    def test_etag(self):
+        """
+        Responses carry a strong ETag and long-lived Cache-Control, and
+        a matching If-None-Match is answered with 304 before calculating.
+        """
+        url = "/events/sun?date=2019-03-14&lat=59.91&lon=10.75&offset=%2B01:00"
+        response = client.get(url)
+        etag = response.headers["ETag"]
+        self.assertTrue(etag.startswith('"'))
+        self.assertIn("max-age=", response.headers["Cache-Control"])
+        lookups = init_cache().hits + init_cache().misses
+        for header in [etag, f'"other", W/{etag}', "*"]:
+            not_modified = client.get(url, headers={"If-None-Match": header})
+            self.assertEqual(not_modified.status_code, HTTPStatus.NOT_MODIFIED)
+            self.assertEqual(not_modified.headers["ETag"], etag)
+            self.assertEqual(not_modified.content, b"")
+        self.assertEqual(init_cache().hits + init_cache().misses, lookups)
+        modified = client.get(url, headers={"If-None-Match": '"other"'})
+        self.assertEqual(modified.status_code, HTTPStatus.OK)
+        self.assertNotEqual(client.get(url + "&days=2").headers["ETag"], etag)
+        self.assertNotEqual(client.get(url.replace("sun", "moon")).headers["ETag"], etag)
+
+    def test_metrics(self):
+        init_cache().clear()
+        client.get("/events/moon?date=2018-11-02&lat=69.65&lon=18.96")
+        client.get("/events/moon?date=2018-11-02&lat=69.65&lon=18.96&offset=bad")
+        metrics = client.get("/metrics")
+        self.assertEqual(metrics.status_code, HTTPStatus.OK)
+        text = metrics.text
+        self.assertIn('celestial_request_duration_seconds_count{body="moon",'
+                      'endpoint="/events/{body}",status="200"}', text)
+        self.assertIn('status="400"', text)
+        for stage in ["events", "select", "moon_phase", "response"]:
+            self.assertIn(f'celestial_stage_duration_seconds_count{{body="Moon",stage="{stage}"}}', text)
+        for gauge in ["cache_entries", "cache_bytes", "tables", "pool_queued",
+                      "ephemeris_load_seconds"]:
+            self.assertIn(f"celestial_{gauge} ", text)
+
+    def test_metrics_unknown_body(self):
+        client.get("/events/xyz?date=2018-11-02&lat=69.65&lon=18.96")
+        text = client.get("/metrics").text
+        self.assertNotIn('body="xyz"', text)
+        self.assertIn('body="other"', text)
+
+    def test_readyz(self):
+        with TestClient(app) as ready_client:
+            response = ready_client.get("/readyz")
+            self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(client.get("/readyz").status_code,
+                         HTTPStatus.SERVICE_UNAVAILABLE)
+
+    def test_cached_response(self):
+        """
+        A repeated query is served from the result cache
+        and gives the same response as the first one.
+        """
+        url = "/events/moon?date=2021-03-14&lat=-33.87&lon=151.21&offset=%2B11:00"
+        first = client.get(url)
+        hits = init_cache().hits
+        second = client.get(url)
+
+        self.assertEqual(second.status_code, HTTPStatus.OK)
+        self.assertEqual(init_cache().hits, hits + 1)
+        self.assertEqual(first.json(), second.json())
+
+
+class TestRender(unittest.TestCase):
+
+    def assertSameBytes(self, content, response_model):
+        """
+        Assert that render gives the same bytes as validating and
+        serializing content against response_model, as FastAPI does.
+        """
+        adapter = TypeAdapter(response_model)
+        validated = adapter.validate_python(content)
+        expected = JSONResponse(adapter.dump_python(validated, mode="json"))
+        self.assertEqual(render(content).body, expected.body)
+
+    def test_same_bytes_as_response_models(self):
+        moonphase = Angle(degrees=numpy.float64(123.4567))
+        for body in ["Sun", "Moon"]:
+            response = make_response(["2021-06-21T22:10", numpy.float64(311.23456)],
+                                     ["2021-06-21T03:52", numpy.float64(48.5)],
+                                     ["2021-06-21T13:12", numpy.float64(53.45678), numpy.True_],
+                                     [None, None, None],
+                                     "2021-06-21T00:00", "2021-06-22T00:00",
+                                     body, 60.0, 10, moonphase, "+02:00")
+            self.assertSameBytes(response, ResponseModel)
+            self.assertSameBytes([response, response], list[ResponseModel])
+            self.assertSameBytes(make_feature_collection([response]),
+                                 FeatureCollection)
+        init_cache().clear()
+        for body in ["sun", "moon"]:
+            for lat in [59.91, 89.99, -33.87]:
+                response = client.get(f"/events/{body}?date=2021-06-21&lat={lat}&lon=10.75&days=2")
+                self.assertSameBytes(response.json(), list[ResponseModel])
+                self.assertEqual(response.content, render(response.json()).body)
+        response = client.get("/events/moon/phases?date=2021-06-21&days=40&offset=-03:00")
+        self.assertSameBytes(response.json(), MoonPhasesModel)
+        self.assertEqual(response.content, render(response.json()).body)
+
+
+class TestSolver(unittest.TestCase):
+
+    def test_matches_skyfield(self):
+        """
+        The vectorized solver finds the same risings, settings and
+        meridian transits as almanac.find_discrete, to within EPS.
+        """
+        eph = init_eph()
+        ts = api.load.timescale()
+        lats = [59.91, -33.87, 0.1, 69.65, -62.0]
+        lons = [10.75, 151.21, -170.0, 18.96, -58.9]
+        t0 = ts.utc(2022, 3, 10)
+        t1 = ts.utc(2022, 3, 11, 12)
+        tables = ChebyshevTables(eph, ts)
+        for body, horizon, inclusive, tables in [
+                ("Sun", SUN_HORIZON, True, None),
+                ("Moon", -ATMOSPHERE_REFRAC - MOON_RADIUS_DEGREES, False, None),
+                ("Sun", SUN_HORIZON, True, tables),
+                ("Moon", -ATMOSPHERE_REFRAC - MOON_RADIUS_DEGREES, False, tables)]:
+            events = find_events(eph, ts, body, lats, lons, t0.tt, t1.tt,
+                                 horizon, EPS, inclusive, tables=tables)
+            for i, (lat, lon) in enumerate(zip(lats, lons)):
+                loc = api.wgs84.latlon(lat, lon)
+                f_rising = almanac.risings_and_settings(eph, eph[body], loc,
+                                                        horizon_degrees=horizon)
+                if inclusive:
+                    f_rising = almanac.sunrise_sunset(eph, loc)
+                f_rising.step_days = 0.04
+                f_transit = almanac.meridian_transits(eph, eph[body], loc)
+                for kind, f in [(RISING, f_rising), (TRANSIT, f_transit)]:
+                    t, y = almanac.find_discrete(t0, t1, f, epsilon=EPS)
+                    mask = (events.observer == i) & (events.kind == kind)
+                    self.assertEqual(list(y), list(events.value[mask]))
+                    self.assertLessEqual(numpy.abs(t.tt - events.tt[mask]).max(initial=0), EPS)
+
+
+    def test_polar_transits(self):
+        """
+        In polar day and night the meridian transits are interpolated
+        from the hour angle without bisecting, and are still reported
+        within EPS after almanac.find_discrete finds them.
+        """
+        eph = init_eph()
+        ts = api.load.timescale()
+        tables = ChebyshevTables(eph, ts)
+        loc = api.wgs84.latlon(78.22, 15.65)
+        for t0 in [ts.utc(2022, 6, 21), ts.utc(2022, 12, 21)]:
+            t1 = ts.tt_jd(t0.tt + 1)
+            with unittest.mock.patch.object(tables, "geocentric", wraps=tables.geocentric) as positions:
+                events = find_events(eph, ts, "Sun", [78.22], [15.65], t0.tt, t1.tt,
+                                     SUN_HORIZON, EPS, True, tables=tables)
+            # The grid, the interpolated transits and the events found
+            self.assertEqual(positions.call_count, 3)
+            self.assertFalse((events.kind == RISING).any())
+            t, y = almanac.find_discrete(t0, t1, almanac.meridian_transits(eph, eph["Sun"], loc),
+                                         epsilon=EPS)
+            self.assertEqual(list(y), list(events.value))
+            self.assertTrue((events.tt > t.tt - EPS).all() and (events.tt < t.tt + EPS).all())
+
+class TestChebyshevTables(unittest.TestCase):
+
+    def test_accuracy(self):
+        """
+        Positions from the tables agree with evaluating the ephemeris
+        directly to better than 1e-4 arcseconds, and sidereal time to
+        better than 1e-2 arcseconds, across several days.
+        """
+        eph = init_eph()
+        ts = api.load.timescale()
+        tables = ChebyshevTables(eph, ts)
+        tt = ts.utc(1995, 7, 30).tt + numpy.random.default_rng(0).uniform(0, 3, 500)
+        arcseconds = 180 / numpy.pi * 3600
+        for body in ["Sun", "Moon"]:
+            xyz, gast = geocentric(eph, ts, body, tt)
+            xyz_table, gast_table = tables.geocentric(body, tt)
+            position_error = (numpy.linalg.norm(xyz_table - xyz, axis=0)
+                              / numpy.linalg.norm(xyz, axis=0))
+            gast_error = (gast_table - gast + numpy.pi) % (2 * numpy.pi) - numpy.pi
+            self.assertLess(position_error.max() * arcseconds, 1e-4)
+            self.assertLess(numpy.abs(gast_error).max() * arcseconds, 1e-2)
+        self.assertEqual(tables.stats()["tables"], 6)
+
+    def test_eviction(self):
+        registry = prometheus_client.CollectorRegistry()
+        gauge = prometheus_client.Gauge("tables", "Tables", registry=registry)
+        tables = ChebyshevTables(init_eph(), api.load.timescale(), max_tables=3,
+                                 gauge=gauge)
+        tables.build("Sun", range(2460000, 2460005))
+        self.assertEqual(tables.stats()["tables"], 3)
+        self.assertEqual(tables.stats()["evictions"], 2)
+        self.assertEqual(registry.get_sample_value("tables"), 3)
+
+        tables.max_age = 0
+        time.sleep(0.01)
+        tables.build("Moon", [2460000])
+        self.assertEqual(tables.stats()["tables"], 1)
+        self.assertEqual(registry.get_sample_value("tables"), 1)
+
+
+class TestLunationTable(unittest.TestCase):
+
+    def test_accuracy(self):
+        """
+        Phases agree with almanac.moon_phase and the principal phases
+        with almanac.moon_phases, also at the ends of the ephemeris.
+        """
+        eph = init_eph()
+        ts = api.load.timescale()
+        lunations = LunationTable(eph, ts)
+        first = max(s.spk_segment.start_jd for s in eph.segments)
+        last = min(s.spk_segment.end_jd for s in eph.segments)
+        tt = numpy.concatenate([numpy.linspace(2459580.5, 2459945.5, 500),
+                                [first + 0.5, last - 0.5]])
+        difference = lunations.phase(tt) - almanac.moon_phase(eph, ts.tt_jd(tt)).degrees
+        self.assertLess(numpy.abs((difference + 180) % 360 - 180).max(), 1e-4)
+        self.assertGreater(lunations.stats()["direct"], 0)
+
+        times, phases = lunations.events(2459580.5, 2459945.5)
+        expected, expected_phases = almanac.find_discrete(ts.tt_jd(2459580.5), ts.tt_jd(2459945.5),
+                                                          almanac.moon_phases(eph))
+        numpy.testing.assert_allclose(times, expected.tt, atol=EPS)
+        self.assertEqual(list(phases), list(expected_phases))
+        self.assertEqual(PHASE_NAMES[phases[0]], "New Moon")
+
+    def test_endpoint(self):
+        response = client.get("/events/moon/phases?date=2022-01-01&days=31&offset=%2B01:00")
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        properties = response.json()["properties"]
+        self.assertEqual(len(properties["moonphases"]), 31)
+        self.assertEqual(properties["moonphases"][0]["date"], "2022-01-01")
+        # The phase at the start of a day is the one /events/moon reports
+        # for places where solar and queried midnight coincide
+        moon = client.get("/events/moon?date=2022-01-10&lat=0&lon=15&offset=%2B01:00").json()
+        self.assertEqual(properties["moonphases"][9]["moonphase"],
+                         moon["properties"]["moonphase"])
+        self.assertEqual([(event["time"], event["phase"]) for event in properties["phase_events"]],
+                         [("2022-01-02T19:33+01:00", "New Moon"),
+                          ("2022-01-09T19:11+01:00", "First Quarter"),
+                          ("2022-01-18T00:48+01:00", "Full Moon"),
+                          ("2022-01-25T14:40+01:00", "Last Quarter")])
+        response = client.get("/events/moon/phases?date=2022-01-01&offset=0100")
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+    def test_phases_outside_ephemeris(self):
+        first, last = sunrise.ephemeris_dates()
+        for date in ["1849-12-20", "2150-01-20",
+                     f"{first - datetime.timedelta(days=1):%Y-%m-%d}",
+                     f"{last:%Y-%m-%d}&days=2"]:
+            response = client.get(f"/events/moon/phases?date={date}")
+            self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+            self.assertIn("outside the range of the ephemeris", response.json())
+        response = client.get(f"/events/moon/phases?date={first:%Y-%m-%d}&offset=%2B14:00")
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        response = client.get(f"/events/moon/phases?date={last:%Y-%m-%d}&days=1&offset=-12:00")
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+
+
+class TestAnalyticSun(unittest.TestCase):
+
+    def test_sidereal_time(self):
+        ts = api.load.timescale()
+        tt = numpy.linspace(2415020.5, 2488069.5, 500)
+        _, gast = AnalyticSun(ts).geocentric("Sun", tt)
+        difference = (gast - ts.tt_jd(tt).gast * numpy.pi / 12 + numpy.pi) % (2 * numpy.pi) - numpy.pi
+        self.assertLess(numpy.degrees(numpy.abs(difference)).max() * 3600, 1)
+
+    def test_events_1900_2100(self):
+        """
+        precision=fast gives the same events as the ephemeris within a
+        minute, for a day of every other year of 1900-2100 covered by
+        the ephemeris and observers at latitudes up to 65 degrees.
+        """
+        first, last = sunrise.ephemeris_dates()
+        rng = numpy.random.default_rng(2)
+        lats = numpy.linspace(-65, 65, 9)
+        offsets = ["+00:00"] * len(lats)
+        compared = 0
+        for year in range(1900, 2101, 2):
+            date = datetime.datetime(year, 1, 1) + datetime.timedelta(days=int(rng.integers(0, 365)))
+            if not first <= date <= last:
+                continue
+            lons = rng.uniform(-179, 179, len(lats))
+            full = sunrise.solve_observers("Sun", date, lats, lons, offsets)
+            for lat, lon, full_day in zip(lats, lons, full):
+                fast_day, = sunrise.solve_days("Sun", date, 1, lat, lon, "+00:00", "fast")
+                first_response, second_response = (
+                    make_response(setting, rising, noon[0], noon[1],
+                                  start.strftime(sunrise.TIME_FORMAT),
+                                  end.strftime(sunrise.TIME_FORMAT),
+                                  "Sun", lat, lon, None, "+00:00")
+                    for rising, setting, noon, _, start, end in [full_day, fast_day])
+                # The ephemeris path reports events up to EPS days late,
+                # in which the azimuth moves by up to 0.05 degrees
+                TestStringMethods.assertSameEvents(self, first_response, second_response,
+                                                   exact_when=False, angle_delta=0.1)
+                compared += 1
+        self.assertGreater(compared, 500)
+
+    def test_fast_only(self):
+        with unittest.mock.patch.dict(os.environ, {"CELESTIAL_EPHEMERIS": "0"}):
+            self.assertIsNone(init_eph())
+        with unittest.mock.patch.object(sunrise, "eph", None):
+            query = "date=2022-06-21&lat=59.91&lon=10.75"
+            self.assertEqual(client.get(f"/events/sun?{query}&precision=fast").status_code,
+                             HTTPStatus.OK)
+            for response in [client.get(f"/events/sun?{query}"),
+                             client.get(f"/events/moon?{query}"),
+                             client.get("/events/moon/phases?date=2022-06-21"),
+                             client.post("/events/sun/batch",
+                                         json=[{"lat": 60, "lon": 10, "date": "2022-06-21"}])]:
+                self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+                self.assertIn("precision=fast", response.json())
+
+
+class TestEphemeris(unittest.TestCase):
+
+    def test_memory_mapped(self):
+        eph = init_eph()
+        self.assertGreater(map_ephemeris(eph, touch=True), 0)
+        for segment in eph.spk.segments:
+            self.assertIsNotNone(segment.daf._map)
+        usage = memory_usage()
+        if usage:
+            self.assertGreaterEqual(usage["rss"], usage["private"])
+            self.assertGreater(usage["shared"] + usage["private"], 0)
+
+    def test_memory_map_fallback(self):
+        # Without the private attributes of jplephem nothing is mapped
+        eph = SimpleNamespace(spk=SimpleNamespace(segments=[object()]))
+        with self.assertLogs("celestial", level="WARNING"):
+            self.assertEqual(map_ephemeris(eph), 0)
+
+
+class TestAstroContext(unittest.TestCase):
+
+    def test_observer_quantization(self):
+        context = AstroContext(init_eph(), api.load.timescale(),
+                               quantization=0.01)
+        observer = context.observer(59.9112, 10.7489)
+        self.assertAlmostEqual(observer.lat, 59.91)
+        self.assertAlmostEqual(observer.lon, 10.75)
+        observer = AstroContext(init_eph(), api.load.timescale(),
+                                quantization=0).observer(59.9112, 10.7489)
+        self.assertEqual((observer.lat, observer.lon), (59.9112, 10.7489))
+
+
+class TestAccessLog(unittest.TestCase):
+
+    def test_sampler(self):
+        sampler = AccessSampler(rate=0.0, slow_seconds=0.5)
+        self.assertFalse(sampler(200, 0.1))
+        self.assertTrue(sampler(404, 0.1))
+        self.assertTrue(sampler(503, 0.1))
+        self.assertTrue(sampler(200, 0.5))
+        self.assertTrue(AccessSampler(rate=1.0)(200, 0.1))
+
+    def test_json_lines(self):
+        output = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(output):
+                logger = configure_logging("json")
+            logger.info("Request: %s with status code %s", "/events/sun", 200,
+                        extra={"fields": {"status": 200, "duration_ms": 1.5}})
+            initialize._stop_listener()
+        finally:
+            configure_logging("text")
+        entry = json.loads(output.getvalue().splitlines()[-1])
+        self.assertEqual(entry["message"], "Request: /events/sun with status code 200")
+        self.assertEqual(entry["status"], 200)
+        self.assertEqual(entry["duration_ms"], 1.5)
+        self.assertEqual(entry["level"], "INFO")
+
+
+class TestProfiler(unittest.TestCase):
+
+    def test_keeps_slow_profiles(self):
+        with tempfile.TemporaryDirectory() as directory:
+            profiler = SlowTaskProfiler(directory, threshold=0.05, max_files=2)
+            self.assertEqual(profiler.run(sum, [1, 2]), 3)
+            self.assertEqual(profiler.names(), [])
+            for seconds in [0.06, 0.07, 0.08]:
+                profiler.run(time.sleep, seconds)
+            names = profiler.names()
+            self.assertEqual(len(names), 2)
+            self.assertEqual(profiler.describe(names[-1])["args"], [0.08])
+            self.assertTrue(os.path.exists(profiler.path(names[-1])))
+            self.assertIsNone(profiler.path("../../etc/passwd"))
+
+    def test_admin_endpoint(self):
+        admin = {"Authorization": "Bearer secret"}
+        with tempfile.TemporaryDirectory() as directory, \
+             unittest.mock.patch.dict(os.environ, {"CELESTIAL_ADMIN_TOKEN": "secret"}):
+            profiler = SlowTaskProfiler(directory, threshold=0.0)
+            with unittest.mock.patch("routes.sunrise.profiler", profiler), \
+                 unittest.mock.patch("core.profiler.profiler", profiler):
+                init_cache().clear()
+                client.get("/events/moon?date=2017-08-21&lat=78.22&lon=15.65")
+                self.assertEqual(client.get("/admin/profiles").status_code,
+                                 HTTPStatus.UNAUTHORIZED)
+                self.assertEqual(client.get("/admin/profiles", headers={
+                    "Authorization": "Bearer wrong"}).status_code, HTTPStatus.UNAUTHORIZED)
+                listing = client.get("/admin/profiles", headers=admin).json()
+                self.assertEqual(listing[0]["task"], "solve_days")
+                self.assertIn("Moon", listing[0]["args"])
+                name = listing[0]["name"]
+                self.assertEqual(client.get(f"/admin/profiles/{name}").status_code,
+                                 HTTPStatus.UNAUTHORIZED)
+                text = client.get(f"/admin/profiles/{name}?format=text", headers=admin)
+                self.assertIn("find_events", text.text)
+                self.assertEqual(client.get(f"/admin/profiles/{name}",
+                                            headers=admin).status_code, HTTPStatus.OK)
+                self.assertEqual(client.get("/admin/profiles/missing",
+                                            headers=admin).status_code, HTTPStatus.NOT_FOUND)
+            self.assertEqual(client.get("/admin/profiles", headers=admin).status_code,
+                             HTTPStatus.NOT_FOUND)
+        # Without an admin token the admin endpoints are not served
+        self.assertEqual(client.get("/admin/profiles", headers=admin).status_code,
+                         HTTPStatus.NOT_FOUND)
+
+
+class TestResultCache(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        cache = ResultCache(max_entries=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.stats()["entries"], 2)
+
+    def test_byte_bound(self):
+        cache = ResultCache(max_bytes=1000)
+        for i in range(100):
+            cache.put(i, [i] * 10)
+        self.assertLessEqual(cache.bytes, 1000)
+        self.assertGreater(cache.evictions, 0)
+
+    def test_quantization(self):
+        cache = ResultCache(quantization=0.01)
+        self.assertEqual(cache.key("Sun", "2022-01-01", 59.9101, 10.7502, "+01:00"),
+                         cache.key("Sun", "2022-01-01", 59.9099, 10.7498, "+01:00"))
+        self.assertNotEqual(cache.key("Sun", "2022-01-01", 59.91, 10.75, "+01:00"),
+                            cache.key("Sun", "2022-01-01", 59.93, 10.75, "+01:00"))
+
+    def test_disabled(self):
+        cache = ResultCache(max_entries=0)
+        cache.put("a", 1)
+        self.assertIsNone(cache.get("a"))
+
+
+class TestEventTiles(unittest.TestCase):
+
+    def test_estimate_error(self):
+        # Times linear over the grid interpolate exactly
+        lat, lon = numpy.meshgrid(numpy.arange(4), numpy.arange(5), indexing="ij")
+        times = numpy.stack([100 * lat + 10 * lon] * 4, axis=-1)[numpy.newaxis].astype(numpy.int32)
+        error = estimate_error(times)
+        self.assertEqual(error.shape, (1, 3, 4))
+        self.assertTrue((error == 0).all())
+        # Second differences of 16 minutes along both latitude and
+        # longitude at a corner, less the truncation noise of 2 minutes
+        # each, are an error of 3.5 minutes
+        times[0, 2, 2] += 8
+        self.assertEqual(estimate_error(times)[0, 1, 1], 35)
+        # Second differences within the truncation noise do not count
+        times[0, 2, 2] -= 7
+        self.assertEqual(estimate_error(times)[0, 1, 1], 0)
+        # Events that only happen at some corners have no estimate,
+        # events that happen at none do not count
+        times[0, 0, 0, 0] = MISSING
+        times[0, :, :, 1] = MISSING
+        error = estimate_error(times)
+        self.assertEqual(error[0, 0, 0], UNKNOWN_ERROR)
+        self.assertEqual(error[0, 2, 3], 0)
+        # Azimuths that bend too much over a cell make the error unknown
+        angles = numpy.zeros_like(times, dtype=numpy.int16)
+        self.assertEqual(estimate_error(times, angles)[0, 2, 3], 0)
+        angles[0, 2, 2, RISE] = 100
+        self.assertEqual(estimate_error(times, angles)[0, 2, 3], UNKNOWN_ERROR)
+
+    def test_disabled(self):
+        tiles = EventTiles()
+        self.assertIsNone(tiles.lookup(datetime.datetime(2022, 6, 20), 60, 10))
+        self.assertEqual(tiles.stats(), {"enabled": False})
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def test_coalesces_identical_calls(self):
+        single_flight = SingleFlight()
+        calls = []
+
+        async def calculate(value):
+            calls.append(value)
+            await asyncio.sleep(0.05)
+            return value * 2
+
+        async def burst():
+            return await asyncio.gather(*[single_flight.run(key, "Sun", calculate, key)
+                                          for key in [1, 1, 1, 2]])
+
+        self.assertEqual(asyncio.run(burst()), [2, 2, 2, 4])
+        self.assertEqual(calls, [1, 2])
+        self.assertEqual(single_flight.stats()["coalesced"], 2)
+        self.assertEqual(single_flight.stats()["in_flight"], 0)
+        # Nothing is kept once the calls are done
+        asyncio.run(burst())
+        self.assertEqual(calls, [1, 2, 1, 2])
+
+    def test_errors_and_cancellation(self):
+        single_flight = SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.05)
+            raise ValueError("failed")
+
+        async def errors():
+            return await asyncio.gather(*[single_flight.run("key", "Sun", fail)
+                                          for _ in range(2)], return_exceptions=True)
+
+        self.assertTrue(all(isinstance(e, ValueError) for e in asyncio.run(errors())))
+
+        async def cancel_first():
+            first = asyncio.ensure_future(single_flight.run("key", "Sun", asyncio.sleep, 0.05, "done"))
+            second = asyncio.ensure_future(single_flight.run("key", "Sun", asyncio.sleep, 0.05, "done"))
+            await asyncio.sleep(0.01)
+            first.cancel()
+            return await second
+
+        self.assertEqual(asyncio.run(cancel_first()), "done")
+
+    def test_disabled(self):
+        single_flight = SingleFlight(enabled=False)
+        calls = []
+
+        async def calculate():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+
+        async def burst():
+            await asyncio.gather(*[single_flight.run("key", "Sun", calculate) for _ in range(3)])
+
+        asyncio.run(burst())
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(single_flight.stats()["coalesced"], 0)
+
+    def test_concurrent_requests(self):
+        """
+        A burst of identical requests is calculated once,
+        also with the result cache disabled.
+        """
+        single_flight = sunrise.single_flight
+        query = "/events/moon?date=2023-03-01&lat=59.91&lon=10.75&days=30"
+
+        async def burst():
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+                return await asyncio.gather(*[client.get(query) for _ in range(5)])
+
+        coalesced = single_flight.coalesced
+        with unittest.mock.patch.object(sunrise, "cache", ResultCache(max_entries=0)):
+            responses = asyncio.run(burst())
+        self.assertTrue(all(response.status_code == HTTPStatus.OK for response in responses))
+        self.assertTrue(all(response.content == responses[0].content for response in responses))
+        self.assertEqual(single_flight.coalesced - coalesced, 4)
+
+class TestWorkerPool(unittest.TestCase):
+
+    def test_run_and_stats(self):
+        pool = WorkerPool(size=2)
+        result = asyncio.run(pool.run(pow, 2, 10))
+        pool.shutdown()
+        self.assertEqual(result, 1024)
+        self.assertEqual(pool.stats()["completed"], 1)
+        self.assertEqual(pool.stats()["in_flight"], 0)
+
+    def test_cancelled_caller(self):
+        pool = WorkerPool(size=1)
+
+        async def cancel_running():
+            task = asyncio.ensure_future(pool.run(time.sleep, 0.2))
+            await asyncio.sleep(0.05)
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+            return pool.in_flight
+
+        # The task keeps running in its thread after the caller is gone
+        self.assertEqual(asyncio.run(cancel_running()), 1)
+        pool.shutdown()
+        time.sleep(0.3)
+        self.assertEqual(pool.in_flight, 0)
+
+    def test_rejects_when_full(self):
+        pool = WorkerPool(size=1, queue_depth=1)
+
+        async def submit_three():
+            return await asyncio.gather(*[pool.run(time.sleep, 0.1)
+                                          for _ in range(3)],
+                                        return_exceptions=True)
+
+        results = asyncio.run(submit_three())
+        pool.shutdown()
+        self.assertEqual(sum(isinstance(r, PoolFull) for r in results), 1)
+        self.assertEqual(pool.stats()["rejected"], 1)
+        self.assertEqual(pool.stats()["completed"], 2)
+
+
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the calculations behind /events/{body}, called directly
+without HTTP, over a fixed matrix of bodies and places.
+
+For every case the full calculation of one day (calculate_one_day),
+the search for events alone (find_events) and building the response
+(make_response) are timed, reporting the median and tail of the time
+per call and how many times the ephemeris was evaluated per call.
+Everything is warmed up first, so the timings are those of a server
+that has answered requests before.
+
+The results can be saved as a baseline and later runs compared with
+it, failing if the median of any case got slower by more than the
+threshold (and by more than a small absolute margin, as the fastest
+calls are within timer noise) or the case evaluates the ephemeris
+more often.
+
+Run from the repository root:
+    python3 benchmark/calculations.py [--repeat 200] [--save baseline.json]
+    python3 benchmark/calculations.py --baseline baseline.json [--threshold 0.25]
+"""
+import argparse
+import json
+import os
+import sys
+from datetime import datetime, timedelta
+from time import perf_counter
+import numpy as np
+from jplephem.spk import Segment
+from skyfield.api import utc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+from routes.sunrise import (calculate_one_day, event_windows, parse_offset,
+                            solar_offset, context, eph, tables, analytic_sun,
+                            HORIZONS, EPS, TIME_FORMAT)
+from core.solver import find_events
+from core.make_response import make_response
+
+# name, body, lat, lon, date, offset, precision
+CASES = [
+    ("equator", "Sun", 0.0, 10.0, "2022-03-20", "+01:00", "full"),
+    ("equator", "Moon", 0.0, 10.0, "2022-03-20", "+01:00", "full"),
+    ("mid-latitude", "Sun", 59.91, 10.75, "2022-06-21", "+02:00", "full"),
+    ("mid-latitude", "Moon", 59.91, 10.75, "2022-06-21", "+02:00", "full"),
+    ("mid-latitude-fast", "Sun", 59.91, 10.75, "2022-06-21", "+02:00", "fast"),
+    ("polar-day", "Sun", 78.22, 15.65, "2022-06-21", "+02:00", "full"),
+    ("polar-day", "Moon", 78.22, 15.65, "2022-06-21", "+02:00", "full"),
+    ("polar-night", "Sun", 78.22, 15.65, "2022-12-21", "+01:00", "full"),
+    ("polar-night", "Moon", 78.22, 15.65, "2022-12-21", "+01:00", "full"),
+    # Places on the "wrong" side of the date line, see solar_offset
+    ("dateline-west", "Sun", 52.9, 172.9, "2022-06-21", "-10:00", "full"),
+    ("dateline-west", "Moon", 52.9, 172.9, "2022-06-21", "-10:00", "full"),
+    ("dateline-east", "Sun", -21.1, -175.2, "2022-06-21", "+13:00", "full"),
+    ("dateline-east", "Moon", -21.1, -175.2, "2022-06-21", "+13:00", "full"),
+]
+
+ephemeris_calls = 0
+
+
+def count_ephemeris_calls():
+    """
+    Counts evaluations of ephemeris segments in ephemeris_calls.
+    """
+    generate = Segment.generate
+
+    def counting(self, *args, **kwargs):
+        global ephemeris_calls
+        ephemeris_calls += 1
+        return generate(self, *args, **kwargs)
+    Segment.generate = counting
+
+
+def calls(case) -> dict:
+    """
+    Returns the functions to time for a case, taking no arguments.
+    """
+    name, body, lat, lon, date, offset, precision = case
+    datetime_date = datetime.strptime(date, "%Y-%m-%d")
+    offset_h, offset_m = parse_offset(offset)
+    delta_offset = solar_offset(lon, offset_h)
+    observer = context.observer(lat, lon)
+
+    def one_day():
+        return calculate_one_day(datetime_date, context.ts, eph, observer,
+                                 offset_h, offset_m, delta_offset, body,
+                                 precision)
+
+    # The search calculate_days makes for the day
+    starts = [datetime_date.replace(tzinfo=utc) + timedelta(hours=delta_offset)]
+    _, search_start, search_end = event_windows(body, starts)
+    horizon, inclusive = HORIZONS[body]
+    tt0 = context.ts.utc(search_start).tt
+    tt1 = context.ts.utc(search_end).tt
+
+    def events():
+        if precision == "fast":
+            return analytic_sun.find_events([lat], [lon], tt0, tt1,
+                                            horizon, inclusive)
+        return find_events(eph, context.ts, body, [lat], [lon], tt0, tt1,
+                           horizon, EPS, inclusive, tables=tables)
+
+    rising, setting, noon, moonphase, day_start, day_end = one_day()
+
+    def response():
+        return make_response(setting, rising, noon[0], noon[1],
+                             day_start.strftime(TIME_FORMAT),
+                             day_end.strftime(TIME_FORMAT),
+                             body, lat, lon, moonphase, offset)
+
+    return {"calculate_one_day": one_day,
+            "find_events": events,
+            "make_response": response}
+
+
+def measure(fn, repeat) -> dict:
+    """
+    Times repeat calls of fn, after one call counting ephemeris calls.
+    """
+    global ephemeris_calls
+    ephemeris_calls = 0
+    fn()
+    calls_per_run = ephemeris_calls
+    times = np.empty(repeat)
+    for i in range(repeat):
+        start = perf_counter()
+        fn()
+        times[i] = perf_counter() - start
+    return {"median": float(np.median(times)),
+            "p90": float(np.percentile(times, 90)),
+            "p99": float(np.percentile(times, 99)),
+            "min": float(times.min()),
+            "ephemeris_calls": calls_per_run}
+
+
+def compare(results, baseline, threshold, margin) -> list:
+    """
+    Returns descriptions of the cases that regressed against baseline.
+    """
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        before = baseline[key]
+        if (result["median"] > before["median"] * (1 + threshold)
+                and result["median"] > before["median"] + margin):
+            regressions.append(f"{key}: median {1000 * before['median']:.3f} ms -> "
+                               f"{1000 * result['median']:.3f} ms")
+        if result["ephemeris_calls"] > before["ephemeris_calls"]:
+            regressions.append(f"{key}: ephemeris calls {before['ephemeris_calls']} -> "
+                               f"{result['ephemeris_calls']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=200,
+                        help="timed calls per case and function")
+    parser.add_argument("--save", help="write the results as a baseline to this file")
+    parser.add_argument("--baseline", help="compare with the baseline in this file")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="allowed relative increase of the median over the baseline")
+    parser.add_argument("--margin", type=float, default=0.0005,
+                        help="allowed absolute increase of the median in seconds")
+    args = parser.parse_args()
+
+    count_ephemeris_calls()
+    results = {}
+    print(f"{'case':<28}{'function':<19}{'median ms':>10}{'p90 ms':>9}"
+          f"{'p99 ms':>9}{'eph calls':>10}")
+    for case in CASES:
+        for function, fn in calls(case).items():
+            key = f"{case[0]}/{case[1]}/{function}"
+            result = measure(fn, args.repeat)
+            results[key] = result
+            print(f"{case[0] + ' ' + case[1]:<28}{function:<19}"
+                  f"{1000 * result['median']:>10.3f}{1000 * result['p90']:>9.3f}"
+                  f"{1000 * result['p99']:>9.3f}{result['ephemeris_calls']:>10}")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=1)
+        print(f"Baseline written to {args.save}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, args.margin)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {100 * args.threshold:.0f}% against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Benchmark of building and serializing responses of /events/{body},
+comparing the pydantic path the application used to take with the
+direct path of core.make_response.
+
+The pydantic path builds the response models, dumps them to a dict,
+and then has FastAPI validate and serialize the dict again against the
+response model of the route. The direct path builds the dict and
+encodes it with render. Both give the same bytes.
+
+Run from the repository root:
+    python3 benchmark/serialization.py [--days 1] [--number 2000]
+"""
+import argparse
+import os
+import sys
+from timeit import repeat
+import numpy as np
+from fastapi.responses import JSONResponse
+from pydantic import TypeAdapter
+from skyfield.units import Angle
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+from core.make_response import (make_response, render, ResponseModel,
+                                Geometry, When, RisingEvent,
+                                MeridianCrossingEvent, SunProperties,
+                                MoonProperties)
+
+
+def pydantic_response(setting, rising, meridian, antimeridian,
+                      start, end, body, lat, lon, moonphase, offset) -> dict:
+    """
+    make_response as it was before the direct path, through the models.
+    """
+    def crossing(event):
+        return MeridianCrossingEvent(
+            time=event[0] + offset if event[0] is not None else None,
+            disc_centre_elevation=round(event[1], 2) if event[1] is not None else None,
+            visible=str(event[2]) == "True" if event[2] is not None else None)
+    rising_event = RisingEvent(time=rising[0] + offset, azimuth=round(rising[1], 2))
+    setting_event = RisingEvent(time=setting[0] + offset, azimuth=round(setting[1], 2))
+    if body == "Sun":
+        properties = SunProperties(sunrise=rising_event, sunset=setting_event,
+                                   solarnoon=crossing(meridian),
+                                   solarmidnight=crossing(antimeridian))
+    else:
+        properties = MoonProperties(moonrise=rising_event, moonset=setting_event,
+                                    high_moon=crossing(meridian),
+                                    low_moon=crossing(antimeridian),
+                                    moonphase=round(moonphase.degrees, 2))
+    return ResponseModel(geometry=Geometry(coordinates=[lon, lat]),
+                         when=When(interval=[start + ":00Z", end + ":00Z"]),
+                         properties=properties).model_dump()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--days", type=int, default=1,
+                        help="number of daily results per response")
+    parser.add_argument("--number", type=int, default=2000,
+                        help="responses per timing run")
+    args = parser.parse_args()
+
+    arguments = (["2021-06-21T22:10", np.float64(311.2345)],
+                 ["2021-06-21T03:52", np.float64(48.5123)],
+                 ["2021-06-21T13:12", np.float64(53.4567), np.True_],
+                 ["2021-06-21T01:12", np.float64(-6.789), np.False_],
+                 "2021-06-21T00:00", "2021-06-22T00:00")
+    moonphase = Angle(degrees=123.4567)
+    if args.days == 1:
+        response_model = ResponseModel
+    else:
+        response_model = list[ResponseModel]
+    adapter = TypeAdapter(response_model)
+
+    def fastapi_path(body):
+        content = [pydantic_response(*arguments, body, 59.91, 10.75,
+                                     moonphase, "+02:00")
+                   for _ in range(args.days)]
+        if args.days == 1:
+            content = content[0]
+        # What FastAPI does with the dict returned from the route
+        validated = adapter.validate_python(content)
+        return JSONResponse(adapter.dump_python(validated, mode="json")).body
+
+    def direct_path(body):
+        content = [make_response(*arguments, body, 59.91, 10.75,
+                                 moonphase, "+02:00")
+                   for _ in range(args.days)]
+        if args.days == 1:
+            content = content[0]
+        return render(content).body
+
+    print(f"{'body':<6}{'path':<10}{'us/response':>14}{'speedup':>10}")
+    for body in ["Sun", "Moon"]:
+        assert fastapi_path(body) == direct_path(body)
+        timings = {}
+        for name, path in [("pydantic", fastapi_path), ("direct", direct_path)]:
+            best = min(repeat(lambda: path(body), number=args.number, repeat=5))
+            timings[name] = best / args.number * 1e6
+        for name, microseconds in timings.items():
+            speedup = timings["pydantic"] / microseconds
+            print(f"{body:<6}{name:<10}{microseconds:>14.1f}{speedup:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+HDR-style latency histogram.
+
+Values are recorded as whole microseconds into log-linear buckets:
+exactly below 2048 us, and above that with 1024 sub-buckets per power
+of two, so every recorded value is known to within 0.1%. Recording is
+a constant time index computation, the memory use is fixed however
+many values are recorded, and histograms from several runs or
+processes merge by adding their counts.
+"""
+import numpy as np
+
+SUB_BUCKET_BITS = 11
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+SUB_BUCKET_HALF = SUB_BUCKET_COUNT // 2
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class Histogram():
+    """
+    Histogram of latencies from 1 us up to `highest_seconds`.
+    Larger values are recorded as highest_seconds.
+    """
+    def __init__(self, highest_seconds=3600):
+        self.highest = int(highest_seconds * 1e6)
+        self.counts = np.zeros(_index(self.highest) + 1, dtype=np.int64)
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, seconds, count=1):
+        value = min(max(int(seconds * 1e6), 0), self.highest)
+        self.counts[_index(value)] += count
+        self.total += count
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        """
+        Add the counts of another histogram to this one.
+        """
+        self.counts += other.counts
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, percentile) -> float:
+        """
+        Returns the latency in seconds that `percentile` percent
+        of the recorded values are at or below.
+        """
+        if self.total == 0:
+            return None
+        rank = max(1, int(np.ceil(percentile / 100 * self.total)))
+        index = int(np.searchsorted(np.cumsum(self.counts), rank))
+        return min(_highest_equivalent(index), self.max) / 1e6
+
+    def mean(self) -> float:
+        if self.total == 0:
+            return None
+        index = np.flatnonzero(self.counts)
+        middle = [(_lowest(i) + _highest_equivalent(i)) / 2 for i in index]
+        return float(np.dot(self.counts[index], middle) / self.total / 1e6)
+
+    def summary(self) -> dict:
+        """
+        Count, mean, percentiles and max in seconds.
+        """
+        summary = {"count": self.total, "mean": self.mean()}
+        for percentile in PERCENTILES:
+            summary[f"p{percentile:g}"] = self.percentile(percentile)
+        summary["max"] = self.max / 1e6 if self.max is not None else None
+        return summary
+
+    def to_dict(self) -> dict:
+        """
+        Sparse representation that from_dict restores, for storing
+        histograms and sending them between processes.
+        """
+        index = np.flatnonzero(self.counts)
+        return {"highest": self.highest,
+                "min": self.min,
+                "max": self.max,
+                "counts": dict(zip(index.tolist(), self.counts[index].tolist()))}
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls(data["highest"] / 1e6)
+        for index, count in data["counts"].items():
+            histogram.counts[int(index)] = count
+        histogram.total = int(histogram.counts.sum())
+        histogram.min = data["min"]
+        histogram.max = data["max"]
+        return histogram
+
+
+def _index(value) -> int:
+    bucket = max(0, int(value).bit_length() - SUB_BUCKET_BITS)
+    return bucket * SUB_BUCKET_HALF + (int(value) >> bucket)
+
+
+def _lowest(index) -> int:
+    bucket = max(0, index // SUB_BUCKET_HALF - 1)
+    return (index - bucket * SUB_BUCKET_HALF) << bucket
+
+
+def _highest_equivalent(index) -> int:
+    bucket = max(0, index // SUB_BUCKET_HALF - 1)
+    return ((index - bucket * SUB_BUCKET_HALF + 1) << bucket) - 1
@@ -1,15 +1,39 @@
-from asyncio import create_task, get_event_loop, sleep, run, exceptions
+"""
+Open-loop load generator for the celestial API.
+
+Requests are sent on a fixed schedule of intended send times, at the
+configured rate, whether or not earlier requests have been answered.
+Latency is measured from the intended send time, so time a request
+spends waiting behind a slow server or a busy client is counted
+(the correction for coordinated omission). The service time, from
+actually sending the request to the response, is recorded separately.
+
+Requests are either generated for random places and dates, or replayed
+from a JSON lines request log, keeping the recorded arrival times or
+speeding them up by a factor.
+
+Above a few hundred requests per second a single event loop can not keep
+up with the schedule, which shows as send lag. The load can then be
+spread over several processes, each sending its share of the requests
+with its own connection pool, and their histograms are merged at the end.
+
+Usage: python src/main.py <config file> [prefix for output files]
+"""
+from asyncio import create_task, get_event_loop, sleep, run, wait, Event, CancelledError, TimeoutError
 import genericpath
-import time
-from queue import Queue
-from aiohttp import ClientSession, TraceConfig, client_exceptions
-import numpy as np
+import multiprocessing
 import configparser
 import sys
 import json
+import os
 import random
 import signal
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+import numpy as np
+from histogram import Histogram
+from replay import read_log, body_of
 
 
 class bcolors:
@@ -25,32 +49,91 @@ class bcolors:
 
 
 def printe(str):
-    print(bcolors.FAIL + str + bcolors.ENDC)
+    print(bcolors.FAIL + str + bcolors.ENDC, file=sys.stderr)
 
 
 def printw(str):
-    print(bcolors.WARNING + str + bcolors.ENDC)
+    print(bcolors.WARNING + str + bcolors.ENDC, file=sys.stderr)
+
+
+class Results():
+    """
+    Latency histograms, overall and by status and body, and the service
+    time and send lag (from intended to actual send time) histograms of
+    all requests.
+    """
+    def __init__(self):
+        self.latency = Histogram()
+        self.service = Histogram()
+        self.send_lag = Histogram()
+        self.by_status = {}
+        self.by_body = {}
 
+    def record(self, status, body, latency, service):
+        self.latency.record(latency)
+        self.service.record(service)
+        self.send_lag.record(latency - service)
+        self.by_status.setdefault(str(status), Histogram()).record(latency)
+        self.by_body.setdefault(body, Histogram()).record(latency)
 
-async def on_request_start(session, trace_config_ctx, params):
-    trace_config_ctx.start = get_event_loop().time()
+    def merge(self, other):
+        self.latency.merge(other.latency)
+        self.service.merge(other.service)
+        self.send_lag.merge(other.send_lag)
+        for mine, theirs in ((self.by_status, other.by_status), (self.by_body, other.by_body)):
+            for key, histogram in theirs.items():
+                mine.setdefault(key, Histogram()).merge(histogram)
 
+    def to_dict(self) -> dict:
+        return {"latency": self.latency.to_dict(),
+                "service": self.service.to_dict(),
+                "send_lag": self.send_lag.to_dict(),
+                "by_status": {k: h.to_dict() for k, h in self.by_status.items()},
+                "by_body": {k: h.to_dict() for k, h in self.by_body.items()}}
 
-async def on_request_end(session, trace_config_ctx, params):
-    elapsed, url, method, status_code = get_event_loop().time() - trace_config_ctx.start, str(params.url), params.method, params.response.status
-    #print("{}".format(params.response))
-    print("{}, {}, {}, {}, {}\n{}".format(time.time(), get_event_loop().time() - elapsed, get_event_loop().time(), elapsed, status_code, params.response))  # print data right away in the callback
-    q.put([status_code, elapsed])
+    @classmethod
+    def from_dict(cls, data):
+        results = cls()
+        results.latency = Histogram.from_dict(data["latency"])
+        results.service = Histogram.from_dict(data["service"])
+        results.send_lag = Histogram.from_dict(data["send_lag"])
+        results.by_status = {k: Histogram.from_dict(h) for k, h in data["by_status"].items()}
+        results.by_body = {k: Histogram.from_dict(h) for k, h in data["by_body"].items()}
+        return results
 
 
-async def get_response(session, url, method="GET", data=None):
-    #print("{}\n".format(url))
+async def get_response(session, url, method="GET", data=None) -> int:
     if method.upper() != "POST":
         async with session.get(url) as resp:
-            pass
+            await resp.read()
     else:
-        async with session.post(url, data) as resp:
-            pass
+        async with session.post(url, json=data) as resp:
+            await resp.read()
+    return resp.status
+
+
+async def send(session, url, body, intended, method, data):
+    """
+    Send one request and record its latency from the intended send time.
+    Requests without a response are recorded with status "timeout" if
+    they timed out, "unanswered" if the test ended first and "error"
+    if they failed.
+    """
+    loop = get_event_loop()
+    sent = loop.time()
+    try:
+        status = await get_response(session, url, method, data)
+    except TimeoutError:
+        status = "timeout"
+    except CancelledError:
+        done = loop.time()
+        results.record("unanswered", body, done - intended, done - sent)
+        raise
+    except Exception as e:
+        printw("WARNING - {} {}: {!r}".format(method, url, e))
+        status = "error"
+    done = loop.time()
+    results.record(status, body, done - intended, done - sent)
 
 
 def get_random_date_range(start_date, end_date, delta):
@@ -61,104 +144,245 @@ def get_random_date_range(start_date, end_date, delta):
     date1 = datetime.fromtimestamp(random.randint(epoch_start, epoch_end))
     return "{}".format(date1.strftime("%Y-%m-%d"))
 
-def print_report():
-    # Change here for more complex reporting
-    tot, succ = 0, 0
-    for t in tasks:
-        try:
-            t.exception()
-        except exceptions.InvalidStateError or client_exceptions.ServerDisconnectedError:
-            pass
-    while not q.empty():  # retrieve data from synchronized queue
-        pair = q.get()
-        q.task_done()
-        # print(f'Latency: {pair[1]}, status: {pair[0]}')  # readable format
-        # print(f'{pair[1]}, {pair[0]}, {op}, {url}')  # csv format
-        if pair[0] == 200:
-            succ += 1
-        tot += pair[1]
-    print(f'Avg Latency: {tot / count}, Success rate: {100 * succ / count}, Total requests: {count}', flush=True)
-    # file.write(f'# Avg Latency: {tot / count}, Success rate: {100 * succ / count}\n')
-
-def ctrl_c_handler(signum, frame):
-    print_report()
-    exit(1)
 
-async def main():
-    async with ClientSession(trace_configs=[trace_config]) as session:
-        # TOTAL TIME MEASUREMENT
-        start_time = get_event_loop().time()
-        last = int(dim_dict["seconds"])
-        distrib = dim_dict["distribution"]
-        min_date = additional_dict["min_date"]
-        max_date = additional_dict["max_date"]
-        date_format = additional_dict["date_format"]
-        elevation = int(additional_dict["elevation"])
-        days = int(additional_dict["days"])
-        min_lat = float(additional_dict["min_lat"])
-        max_lat = float(additional_dict["max_lat"])
-        min_lon = float(additional_dict["min_lon"])
-        max_lon = float(additional_dict["max_lon"])
-        min_offset = int(additional_dict["min_offset"])
-        max_offset = int(additional_dict["max_offset"])
-        if (distrib.lower() != "poisson" and distrib.lower() != "uniform"):
-            printe("ERROR - Unknown distribution {}".format(distrib))
-            exit(1)
-        stress_test_last = start_time + last
-        # tasks = set()
-        global count
-        print(f'"ts", "ts1", "ts2", "latency", "status"')
-        op = req_dict["operation"]  # read from param if GET or POST
-        base_url = req_dict["url"]  # read url from input param
-        jpath = req_dict["payload"]  # eventually load json in case of http POST
-        # csv_output = req_dict["csv"]  # output file for csv data UNUSED
-        jcontent = None
-        if op == "POST":
-            jfile = open(jpath)
+def random_request(base_url, bodies):
+    """
+    Returns the body and url of a request for a random place and date.
+    """
+    date_range = get_random_date_range(datetime.strptime(additional_dict["min_date"], additional_dict["date_format"]),
+                                       datetime.strptime(additional_dict["max_date"], additional_dict["date_format"]),
+                                       timedelta(days=1))
+    lat = random.uniform(float(additional_dict["min_lat"]) + 0.0001, float(additional_dict["max_lat"]) - 0.0001)
+    lon = random.uniform(float(additional_dict["min_lon"]) + 0.0001, float(additional_dict["max_lon"]) - 0.0001)
+    int_offset = random.randint(int(additional_dict["min_offset"]), int(additional_dict["max_offset"]))
+    offset = "{}{:02d}:00".format("%2B" if int_offset >= 0 else "-", abs(int_offset))
+    body = random.choice(bodies)
+    url = base_url + body + "?elevation={}&date={}&offset={}&lat={}&lon={}&days={}".format(
+        int(additional_dict["elevation"]), date_range, offset, round(lat, 4), round(lon, 4), int(additional_dict["days"]))
+    return body, url
+
+
+def intervals(distrib, rps):
+    """
+    Yields the time between consecutive intended send times.
+    """
+    while True:
+        if distrib == "poisson":
+            yield np.random.exponential(1 / rps)
+        else:
+            yield 1 / rps
+
+
+def random_schedule(base_url, bodies, distrib, rps, offset=0.0):
+    """
+    Yields the (intended send time from the start, body, url)
+    of requests for random places and dates, from offset on.
+    """
+    for interval in intervals(distrib, rps):
+        yield (offset,) + random_request(base_url, bodies)
+        offset += interval
+
+
+def replay_schedule(log, target, speed, prefix, distrib, rps):
+    """
+    Yields the (intended send time from the start, body, url) of the
+    requests in log, sent to target. The recorded times are divided by
+    speed, or ignored and replaced by the distribution if speed is 0.
+    """
+    paced = intervals(distrib, rps)
+    offset = 0.0
+    for seconds, path in read_log(log, prefix):
+        if speed > 0:
+            offset = seconds / speed
+        yield (offset, body_of(path), target.rstrip("/") + path)
+        if speed <= 0:
+            offset += next(paced)
+
+
+def print_report(summary):
+    def row(name, s):
+        values = [s["p50"], s["p90"], s["p99"], s["p99.9"], s["max"]]
+        print("{:<16}{:>9}".format(name, s["count"])
+              + "".join("{:>11.1f}".format(1000 * v) for v in values), flush=True)
+
+    print("Sent {} requests in {:.1f} s, {:.1f} requests/s".format(
+        summary["requests"], summary["seconds"], summary["achieved_rps"])
+          + (" (target {})".format(summary["target_rps"]) if summary["target_rps"] else ""))
+    print("{:<16}{:>9}".format("latency (ms)", "count")
+          + "".join("{:>11}".format(p) for p in ["p50", "p90", "p99", "p99.9", "max"]))
+    if summary["requests"] == 0:
+        return
+    row("all", summary["latency"])
+    row("service time", summary["service"])
+    row("send lag", summary["send_lag"])
+    for status, s in summary["by_status"].items():
+        row("status " + status, s)
+    for body, s in summary["by_body"].items():
+        row("body " + body, s)
+
+
+def write_summary(summary, prefix):
+    """
+    Writes the summary and the histograms as JSON to out_dir, so that
+    runs can be compared and their histograms merged later.
+    """
+    out_dir = req_dict.get("out_dir")
+    if not out_dir:
+        return
+    os.makedirs(out_dir, exist_ok=True)
+    name = "{}-{:%Y-%m-%d-%H:%M:%S}-summary.json".format(prefix, datetime.now())
+    summary = dict(summary, histograms=results.to_dict())
+    with open(os.path.join(out_dir, name), "w") as f:
+        json.dump(summary, f)
+    print("Summary written to {}".format(os.path.join(out_dir, name)))
+
+
+def summarize(run, processes):
+    return {"mode": run["mode"],
+            "replay": run["replay"],
+            "started": run["started"],
+            "url": req_dict["url"],
+            "distribution": dim_dict["distribution"],
+            "processes": processes,
+            "target_rps": run["target_rps"],
+            "seconds": run["seconds"],
+            "requests": run["requests"],
+            "achieved_rps": run["requests"] / run["seconds"] if run["seconds"] else 0,
+            "latency": results.latency.summary(),
+            "service": results.service.summary(),
+            "send_lag": results.send_lag.summary(),
+            "by_status": {k: h.summary() for k, h in sorted(results.by_status.items())},
+            "by_body": {k: h.summary() for k, h in sorted(results.by_body.items())}}
+
+
+async def main(index=0, processes=1) -> dict:
+    """
+    Sends the share of the requests of process index out of processes,
+    and returns how many were sent when.
+    """
+    loop = get_event_loop()
+    stop = Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    distrib = dim_dict["distribution"].lower()
+    if distrib not in ("poisson", "uniform"):
+        printe("ERROR - Unknown distribution {}".format(distrib))
+        exit(1)
+    last = int(dim_dict["seconds"])
+    rps = float(dim_dict["rps"])
+    op = req_dict["operation"]  # read from param if GET or POST
+    base_url = req_dict["url"]  # read url from input param
+    bodies = [b.strip() for b in req_dict.get("bodies", "sun").split(",")]
+    jpath = req_dict["payload"]  # eventually load json in case of http POST
+    jcontent = None
+    if op == "POST":
+        with open(jpath) as jfile:
             jcontent = json.load(jfile)
-            jfile.close()
-        rps = int(dim_dict["rps"])  # read rps from input param
-        while get_event_loop().time() < stress_test_last:  # replace with loop
-            start_inner_loop_time = get_event_loop().time()
-            date_range = get_random_date_range(datetime.strptime(min_date, date_format), datetime.strptime(max_date, date_format), timedelta(days=1))
-            lat = random.uniform(min_lat + 0.0001, max_lat - 0.0001)
-            lon = random.uniform(min_lon + 0.0001, max_lon - 0.0001)
-            int_offset = random.randint(0, max_offset)
-            offset = "{0:0=2d}".format(int_offset)
-            int_offset = random.randint(min_offset, max_offset)
-            if(int_offset >= 0):
-              offset = "%2B" + offset
-            else:
-              offset = "-" + offset
-            url = base_url + "elevation={}&date={}&offset={}:00&lat={}&lon={}&days={}".format(elevation, date_range, offset, round(lat, 4), round(lon, 4), days)
-            task = create_task(get_response(session, url, op, jcontent))
+    connector = TCPConnector(limit=int(req_dict.get("max_connections", 0)))
+    timeout = ClientTimeout(total=float(req_dict.get("timeout", 60)))
+    replay = dict(config.items("REPLAY")) if config.has_section("REPLAY") else {}
+    if replay.get("log"):
+        op = "GET"
+        speed = float(replay.get("speed", 1))
+        schedule = replay_schedule(replay["log"], replay.get("target") or base_url.split("/events/")[0],
+                                   speed, replay.get("prefix", "/events/"), distrib, rps)
+        # Every process replays every processes'th request of the log
+        schedule = islice(schedule, index, None, processes)
+        mode = {"mode": "replay", "replay": {"log": replay["log"], "speed": speed}}
+        if speed > 0:
+            rps = None
+    else:
+        # Staggered so that uniform schedules of all processes interleave
+        schedule = random_schedule(base_url, bodies, distrib, rps / processes, offset=index / rps)
+        mode = {"mode": "random", "replay": None}
+    tasks = set()
+    count = 0
+
+    async with ClientSession(connector=connector, timeout=timeout) as session:
+        started = datetime.now(timezone.utc)
+        start_time = loop.time()
+        for offset, body, url in schedule:
+            if offset >= last or stop.is_set():
+                break
+            # Wait for the intended send time, never for earlier responses
+            intended = start_time + offset
+            delay = intended - loop.time()
+            if delay > 0:
+                await sleep(delay)
+            task = create_task(send(session, url, body, intended, op, jcontent))
             tasks.add(task)
             task.add_done_callback(tasks.discard)
-            if(distrib.lower() == "poisson"):
-                # Poisson
-                slept, count = np.random.exponential(1 / rps), count + 1
-            else:
-                # Uniform
-                slept, count = 1 / rps, count + 1
-            await sleep(slept - (get_event_loop().time() - start_inner_loop_time))
-            # print(f'slept: {slept}')  # print sleeping time
-        print_report()
-        #tot, succ = 0, 0
-        #for t in tasks:
-        #    try:
-        #        t.exception()
-        #    except exceptions.InvalidStateError or client_exceptions.ServerDisconnectedError:
-        #        pass
-        #while not q.empty():  # retrieve data from synchronized queue
-        #    pair = q.get()
-        #    q.task_done()
-            # print(f'Latency: {pair[1]}, status: {pair[0]}')  # readable format
-            # print(f'{pair[1]}, {pair[0]}, {op}, {url}')  # csv format
-        #    if pair[0] == 200:
-        #        succ += 1
-        #    tot += pair[1]
-        #print(f'Avg Latency: {tot / count}, Success rate: {100 * succ / count}')
-        # file.write(f'# Avg Latency: {tot / count}, Success rate: {100 * succ / count}\n')
+            count += 1
+        seconds = loop.time() - start_time
+
+        # Requests still unanswered after the drain period are recorded
+        # with the latency they had reached, so they are not lost
+        if tasks:
+            await wait(set(tasks), timeout=float(req_dict.get("drain_seconds", 30)))
+        if tasks:
+            printw("WARNING - {} requests unanswered at the end of the test".format(len(tasks)))
+            for task in tasks:
+                task.cancel()
+            await wait(set(tasks))
+
+    return dict(mode, started=started.isoformat(timespec="seconds"),
+                seconds=seconds, requests=count, target_rps=rps)
+
+
+def run_worker(index, processes, conn):
+    """
+    Entry point of the load generating processes, sending
+    what main returns and the results through conn.
+    """
+    global results
+    random.seed()
+    np.random.seed()
+    results = Results()
+    sent = run(main(index, processes))
+    conn.send((sent, results.to_dict()))
+    conn.close()
+
+
+def run_processes(processes) -> dict:
+    """
+    Runs processes load generating processes and merges their results
+    into results. Returns the combined counts of what they sent.
+    """
+    context = multiprocessing.get_context("fork")
+    workers = []
+    for index in range(processes):
+        receiver, sender = context.Pipe(duplex=False)
+        worker = context.Process(target=run_worker, args=(index, processes, sender))
+        worker.start()
+        sender.close()
+        workers.append((worker, receiver))
+
+    # The processes stop on SIGINT or SIGTERM, which only reach this
+    # process when the tester runs in a container
+    def forward(signum, frame):
+        for worker, receiver in workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGTERM)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, forward)
+
+    runs = []
+    for worker, receiver in workers:
+        try:
+            sent, worker_results = receiver.recv()
+        except EOFError:
+            printe("ERROR - Load generating process {} failed".format(worker.pid))
+            continue
+        runs.append(sent)
+        results.merge(Results.from_dict(worker_results))
+    for worker, receiver in workers:
+        worker.join()
+    if not runs:
+        exit(1)
+    return dict(runs[0], started=min(r["started"] for r in runs),
+                seconds=max(r["seconds"] for r in runs),
+                requests=sum(r["requests"] for r in runs))
 
 
 config = configparser.RawConfigParser()
@@ -169,6 +393,7 @@ elif not genericpath.isfile(sys.argv[1]):
     printe("ERROR - Impossible to read configuration file")
     exit(1)
 config.read(sys.argv[1])
+prefix = sys.argv[2] if len(sys.argv) > 2 else "stress-test"
 
 try:
     req_dict = dict(config.items('REQUEST'))
@@ -177,12 +402,13 @@ try:
 except configparser.NoSectionError:
     printe("ERROR - Impossible to parse configuration file")
     exit(1)
-trace_config = TraceConfig()
-trace_config.on_request_start.append(on_request_start)
-trace_config.on_request_end.append(on_request_end)
-
-signal.signal(signal.SIGINT, ctrl_c_handler)
-tasks = set()
-count = 0
-q = Queue()
-run(main())
+
+results = Results()
+processes = int(dim_dict.get("processes", 1))
+if processes > 1:
+    sent = run_processes(processes)
+else:
+    sent = run(main())
+summary = summarize(sent, processes)
+print_report(summary)
+write_summary(summary, prefix)
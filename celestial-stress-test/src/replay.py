@@ -0,0 +1,46 @@
+"""
+Reading recorded requests to replay them.
+
+The log is JSON lines, as the API writes with LOG_FORMAT=json: every
+line with a "path" field is a request, with its "query" string and
+the "time" it was logged as an ISO 8601 timestamp. Other lines, such
+as startup messages, are skipped. Only GET requests are replayed,
+as the log does not hold request bodies.
+"""
+import json
+from datetime import datetime
+
+
+def read_log(path, prefix="/events/"):
+    """
+    Yields the (seconds after the first request, path and query) of
+    the GET requests in the log whose path starts with prefix.
+    Requests without a time are given the time of the previous one.
+    """
+    first = None
+    seconds = 0.0
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if not isinstance(entry, dict) or not str(entry.get("path", "")).startswith(prefix):
+                continue
+            if entry.get("method", "GET").upper() != "GET":
+                continue
+            if "time" in entry:
+                # fromisoformat in Python 3.8 does not accept a Z suffix
+                time = datetime.fromisoformat(entry["time"].replace("Z", "+00:00")).timestamp()
+                first = time if first is None else first
+                seconds = time - first
+            query = entry.get("query") or ""
+            yield (seconds, entry["path"] + ("?" + query if query else ""))
+
+
+def body_of(path) -> str:
+    """
+    The body of an /events/{body} path, or the path itself for other endpoints.
+    """
+    parts = path.split("?")[0].strip("/").split("/")
+    return parts[1] if len(parts) > 1 and parts[0] == "events" else path.split("?")[0]
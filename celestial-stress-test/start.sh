@@ -34,9 +34,9 @@ DATE_FORMAT=+%Y-%m-%d-%H:%M:%S
 [ ! -d $DATA_DIR ] && mkdir $DATA_DIR
 [ ! -d $DATA_DIR/$ERROR_LOG_DIR ] && mkdir $DATA_DIR/$ERROR_LOG_DIR
 
-OUTPUT=$PREFIX-$(date $DATE_FORMAT)-latencies.csv
+OUTPUT=$PREFIX-$(date $DATE_FORMAT)-report.txt
 
-docker run --add-host host.docker.internal:host-gateway $CONTAINER_NAME:$VERSION 2> $DATA_DIR/$ERROR_LOG_DIR/$PREFIX-$(date $DATE_FORMAT)-req-errors.txt 1> $DATA_DIR/$OUTPUT & pid="$!"; trap 'sigint_handler' SIGINT
+docker run --add-host host.docker.internal:host-gateway -v $(pwd)/$DATA_DIR:/data $CONTAINER_NAME:$VERSION $PREFIX 2> $DATA_DIR/$ERROR_LOG_DIR/$PREFIX-$(date $DATE_FORMAT)-req-errors.txt 1> $DATA_DIR/$OUTPUT & pid="$!"; trap 'sigint_handler' SIGINT
 #####trap "echo -e '\nStopping container...\n'" 2
 
 
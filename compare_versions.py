@@ -2,54 +2,208 @@
 compare_versions.py
 
 Usage:
-    python compare_versions.py <API_URL_1> <API_URL_2>
+    python compare_versions.py <API_URL_1> <API_URL_2> [--number 10000] [--concurrency 32]
 
 Example:
     python3 compare_versions.py http://localhost:8080 https://celestial-dev.k8s.met.no
 
-This script compares the JSON responses from two API endpoints for randomly generated dates and coordinates.
+This script compares the JSON responses from two API endpoints for randomly
+generated dates, coordinates and offsets, for both the Sun and the Moon.
+
+Event times are compared within --time-tolerance seconds and angles within
+--angle-tolerance degrees, everything else has to be equal. The distribution
+of the differences of every field is reported, as well as the throughput and
+latency of each API. The queries are sent concurrently, at most --concurrency
+at a time to each API. The exit code is 1 if any response differs beyond the
+tolerances.
 """
 
+import argparse
+import asyncio
+import re
+import sys
+from datetime import datetime, timedelta
+from time import perf_counter
 import httpx
 import numpy as np
-import difflib
-import json
-import sys
-from urllib.parse import urljoin
 
+BODIES = ["sun", "moon"]
+FIRST_DATE = datetime(1990, 1, 1)
+LAST_DATE = datetime(2024, 12, 31)
+TIME_PATTERN = re.compile(r"^\d{4}-\d\d-\d\dT")
 
-N = 50
 
-def main():
+def random_queries(number, days, rng) -> list:
+    """
+    Returns number query strings for random bodies, dates, places and
+    whole hour offsets, covering every day of the year.
+    """
+    dates = [FIRST_DATE + timedelta(days=int(d)) for d in
+             rng.integers(0, (LAST_DATE - FIRST_DATE).days + 1, number)]
+    lats = rng.uniform(-89.99, 89.99, number)
+    lons = rng.uniform(-179.99, 179.99, number)
+    offsets = rng.integers(-12, 15, number)
+    bodies = rng.choice(BODIES, number)
+    return [f"/events/{body}?date={date:%Y-%m-%d}&lat={lat:.4f}&lon={lon:.4f}"
+            f"&offset={'%2B' if offset >= 0 else '-'}{abs(offset):02d}%3A00&days={days}"
+            for body, date, lat, lon, offset in zip(bodies, dates, lats, lons, offsets)]
 
-    if len(sys.argv) < 2:
-        raise Exception("Please provide two API URLs as arguments.")
-    api1 = str(sys.argv[1])
-    api2 = str(sys.argv[2])
 
-    print(f"Comparing {api1} and {api2} ...")
-    lat = np.random.uniform(-90, 90, N)
-    lon = np.random.uniform(-180, 180, N)
-
-    day = np.random.randint(1,27, N) # 27 to avoid querying february out of range
-    month = np.random.randint(1,12, N)
-    year = np.random.randint(1990, 2025, N)
-
-    for i in range(N):
-        query_string = f"/events/sun?date={year[i]}-{str(month[i]).zfill(2)}-{str(day[i]).zfill(2)}&lat={lat[i]}&lon={lon[i]}&offset=%2B00%3A00"
-        r1 = httpx.get(urljoin(api1, query_string))
-        r2 = httpx.get(urljoin(api2, query_string))
-        str1 = json.dumps(r1.json(), indent=2, sort_keys=True)
-        str2 = json.dumps(r2.json(), indent=2, sort_keys=True)
-
-        diff = difflib.unified_diff(str1.splitlines(), str2.splitlines())
-        
+def is_time(field) -> bool:
+    return field.endswith("time") or field.endswith("interval")
+
+
+def is_angle(field) -> bool:
+    """
+    Azimuths and the moon phase wrap around at 360 degrees.
+    """
+    return field.endswith("azimuth") or field.endswith("moonphase")
+
+
+def differences(a, b, path="") -> tuple:
+    """
+    Walks two responses together and returns the differences of their
+    event times in seconds and angles in degrees, as a list of
+    (field, difference), and the fields that differ otherwise.
+    """
+    if isinstance(a, dict) and isinstance(b, dict):
+        found, mismatches = [], []
+        for key in sorted(set(a) | set(b)):
+            if key not in a or key not in b:
+                mismatches.append(f"{path}.{key}".lstrip("."))
+                continue
+            more, other = differences(a[key], b[key], f"{path}.{key}")
+            found += more
+            mismatches += other
+        return found, mismatches
+    if isinstance(a, list) and isinstance(b, list) and len(a) == len(b):
+        found, mismatches = [], []
+        for x, y in zip(a, b):
+            more, other = differences(x, y, path)
+            found += more
+            mismatches += other
+        return found, mismatches
+    field = path.lstrip(".")
+    if isinstance(a, str) and isinstance(b, str) and TIME_PATTERN.match(a) and TIME_PATTERN.match(b):
+        # datetime.fromisoformat accepts the Z suffix from Python 3.11 only
+        seconds = (datetime.fromisoformat(a.replace("Z", "+00:00"))
+                   - datetime.fromisoformat(b.replace("Z", "+00:00"))).total_seconds()
+        return [(field, seconds)], []
+    numbers = (int, float)
+    if (isinstance(a, numbers) and isinstance(b, numbers)
+            and not isinstance(a, bool) and not isinstance(b, bool)):
+        if is_angle(field):
+            return [(field, (a - b + 180) % 360 - 180)], []
+        return [(field, a - b)], []
+    return [], ([] if a == b else [field])
+
+
+async def fetch(client, api, query, limit, latencies) -> tuple:
+    async with limit:
+        start = perf_counter()
+        try:
+            response = await client.get(api.rstrip("/") + query)
+        except httpx.HTTPError as e:
+            return (None, repr(e))
+        latencies.append(perf_counter() - start)
         try:
-            assert r1.json() == r2.json()
-            print(f"Responses from {api1} and {api2} for query string {query_string} are equal")
-        except AssertionError:
-            print(f"Responses from {api1} and {api2} for query string {query_string} are NOT equal. see diff below:")
-            print('\n'.join(diff))
+            return (response.status_code, response.json())
+        except ValueError:
+            return (response.status_code, response.text)
+
+
+async def compare(api1, api2, queries, concurrency) -> tuple:
+    """
+    Queries both APIs and returns the responses, the latencies of
+    each API and the total time taken.
+    """
+    latencies = ([], [])
+    limits = (asyncio.Semaphore(concurrency), asyncio.Semaphore(concurrency))
+    connections = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(timeout=60, limits=connections) as client1, \
+            httpx.AsyncClient(timeout=60, limits=connections) as client2:
+        start = perf_counter()
+        responses = await asyncio.gather(*[
+            asyncio.gather(fetch(client1, api1, query, limits[0], latencies[0]),
+                           fetch(client2, api2, query, limits[1], latencies[1]))
+            for query in queries])
+        seconds = perf_counter() - start
+    return responses, latencies, seconds
+
+
+def print_distribution(name, values, unit, tolerance):
+    values = np.abs(values)
+    print(f"{name:<48}{len(values):>8}{np.mean(values):>10.3f}"
+          + "".join(f"{v:>10.3f}" for v in np.percentile(values, [50, 99]))
+          + f"{values.max():>10.3f} {unit:<4}{np.count_nonzero(values > tolerance):>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the responses of two versions of the API.")
+    parser.add_argument("api1")
+    parser.add_argument("api2")
+    parser.add_argument("--number", type=int, default=50, help="number of queries")
+    parser.add_argument("--days", type=int, default=1, help="days per query")
+    parser.add_argument("--concurrency", type=int, default=16,
+                        help="queries in flight at a time to each API")
+    parser.add_argument("--time-tolerance", type=float, default=60,
+                        help="allowed difference of event times in seconds")
+    parser.add_argument("--angle-tolerance", type=float, default=0.1,
+                        help="allowed difference of angles in degrees")
+    parser.add_argument("--seed", type=int, help="seed of the random queries")
+    parser.add_argument("--show", type=int, default=10,
+                        help="number of differing responses to print")
+    args = parser.parse_args()
+
+    api1, api2 = args.api1, args.api2
+    print(f"Comparing {api1} and {api2} ...")
+    queries = random_queries(args.number, args.days, np.random.default_rng(args.seed))
+    responses, latencies, seconds = asyncio.run(
+        compare(api1, api2, queries, args.concurrency))
+
+    fields = {}
+    equal = within = failed = 0
+    shown = 0
+    for query, ((status1, json1), (status2, json2)) in zip(queries, responses):
+        if status1 != status2 or status1 is None:
+            found, mismatches = [], [f"status {status1} != {status2}"]
+        else:
+            found, mismatches = differences(json1, json2)
+        for field, difference in found:
+            fields.setdefault(field, []).append(difference)
+        beyond = [f"{field} differs by {difference:.3f}" for field, difference in found
+                  if abs(difference) > (args.time_tolerance if is_time(field)
+                                        else args.angle_tolerance)]
+        if not mismatches and not any(difference for _, difference in found):
+            equal += 1
+        elif not mismatches and not beyond:
+            within += 1
+        else:
+            failed += 1
+            if shown < args.show:
+                shown += 1
+                print(f"Responses for query string {query} are NOT equal: "
+                      + ", ".join(mismatches + beyond))
+
+    print(f"\n{len(queries)} queries: {equal} equal, {within} within tolerances, "
+          f"{failed} different")
+    if fields:
+        print(f"\n{'field':<48}{'count':>8}{'mean':>10}{'p50':>10}{'p99':>10}{'max':>10} "
+              f"{'unit':<4}{'beyond':>8}")
+        for field, values in sorted(fields.items()):
+            if is_time(field):
+                print_distribution(field, values, "s", args.time_tolerance)
+            else:
+                print_distribution(field, values, "deg", args.angle_tolerance)
+
+    print(f"\n{'api':<40}{'req/s':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for api, times in zip((api1, api2), latencies):
+        if times:
+            print(f"{api:<40}{len(times) / seconds:>8.1f}"
+                  + "".join(f"{1000 * v:>10.1f}" for v in np.percentile(times, [50, 90, 99]))
+                  + f"{1000 * max(times):>10.1f}")
+    sys.exit(1 if failed else 0)
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()